@@ -2,9 +2,11 @@
 Customized admin interface for Poll
 """
 from django.contrib import admin
-from polls.models import Poll
+from django.contrib.admin.views.main import ChangeList
+from polls.models import Poll, PollStats
 from polls.models import Choice
 from polls.models import Voter
+from polls.jobs import enqueue
 from django.contrib.auth.models import User
 
 class ChoiceInline(admin.TabularInline):
@@ -20,6 +22,14 @@ class VoterInline(admin.TabularInline):
     """
     model = Voter
 
+class PollChangeList(ChangeList):
+    """
+    Change list computing the vote statistics of the listed polls at once
+    """
+    def get_results(self, request):
+        super(PollChangeList, self).get_results(request)
+        PollStats.for_polls(self.result_list)
+
 class PollAdmin(admin.ModelAdmin):
     """
     Admin view poll class
@@ -28,13 +38,26 @@ class PollAdmin(admin.ModelAdmin):
         (None, {'fields': ['question']}),
         ('Date information', {'fields': ['pub_date']}),
         ('Active', {'fields': ['is_open']}),
+        ('Voters', {'fields': ['segment', 'segment_group']}),
+        ('Performance', {'fields': ['vote_shards'], 'classes': ['collapse']}),
     ]
     inlines = [ChoiceInline, VoterInline]
-    list_display = ('question', 'pub_date', 'is_open', 'was_published_recently')
+    list_display = ('question', 'pub_date', 'is_open', 'was_published_recently',
+                    'total_votes', 'get_winner')
     list_filter = ['pub_date']
     search_fields = ['question']
+    actions = ['reopen_polls', 'register_voters']
     #fields = ['pub_date', 'question']
 
+    def get_changelist(self, request, **kwargs):
+        return PollChangeList
+
+    def save_model(self, request, obj, form, change):
+        super(PollAdmin, self).save_model(request, obj, form, change)
+        if change and 'vote_shards' in form.changed_data:
+            # reads only add the shards of sharded polls - fold them in
+            obj.rollup_vote_shards()
+
     #def save_model(self, request, obj, form, change):
     #    """
     #    Save the Poll model - register users to Voter list upon form save
@@ -50,6 +73,26 @@ class PollAdmin(admin.ModelAdmin):
     #                voter = Voter(poll=obj, user=user, has_voted=False)
     #                voter.save()
 
+    def reopen_polls(self, request, queryset):
+        """
+        Bulk action - reopen the selected polls
+        """
+        n_reopened = queryset.reopen()
+        self.message_user(request, '%d poll(s) reopened' % n_reopened)
+    reopen_polls.short_description = 'Reopen selected polls'
+
+    def register_voters(self, request, queryset):
+        """
+        Bulk action - register the voters of the selected open polls ahead
+        of their visits, in background jobs. Optional, voters are registered
+        on their first visit otherwise
+        """
+        poll_ids = list(queryset.filter(is_open=True).values_list('pk', flat=True))
+        for poll_id in poll_ids:
+            enqueue('register_voters', poll_id=poll_id)
+        self.message_user(request, '%d poll(s) queued for voter registration' % len(poll_ids))
+    register_voters.short_description = 'Register voters of selected polls'
+
 # Register your models here.
 admin.site.register(Poll, PollAdmin)
 #admin.site.register(Choice)
@@ -0,0 +1,13 @@
+"""
+App config of the poll app
+"""
+from django.apps import AppConfig
+
+
+class PollsConfig(AppConfig):
+    name = 'polls'
+    verbose_name = 'Polls'
+
+    def ready(self):
+        # connects the receivers
+        from polls import signals
@@ -0,0 +1,71 @@
+"""
+In process vote event bus - feeds the vote_given event stream without
+polling the database for every connected client
+"""
+import collections
+import json
+import threading
+import time
+
+# events kept for clients that reconnect with Last-Event-ID
+MAX_EVENTS = 1000
+
+VoteEvent = collections.namedtuple('VoteEvent', 'seq poll_id type data')
+
+
+class VoteEventBus(object):
+    """
+    Ring buffer of poll events that clients can block on. Only sees the
+    events published by this process
+    """
+    def __init__(self, max_events=MAX_EVENTS):
+        self._cond = threading.Condition()
+        self._events = collections.deque(maxlen=max_events)
+        self._seq = 0
+
+    @property
+    def last_seq(self):
+        """
+        Sequence number of the latest event - start streaming after it
+        """
+        return self._seq
+
+    def publish(self, poll_id, event_type, **data):
+        """
+        Publish an event for poll_id and wake up the waiting clients
+        """
+        with self._cond:
+            self._seq += 1
+            self._events.append(VoteEvent(self._seq, poll_id, event_type, data))
+            self._cond.notify_all()
+
+    def wait(self, poll_id, after, timeout):
+        """
+        Return the events of poll_id newer than sequence number after -
+        blocks up to timeout seconds until there is one
+        """
+        deadline = time.time() + timeout
+        with self._cond:
+            while True:
+                if self._events and after < self._events[0].seq - 1:
+                    # client fell behind the ring buffer - it has to reload
+                    return [VoteEvent(self._seq, poll_id, 'resync', {})]
+                if after > self._seq:
+                    # sequence number of another process, or of this one
+                    # before a restart - it would filter out every event
+                    return [VoteEvent(self._seq, poll_id, 'resync', {})]
+                events = [e for e in self._events
+                          if e.seq > after and e.poll_id == poll_id]
+                remaining = deadline - time.time()
+                if events or remaining <= 0:
+                    return events
+                self._cond.wait(remaining)
+
+vote_events = VoteEventBus()
+
+def format_sse(event):
+    """
+    Serialize an event in text/event-stream format
+    """
+    return 'id: %d\nevent: %s\ndata: %s\n\n' % (event.seq, event.type,
+                                                json.dumps(event.data))
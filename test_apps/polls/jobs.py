@@ -0,0 +1,254 @@
+"""
+Background jobs - fan-out work is recorded in the Job table and run by a
+pool of threads once the transaction that queued it commits, so the
+request that triggered it does not wait for it. The only task registers
+the voters of a poll ahead of their visits, queued by the "Register
+voters" admin action. Voters are registered lazily on their first visit
+anyway, so neither is needed - they only take that write off the first
+page view. The eligible counts are not queued - closing a poll relies on
+them, so the receivers keep them current.
+
+The pool writes while requests do, which SQLite only survives with the
+SQLite profile and its TRANSACTION_MODE (see sqlite_profile). Without
+them a queue runs its jobs inline, as in SYNC mode.
+
+Queued jobs survive a restart - the next process picks them up. A failed
+attempt is retried up to MAX_ATTEMPTS times, failed jobs can be queued
+again with manage.py jobs retry. Tasks must therefore be idempotent.
+
+Settings in settings.POLLS_JOBS, SYNC runs every job inline when it is
+queued - the test runner turns it on.
+"""
+from django.conf import settings
+from django.db import connection, transaction
+from django.db.models import Count, F
+from django.utils import timezone
+
+from polls.models import Poll, Job, REGISTER_BATCH_SIZE
+from test_apps.sqlite_profile import retry_on_locked, waits_for_writers
+
+from multiprocessing.pool import ThreadPool
+
+import atexit
+import hashlib
+import json
+import threading
+import time
+import traceback
+
+DEFAULT_OPTIONS = {
+    # worker threads
+    'THREADS': 2,
+    # attempts of a job before it is marked failed ...
+    'MAX_ATTEMPTS': 3,
+    # ... waiting this many milliseconds between them
+    'RETRY_DELAY_MS': 1000,
+    # run jobs inline in the thread queueing them
+    'SYNC': False,
+}
+
+# seconds a task pauses between its batches of writes, so requests waiting
+# for the database get in between
+BATCH_PAUSE = 0.05
+
+# task name to function - see task
+TASKS = {}
+
+_job_queue = None
+_job_queue_lock = threading.Lock()
+
+
+def task(func):
+    """
+    Register func as a task jobs can run, under its name. A task may run
+    again after a failed attempt or a crash, so it has to be idempotent
+    """
+    TASKS[func.__name__] = func
+    return func
+
+@task
+def register_voters(poll_id):
+    """
+    Register the voters of an open poll ahead of their first visit - one
+    transaction per batch, a retry goes on with the users still missing
+    """
+    poll = Poll.objects.filter(pk=poll_id, is_open=True).first()
+    if poll is None:
+        return 0
+    n_registered = 0
+    for _ in poll.register_voters(REGISTER_BATCH_SIZE):
+        n_registered += 1
+        if n_registered % REGISTER_BATCH_SIZE == 0:
+            time.sleep(BATCH_PAUSE)
+    return n_registered
+
+
+class JobQueue(object):
+    """
+    Runs the jobs of the Job table on a thread pool - inline when the
+    database would fail writes racing the pool (see waits_for_writers)
+    """
+    def __init__(self, threads=DEFAULT_OPTIONS['THREADS'],
+                 max_attempts=DEFAULT_OPTIONS['MAX_ATTEMPTS'],
+                 retry_delay_ms=DEFAULT_OPTIONS['RETRY_DELAY_MS'], sync=False):
+        self.max_attempts = max_attempts
+        self.retry_delay = retry_delay_ms / 1000.0
+        self.sync = sync or not waits_for_writers(connection)
+        self._pool = None if self.sync else ThreadPool(threads)
+
+    def enqueue(self, name, **kwargs):
+        """
+        Queue task name with keyword arguments kwargs (JSON serializable).
+        A job of the same task and arguments still waiting to start is not
+        queued twice - it will see the current data when it runs. Returns
+        the job
+        """
+        if name not in TASKS:
+            raise KeyError('No task %s' % name)
+        args = json.dumps(kwargs, sort_keys=True)
+        key = '%s:%s' % (name, hashlib.sha1(args).hexdigest())
+        job = Job.objects.filter(status=Job.QUEUED, key=key).first()
+        if job is not None:
+            return job
+        job = Job.objects.create(name=name, args=args, key=key)
+        self._submit_on_commit(job.pk)
+        if self.sync:
+            job.refresh_from_db()
+        return job
+
+    def submit(self, job_id):
+        """
+        Hand job_id to the pool (run it now in sync mode)
+        """
+        if self.sync:
+            return self.run(job_id)
+        self._pool.apply_async(self._work, (job_id,))
+
+    def _submit_on_commit(self, job_id):
+        # the pool threads only see the job once it is committed
+        if self.sync:
+            self.run(job_id)
+        else:
+            transaction.on_commit(lambda: self.submit(job_id))
+
+    def run(self, job_id):
+        """
+        Run job_id if it is queued - claimed first so a job submitted twice
+        runs once - and retry it on failure. Returns the final status, None
+        if the job was not queued. In the pool the task and the job updates
+        are retried while SQLite reports the database as locked, before a
+        lock costs an attempt
+        """
+        call = (lambda func: func) if self.sync else retry_on_locked
+        while True:
+            claimed = call(Job.objects.filter(pk=job_id, status=Job.QUEUED).update)(
+                status=Job.RUNNING, attempts=F('attempts') + 1, started=timezone.now())
+            if not claimed:
+                return None
+            job = Job.objects.get(pk=job_id)
+            try:
+                if self.sync:
+                    # inline jobs run in the transaction of the caller - a
+                    # failed attempt is rolled back to a savepoint
+                    with transaction.atomic():
+                        TASKS[job.name](**json.loads(job.args))
+                else:
+                    call(TASKS[job.name])(**json.loads(job.args))
+            except Exception:
+                status = Job.QUEUED if job.attempts < self.max_attempts else Job.FAILED
+                call(Job.objects.filter(pk=job_id).update)(status=status,
+                                                           error=traceback.format_exc(),
+                                                           finished=timezone.now())
+                if status == Job.FAILED:
+                    return status
+                time.sleep(self.retry_delay)
+            else:
+                call(Job.objects.filter(pk=job_id).update)(status=Job.DONE, error='',
+                                                           finished=timezone.now())
+                return Job.DONE
+
+    def retry(self, job_ids=None):
+        """
+        Queue failed jobs again, and running ones left behind by a process
+        that died - all failed jobs unless job_ids are given. Returns number
+        of jobs queued
+        """
+        jobs = Job.objects.filter(status__in=(Job.FAILED, Job.RUNNING))
+        if job_ids is None:
+            jobs = jobs.filter(status=Job.FAILED)
+        else:
+            jobs = jobs.filter(pk__in=job_ids)
+        job_ids = list(jobs.values_list('pk', flat=True))
+        n_queued = Job.objects.filter(pk__in=job_ids).update(status=Job.QUEUED, attempts=0)
+        for job_id in job_ids:
+            self._submit_on_commit(job_id)
+        return n_queued
+
+    def resume(self):
+        """
+        Submit the jobs queued by a previous process. Returns their number
+        """
+        job_ids = list(Job.objects.filter(status=Job.QUEUED).order_by('pk')
+                                  .values_list('pk', flat=True))
+        for job_id in job_ids:
+            self.submit(job_id)
+        return len(job_ids)
+
+    def close(self):
+        """
+        Wait for the submitted jobs and stop the threads
+        """
+        if self._pool is not None:
+            self._pool.close()
+            self._pool.join()
+            self._pool = None
+
+    def _work(self, job_id):
+        # pool threads have database connections of their own
+        try:
+            self.run(job_id)
+        finally:
+            connection.close()
+
+
+def job_status():
+    """
+    Number of jobs per status
+    """
+    counts = dict((status, 0) for status, _ in Job.STATUSES)
+    counts.update(Job.objects.values_list('status').annotate(n=Count('pk')).order_by())
+    return counts
+
+def get_job_queue():
+    """
+    Return the process wide job queue
+    """
+    global _job_queue
+    if _job_queue is not None:
+        return _job_queue
+    options = dict(DEFAULT_OPTIONS, **getattr(settings, 'POLLS_JOBS', {}))
+    with _job_queue_lock:
+        if _job_queue is None:
+            job_queue = JobQueue(threads=options['THREADS'],
+                                 max_attempts=options['MAX_ATTEMPTS'],
+                                 retry_delay_ms=options['RETRY_DELAY_MS'],
+                                 sync=options['SYNC'])
+            if not job_queue.sync:
+                job_queue.resume()
+                atexit.register(job_queue.close)
+            _job_queue = job_queue
+    return _job_queue
+
+def set_job_queue(job_queue):
+    """
+    Install job_queue as the process wide queue (None to drop it)
+    """
+    global _job_queue
+    with _job_queue_lock:
+        _job_queue = job_queue
+
+def enqueue(name, **kwargs):
+    """
+    Queue task name on the process wide queue - see JobQueue.enqueue
+    """
+    return get_job_queue().enqueue(name, **kwargs)
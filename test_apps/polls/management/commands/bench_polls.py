@@ -0,0 +1,207 @@
+"""
+End-to-end benchmark of the polls views and model methods
+"""
+from django.core.management.base import BaseCommand, CommandError
+from django.contrib.auth.models import User
+from django.core.urlresolvers import reverse
+from django.test import Client
+from django.utils import timezone
+
+from polls.models import Poll
+from test_apps.bench import bench_database, timed, measure_request, seed_users
+from test_apps.bench import summarize, compare_to_baseline
+from test_apps.utils import factory
+
+import json
+
+BENCHMARKS = ('index', 'index_data', 'detail', 'vote', 'results', 'reopen', 'vote_randomly',
+              'register_voters')
+
+
+class Command(BaseCommand):
+    help = ('Time the polls views through the test client against a throwaway '
+            'database - reports latency percentiles and query counts')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--users', type=int, default=100,
+                            help='Users - all of them are voters of every poll')
+        parser.add_argument('--polls', type=int, default=10,
+                            help='Polls - every other one is closed')
+        parser.add_argument('--choices', type=int, default=3,
+                            help='Choices per poll')
+        parser.add_argument('--votes', type=int, default=50,
+                            help='Votes already cast in every open poll')
+        parser.add_argument('--runs', type=int, default=20,
+                            help='Timed runs per benchmark')
+        parser.add_argument('--only', nargs='+', choices=BENCHMARKS,
+                            help='Benchmarks to run (default all)')
+        parser.add_argument('--output', help='Save the results as JSON to this file')
+        parser.add_argument('--baseline',
+                            help='Compare to the JSON results saved by an earlier run')
+        parser.add_argument('--max-regression', type=float, default=20,
+                            help='Percent the median latency may grow over the baseline')
+
+    def handle(self, *args, **options):
+        if options['polls'] < 2:
+            raise CommandError('Need at least 2 polls - one open and one closed')
+        if options['votes'] + options['runs'] > options['users']:
+            raise CommandError('--votes plus --runs cannot exceed --users - '
+                               'every timed vote needs a voter who has not voted')
+
+        params = dict((key, options[key])
+                      for key in ('users', 'polls', 'choices', 'votes', 'runs'))
+        results = {}
+        with bench_database():
+            self.seed(options)
+            for name in BENCHMARKS:
+                if options['only'] and name not in options['only']:
+                    continue
+                timings, query_counts = getattr(self, 'bench_' + name)(options['runs'])
+                results[name] = summarize(timings, query_counts)
+
+        self.report(results)
+        if options['output']:
+            with open(options['output'], 'w') as output:
+                json.dump({'params': params, 'results': results}, output,
+                          indent=2, sort_keys=True)
+            self.stdout.write('Results saved to %s' % options['output'])
+        if options['baseline']:
+            self.check_baseline(params, results, options)
+
+    def seed(self, options):
+        """
+        Users, polls with their voters and choices and the votes cast so far
+        """
+        seed_users(options['users'])
+        self.users = list(User.objects.filter(username__startswith='benchuser')
+                                      .order_by('pk'))
+        choices = ['choice %d' % c for c in range(options['choices'])]
+        questions = ['bench poll %d' % i for i in range(options['polls'])]
+        # everybody voted in the closed polls
+        self.closed_polls = factory.create_polls(
+            questions[1::2], choices=choices,
+            votes=self.spread(options['users'], options['choices']))
+        self.open_polls = factory.create_polls(
+            questions[::2], choices=choices,
+            votes=self.spread(options['votes'], options['choices']))
+
+        # voters who have not voted in the first open poll yet
+        poll = self.open_polls[0]
+        self.pending_users = list(poll.pending_voters().order_by('pk'))
+
+    def spread(self, n_votes, n_choices):
+        """
+        Votes per choice with n_votes spread evenly over n_choices
+        """
+        return [n_votes // n_choices + (1 if c < n_votes % n_choices else 0)
+                for c in range(n_choices)]
+
+    def client_for(self, user):
+        client = Client()
+        client.force_login(user)
+        return client
+
+    def run(self, runs, request, setup=None, expected_status=200):
+        """
+        Time runs requests - request(run) returns (client, method, path, data),
+        setup(run) prepares the data untimed
+        """
+        timings, query_counts = [], []
+        for run in range(runs):
+            if setup is not None:
+                setup(run)
+            client, method, path, data = request(run)
+            elapsed, n_queries, response = measure_request(client, method, path, data)
+            if response.status_code != expected_status:
+                raise CommandError('%s %s returned %d' % (method.upper(), path,
+                                                          response.status_code))
+            timings.append(elapsed)
+            query_counts.append(n_queries)
+        return timings, query_counts
+
+    def bench_index(self, runs):
+        client = self.client_for(self.users[0])
+        return self.run(runs, lambda run: (client, 'get', reverse('polls:index'), None))
+
+    def bench_index_data(self, runs):
+        client = self.client_for(self.users[0])
+        return self.run(runs, lambda run: (client, 'get', reverse('polls:index_data'), None))
+
+    def bench_detail(self, runs):
+        client = self.client_for(self.pending_users[0])
+        path = reverse('polls:detail', args=(self.open_polls[0].id,))
+        return self.run(runs, lambda run: (client, 'get', path, None))
+
+    def bench_vote(self, runs):
+        poll = self.open_polls[0]
+        choice_ids = list(poll.choice_set.values_list('pk', flat=True))
+        path = reverse('polls:vote', args=(poll.id,))
+        clients = [self.client_for(user) for user in self.pending_users[:runs]]
+        return self.run(runs, lambda run: (clients[run], 'post', path,
+                                           {'choice': choice_ids[run % len(choice_ids)]}),
+                        expected_status=302)
+
+    def bench_results(self, runs):
+        client = self.client_for(self.users[0])
+        path = reverse('polls:results', args=(self.closed_polls[0].id,))
+        return self.run(runs, lambda run: (client, 'get', path, None))
+
+    def bench_reopen(self, runs):
+        poll = self.closed_polls[-1]
+        client = self.client_for(self.users[0])
+        path = reverse('polls:reopen')
+        def close(run):
+            poll.cast_random_votes(seed=run)
+        return self.run(runs, lambda run: (client, 'post', path, {'poll_ids': [poll.id]}),
+                        setup=close, expected_status=302)
+
+    def bench_vote_randomly(self, runs):
+        poll = self.closed_polls[-1]
+        client = self.client_for(self.users[0])
+        path = reverse('polls:vote_randomly')
+        def reopen(run):
+            Poll.objects.filter(pk=poll.pk).reopen()
+        return self.run(runs, lambda run: (client, 'post', path, {'poll_ids': [poll.id]}),
+                        setup=reopen, expected_status=302)
+
+    def bench_register_voters(self, runs):
+        """
+        Not a view - times Poll.register_voters, which registers every
+        eligible user ahead of their first visit, on a poll without voters
+        """
+        poll = Poll.objects.create(question='bench poll register',
+                                   pub_date=timezone.now())
+        timings, query_counts = [], []
+        for run in range(runs):
+            poll.voter_set.all().delete()
+            elapsed, n_queries, _ = timed(lambda: sum(1 for _ in poll.register_voters()))
+            timings.append(elapsed)
+            query_counts.append(n_queries)
+        return timings, query_counts
+
+    def report(self, results):
+        row = '%-16s %6s %9s %9s %9s %9s %8s'
+        self.stdout.write(row % ('benchmark', 'runs', 'p50 ms', 'p90 ms', 'p99 ms',
+                                 'max ms', 'queries'))
+        for name in BENCHMARKS:
+            if name not in results:
+                continue
+            result = results[name]
+            self.stdout.write(row % (name, result['runs'], '%.2f' % result['p50_ms'],
+                                     '%.2f' % result['p90_ms'], '%.2f' % result['p99_ms'],
+                                     '%.2f' % result['max_ms'], result['max_queries']))
+
+    def check_baseline(self, params, results, options):
+        with open(options['baseline']) as baseline_file:
+            baseline = json.load(baseline_file)
+        if baseline['params'] != params:
+            self.stderr.write('Baseline was taken with different data sizes: %s'
+                              % baseline['params'])
+        regressions = compare_to_baseline(results, baseline['results'],
+                                          options['max_regression'] / 100.0)
+        for name, metric, before, after in regressions:
+            self.stdout.write('REGRESSION %s %s: %s -> %s' % (name, metric, before, after))
+        if regressions:
+            raise CommandError('%d regression(s) against %s'
+                               % (len(regressions), options['baseline']))
+        self.stdout.write('No regressions against %s' % options['baseline'])
@@ -0,0 +1,45 @@
+"""
+Benchmark voter registration at different user counts
+"""
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from polls.models import Poll, REGISTER_BATCH_SIZE
+from test_apps.bench import bench_database, timed, seed_users
+
+
+class Command(BaseCommand):
+    help = 'Time Poll voter registration against a throwaway database'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--sizes', nargs='+', type=int,
+                            default=[10000, 100000, 1000000],
+                            help='User counts to benchmark')
+        parser.add_argument('--batch-size', type=int, default=REGISTER_BATCH_SIZE,
+                            help='Voters inserted per batch in stream mode')
+
+    def handle(self, *args, **options):
+        batch_size = options['batch_size']
+        row = '%10s %-10s %10s %8s %12s'
+        self.stdout.write(row % ('users', 'mode', 'seconds', 'queries', 'voters/s'))
+
+        with bench_database():
+            for size in sorted(options['sizes']):
+                seed_users(size)
+
+                # poll save - counts the eligible users, voters are
+                # registered on their first visit
+                poll = Poll(question='bench poll %d' % size, pub_date=timezone.now())
+                elapsed, n_queries, _ = timed(poll.save)
+                self.report(row, size, 'save', elapsed, n_queries)
+
+                # generator mode - register every user ahead of their visit
+                elapsed, n_queries, _ = timed(
+                    lambda: sum(1 for _ in poll.register_voters(batch_size)))
+                self.report(row, size, 'stream', elapsed, n_queries)
+
+                poll.delete()
+
+    def report(self, row, size, mode, elapsed, n_queries):
+        rate = size / elapsed if elapsed else 0
+        self.stdout.write(row % (size, mode, '%.3f' % elapsed, n_queries, '%d' % rate))
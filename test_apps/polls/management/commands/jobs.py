@@ -0,0 +1,48 @@
+"""
+Report on the background jobs of polls.jobs and queue failed ones again
+"""
+from django.core.management.base import BaseCommand
+
+from polls.jobs import get_job_queue, job_status
+from polls.models import Job
+
+
+class Command(BaseCommand):
+    help = ('Count the background jobs per status, list the latest ones or '
+            'queue failed ones again - all failed jobs unless ids are given')
+
+    def add_arguments(self, parser):
+        parser.add_argument('action', choices=('status', 'list', 'retry'))
+        parser.add_argument('ids', nargs='*', type=int,
+                            help='Jobs to retry - failed ones or running ones '
+                                 'whose process died')
+        parser.add_argument('--status', choices=[status for status, _ in Job.STATUSES],
+                            help='Only list jobs of this status')
+        parser.add_argument('--limit', type=int, default=20, help='Jobs listed')
+
+    def handle(self, *args, **options):
+        if options['action'] == 'status':
+            for status, n_jobs in sorted(job_status().items()):
+                self.stdout.write('%-8s %d' % (status, n_jobs))
+        elif options['action'] == 'list':
+            self.list_jobs(options['status'], options['limit'])
+        else:
+            job_queue = get_job_queue()
+            n_queued = job_queue.retry(options['ids'] or None)
+            self.stdout.write('%d job(s) queued again' % n_queued)
+            # the pool threads die with this process
+            job_queue.close()
+
+    def list_jobs(self, status, limit):
+        jobs = Job.objects.order_by('-pk')
+        if status:
+            jobs = jobs.filter(status=status)
+        row = '%6s %-8s %8s %-20s %-25s %s'
+        self.stdout.write(row % ('id', 'status', 'attempts', 'created', 'task', 'args'))
+        for job in jobs[:limit]:
+            self.stdout.write(row % (job.pk, job.status, job.attempts,
+                                     job.created.strftime('%Y-%m-%d %H:%M:%S'),
+                                     job.name, job.args))
+            if job.status == Job.FAILED:
+                # last line of the traceback
+                self.stdout.write('       %s' % job.error.strip().splitlines()[-1])
@@ -0,0 +1,28 @@
+"""
+Recompute the denormalized Poll counters and fix any drift
+"""
+from django.core.management.base import BaseCommand
+
+from polls.models import Poll
+
+
+class Command(BaseCommand):
+    help = 'Recompute voter/vote counters of polls and fix the ones that drifted'
+
+    def add_arguments(self, parser):
+        parser.add_argument('poll_ids', nargs='*', type=int,
+                            help='Polls to reconcile (default: all polls)')
+        parser.add_argument('--dry-run', action='store_true', default=False,
+                            help='Only report drift, do not fix it')
+
+    def handle(self, *args, **options):
+        polls = Poll.objects.all()
+        if options['poll_ids']:
+            polls = polls.filter(pk__in=options['poll_ids'])
+
+        drift = polls.reconcile_counters(dry_run=options['dry_run'])
+        for poll, field, stored, actual in drift:
+            self.stdout.write('poll %d: %s %d -> %d' % (poll.pk, field, stored, actual))
+
+        status = 'found' if options['dry_run'] else 'fixed'
+        self.stdout.write('%d counter(s) %s' % (len(drift), status))
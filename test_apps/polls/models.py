@@ -1,21 +1,350 @@
 """ Models for the poll app """
-from django.db import models
+from django.db import models, transaction, IntegrityError
+from django.db.models import F, Q, Sum, Count
 from django.utils import timezone
-from django.contrib.auth.models import User
+from django.contrib.auth.models import User, Group
 
+from polls.events import vote_events
+
+import bisect
+import collections
+import contextlib
 import datetime
 import random
+import threading
 
 # Create your models here.
 
+# number of users fetched and inserted per voter registration batch
+REGISTER_BATCH_SIZE = 1000
+
+# poll ids per UPDATE ... WHERE id IN - SQLite allows 999 parameters
+UPDATE_BATCH_SIZE = 500
+
+# eligibility segments of a poll - see Poll.segment
+SEGMENT_ALL = 'all'
+SEGMENT_GROUP = 'group'
+SEGMENTS = (
+    (SEGMENT_ALL, 'All users'),
+    (SEGMENT_GROUP, 'Members of a group'),
+)
+
+def changed(**updates):
+    """
+    update() arguments of updates that also mark the polls as changed -
+    see Poll.version
+    """
+    updates.update(version=F('version') + 1, modified=timezone.now())
+    return updates
+
+def segment_users(segment, group_id=None):
+    """
+    Users in an eligibility segment, as a query - nobody for a group
+    segment without a group
+    """
+    if segment == SEGMENT_GROUP:
+        if group_id is None:
+            return User.objects.none()
+        return User.objects.filter(groups=group_id)
+    return User.objects.all()
+
+# see batched_recounts
+_recounts = threading.local()
+
+def recount_open_polls():
+    """
+    Refresh both counters of the open polls after users or groups were
+    deleted - once at the end of the enclosing batched_recounts block if
+    there is one
+    """
+    if getattr(_recounts, 'depth', 0):
+        _recounts.pending = True
+    else:
+        Poll.objects.filter(is_open=True).refresh_eligible_counts(recount_voted=True)
+
+@contextlib.contextmanager
+def batched_recounts():
+    """
+    Defer the recount_open_polls calls of the block to a single one at its
+    end - a queryset delete sends post_delete once per row. Nests, the
+    outermost block recounts
+    """
+    outermost = not getattr(_recounts, 'depth', 0)
+    if outermost:
+        _recounts.depth, _recounts.pending = 0, False
+    _recounts.depth += 1
+    try:
+        yield
+    finally:
+        _recounts.depth -= 1
+    if outermost and _recounts.pending:
+        recount_open_polls()
+
+class PollQuerySet(models.QuerySet):
+    """
+    Set based operations on many polls
+    """
+    def reopen(self):
+        """
+        Reset the votes and voters of these polls and reopen them - constant
+        number of queries per UPDATE_BATCH_SIZE polls however many choices
+        and voters there are. Returns number of polls reopened
+        """
+        # loaded up front - the updates change what a filter of this
+        # queryset on the poll columns (is_open, ...) matches
+        poll_ids = list(self.values_list('pk', flat=True))
+        n_reopened = 0
+        with transaction.atomic():
+            for i in range(0, len(poll_ids), UPDATE_BATCH_SIZE):
+                batch = poll_ids[i:i + UPDATE_BATCH_SIZE]
+                Choice.objects.filter(poll__in=batch).exclude(votes=0).update(votes=0)
+                ChoiceShard.objects.filter(choice__poll__in=batch).exclude(votes=0)\
+                                   .update(votes=0)
+                Voter.objects.filter(poll__in=batch, has_voted=True).update(has_voted=False)
+                n_reopened += Poll.objects.filter(pk__in=batch).update(
+                    **changed(is_open=True, n_voted=0, n_votes=0))
+                # the eligible counts of closed polls are the ones they closed with
+                Poll.objects.filter(pk__in=batch).refresh_eligible_counts()
+        return n_reopened
+
+    def eligible_for(self, user):
+        """
+        These polls user is in the segment of
+        """
+        return self.filter(Q(segment=SEGMENT_ALL) |
+                           Q(segment=SEGMENT_GROUP, segment_group__in=user.groups.values('pk')))
+
+    def pending_for(self, user):
+        """
+        Open polls of these that user may vote on and has not voted on yet
+        """
+        return self.eligible_for(user).filter(is_open=True).exclude(
+            pk__in=Voter.objects.filter(user=user, has_voted=True).values('poll'))
+
+    def refresh_eligible_counts(self, recount_voted=False):
+        """
+        Count the eligible voters of these polls again - a COUNT and an
+        UPDATE per segment, polls whose count did not change are left
+        alone. Users leaving a segment take their votes out of n_voted, so
+        after departures recount_voted counts the voters again as well (see
+        voted_counts) and closes the open polls every eligible user has
+        voted on. Returns number of counter updates
+        """
+        n_updated = 0
+        segments = self.order_by().values_list('segment', 'segment_group').distinct()
+        for segment, group_id in list(segments):
+            n_eligible = segment_users(segment, group_id).count()
+            n_updated += self.filter(segment=segment, segment_group=group_id)\
+                             .exclude(n_eligible_voters=n_eligible)\
+                             .update(**changed(n_eligible_voters=n_eligible))
+        if recount_voted:
+            voted_counts = self.voted_counts()
+            drifted = collections.defaultdict(list)
+            for poll_id, n_voted in self.values_list('pk', 'n_voted'):
+                if n_voted != voted_counts.get(poll_id, 0):
+                    drifted[voted_counts.get(poll_id, 0)].append(poll_id)
+            for n_voted, poll_ids in drifted.items():
+                for i in range(0, len(poll_ids), UPDATE_BATCH_SIZE):
+                    n_updated += Poll.objects.filter(pk__in=poll_ids[i:i + UPDATE_BATCH_SIZE])\
+                                             .update(**changed(n_voted=n_voted))
+            # not the polls nobody could vote on yet
+            for poll in self.filter(is_open=True, n_voted__gt=0,
+                                    n_voted__gte=F('n_eligible_voters')):
+                poll.update_open_status()
+        return n_updated
+
+    def voted_counts(self):
+        """
+        Voters who have voted per poll of these - only the ones still in
+        the segment of the poll count. A query per segment
+        """
+        counts = {}
+        segments = self.order_by().values_list('segment', 'segment_group').distinct()
+        for segment, group_id in list(segments):
+            polls = self.filter(segment=segment, segment_group=group_id).values('pk')
+            voters = Voter.objects.filter(poll__in=polls, has_voted=True)
+            if segment != SEGMENT_ALL:
+                # the voters of deleted users are deleted with them
+                voters = voters.filter(user__in=segment_users(segment, group_id))
+            counts.update(voters.values('poll').annotate(n_voted=Count('pk'))
+                                .values_list('poll', 'n_voted'))
+        return counts
+
+    def reconcile_counters(self, dry_run=False):
+        """
+        Recompute the denormalized counters of these polls from the
+        Voter and Choice tables and the segments of the open polls, and fix
+        the ones that drifted. Closed polls keep the eligible and voted
+        counts they closed with - the segment may have changed since.
+        Returns list of (poll, field, stored value, actual value)
+        """
+        poll_ids = self.values_list('pk', flat=True)
+        voted_counts = self.filter(is_open=True).voted_counts()
+        vote_counts = collections.Counter(dict(
+            Choice.objects.filter(poll__in=poll_ids).values('poll')
+                          .annotate(n_votes=Sum('votes'))
+                          .values_list('poll', 'n_votes')))
+        vote_counts.update(dict(
+            ChoiceShard.objects.filter(choice__poll__in=poll_ids).values('choice__poll')
+                               .annotate(n_votes=Sum('votes'))
+                               .values_list('choice__poll', 'n_votes')))
+
+        drift = []
+        segment_counts = {}
+        for poll in self.only('pk', 'is_open', 'segment', 'segment_group', *Poll.COUNTER_FIELDS):
+            actual = {
+                'n_votes': vote_counts.get(poll.pk) or 0,
+            }
+            if poll.is_open:
+                actual['n_voted'] = voted_counts.get(poll.pk) or 0
+                segment = (poll.segment, poll.segment_group_id)
+                if segment not in segment_counts:
+                    segment_counts[segment] = segment_users(*segment).count()
+                actual['n_eligible_voters'] = segment_counts[segment]
+            drifted = dict((f, v) for f, v in actual.items() if getattr(poll, f) != v)
+            for field in sorted(drifted):
+                drift.append((poll, field, getattr(poll, field), drifted[field]))
+            if drifted and not dry_run:
+                Poll.objects.filter(pk=poll.pk).update(**changed(**drifted))
+        return drift
+
+    def stats(self):
+        """
+        Vote statistics of these polls - see PollStats.for_polls
+        """
+        return PollStats.for_polls(self)
+
+    def rollup_vote_shards(self):
+        """
+        Fold the shard counts of these polls into Choice.votes and zero the
+        shards. Returns number of votes moved
+        """
+        with transaction.atomic():
+            # locked until the end of the transaction so no vote lands on a
+            # shard between summing and zeroing it
+            shards = list(ChoiceShard.objects.select_for_update()
+                                     .filter(choice__poll__in=self.values('pk'))
+                                     .exclude(votes=0))
+            counts = collections.Counter()
+            for shard in shards:
+                counts[shard.choice_id] += shard.votes
+            for choice_id, n_votes in counts.items():
+                Choice.objects.filter(pk=choice_id).update(votes=F('votes') + n_votes)
+            if shards:
+                ChoiceShard.objects.filter(pk__in=[shard.pk for shard in shards])\
+                                   .update(votes=0)
+        return sum(counts.values())
+
+class PollStats(object):
+    """
+    Vote statistics of a poll - total votes, whether voting has started,
+    the winner and the choices ranked by votes
+    """
+    def __init__(self, poll, ranked_choices):
+        self.poll = poll
+        self.ranked_choices = ranked_choices
+        self.total_votes = sum(choice.votes for choice in ranked_choices)
+        self.has_voting_started = self.total_votes > 0
+
+    @property
+    def winner(self):
+        """
+        Choice with the most votes (lowest pk on a tie) - None while the
+        poll is open
+        """
+        if self.poll.is_open or not self.ranked_choices:
+            return None
+        return self.ranked_choices[0]
+
+    @classmethod
+    def for_polls(cls, polls, cache=True):
+        """
+        Compute the statistics of many polls with a single query. With cache
+        they are kept on the poll instances, where the Poll methods pick
+        them up. Returns dict of poll pk to PollStats
+        """
+        polls = list(polls)
+        ranked_choices = collections.defaultdict(list)
+        if polls:
+            choices = Choice.objects.filter(poll__in=[poll.pk for poll in polls])\
+                                    .order_by('poll', '-votes', 'pk')
+            for choice in choices:
+                ranked_choices[choice.poll_id].append(choice)
+
+        sharded = [poll.pk for poll in polls if poll.vote_shards]
+        if sharded:
+            shard_votes = dict(
+                ChoiceShard.objects.filter(choice__poll__in=sharded).values('choice')
+                                   .annotate(n_votes=Sum('votes'))
+                                   .values_list('choice', 'n_votes'))
+            for poll_id in sharded:
+                for choice in ranked_choices[poll_id]:
+                    choice.votes += shard_votes.get(choice.pk) or 0
+                ranked_choices[poll_id].sort(key=lambda c: (-c.votes, c.pk))
+        stats = {}
+        for poll in polls:
+            stats[poll.pk] = cls(poll, ranked_choices[poll.pk])
+            if cache:
+                poll._stats = stats[poll.pk]
+        return stats
+
 class Poll(models.Model):
     """ Poll model """
+    class Meta:
+        # the open and closed index tabs - newest first, keyset paginated
+        # on (pub_date, id)
+        index_together = [('is_open', 'pub_date')]
+
     question = models.CharField(max_length=200, unique=True)
-    pub_date = models.DateTimeField('date published')
+    pub_date = models.DateTimeField('date published', db_index=True)
     is_open = models.BooleanField(default=True)
 
+    # who may vote - all users or the members of segment_group. Voters are
+    # registered when they first open or vote on the poll, so there is no
+    # Voter row for the others
+    segment = models.CharField(max_length=10, choices=SEGMENTS, default=SEGMENT_ALL)
+    segment_group = models.ForeignKey(Group, null=True, blank=True,
+                                      on_delete=models.SET_NULL)
+
+    # denormalized counters - kept up to date by vote, reopen and the user
+    # and group receivers. n_eligible_voters counts the segment of an open
+    # poll and n_voted its voters still in the segment, a closed poll keeps
+    # the ones it closed with. Use PollQuerySet.reconcile_counters to fix drift.
+    n_eligible_voters = models.IntegerField(default=0, editable=False)
+    n_voted = models.IntegerField(default=0, editable=False)
+    n_votes = models.IntegerField(default=0, editable=False)
+
+    COUNTER_FIELDS = ('n_eligible_voters', 'n_voted', 'n_votes')
+
+    # bumped, and modified set, whenever anything shown about the poll can
+    # change - votes, voters, closing, reopening and edits. Part of the
+    # results cache key and of the ETags of the poll pages
+    version = models.IntegerField(default=0, editable=False)
+    modified = models.DateTimeField(default=timezone.now, editable=False, db_index=True)
+
+    # spread the votes of each choice over this many ChoiceShard rows so a
+    # burst of votes does not queue on one Choice row - 0 for no sharding.
+    # Change it with set_vote_shards
+    vote_shards = models.PositiveIntegerField(default=0)
+
+    objects = PollQuerySet.as_manager()
+
+    def stats(self):
+        """
+        Vote statistics of this poll - the ones computed by PollStats.for_polls
+        if any, else fresh ones
+        """
+        stats = getattr(self, '_stats', None)
+        if stats is None:
+            # not kept - votes cast through other instances would not show
+            stats = PollStats.for_polls([self], cache=False)[self.pk]
+        return stats
+
+    def _clear_stats(self):
+        self.__dict__.pop('_stats', None)
+
     def has_voting_started(self):
-        return any(choice.votes > 0 for choice in self.choice_set.all())
+        return self.stats().has_voting_started
 
     def __unicode__(self):
         """ represent object """
@@ -33,97 +362,311 @@ class Poll(models.Model):
     was_published_recently.short_description = 'Published recently?'
 
     def eligible_voters(self):
-        return User.objects.all()
+        """
+        Users in the segment of this poll
+        """
+        return segment_users(self.segment, self.segment_group_id)
+
+    def segment_voters(self):
+        """
+        Registered voters still in the segment of this poll - the others
+        can neither vote nor count as voted
+        """
+        voters = self.voter_set.all()
+        if self.segment != SEGMENT_ALL:
+            voters = voters.filter(user__in=self.eligible_voters())
+        return voters
+
+    def pending_voters(self):
+        """
+        Eligible users who have not voted - registered or not
+        """
+        return self.eligible_voters().exclude(
+            pk__in=self.voter_set.filter(has_voted=True).values('user'))
 
     def get_winner(self):
-        if self.is_open: 
-            return None
-        return max(self.choice_set.all(), key = lambda c: c.votes)
+        return self.stats().winner
+    get_winner.short_description = 'Winner'
 
     def update_open_status(self):
         """
         Check if poll ought to be closed - if all voters have voted
         """
-        n_voted = [v for v in self.voter_set.all() if v.has_voted == True]
-        if len(self.eligible_voters()) == len(n_voted):
+        n_closed = Poll.objects.filter(pk=self.pk, is_open=True,
+                                       n_voted__gte=F('n_eligible_voters'))\
+                               .update(**changed(is_open=False))
+        if n_closed:
             self.is_open = False
-            self.save()
+            self.version += 1
+            if self.vote_shards:
+                # no more votes - settle the final counts in Choice.votes
+                self.rollup_vote_shards()
+            transaction.on_commit(lambda: vote_events.publish(self.pk, 'closed'))
+        else:
+            # still open or closed by someone else - pick up current state
+            self.refresh_from_db(fields=('is_open', 'version', 'modified') +
+                                 self.COUNTER_FIELDS)
+            self._clear_stats()
         return self.is_open
 
     def reopen(self):
         """
         Reopen poll
         """
-        # set vote count to 0 for all choices
-        choices = self.choice_set.all()
-        for choice in choices:
-            choice.votes = 0
-            choice.save()
-
-        # set has_voted flag for all voters
-        voters = self.voter_set.all()
-        for voter in voters:
-            voter.has_voted = False
-            voter.save()
-
+        Poll.objects.filter(pk=self.pk).reopen()
         self.is_open = True
-        self.save()
+        self.n_voted = 0
+        self.n_votes = 0
+        self.version += 1
+        self._clear_stats()
         return True
 
+    def rollup_vote_shards(self):
+        """
+        Fold the shard counts of this poll into Choice.votes
+        """
+        n_votes = Poll.objects.filter(pk=self.pk).rollup_vote_shards()
+        self._clear_stats()
+        return n_votes
+
+    def set_vote_shards(self, vote_shards):
+        """
+        Switch vote sharding on (vote_shards > 0) or off (0) - pending shard
+        counts are rolled up first so no vote is lost either way
+        """
+        with transaction.atomic():
+            self.rollup_vote_shards()
+            Poll.objects.filter(pk=self.pk).update(vote_shards=vote_shards)
+        self.vote_shards = vote_shards
+
     def total_votes(self):
         """
         Count total votes for this poll
         """
-        total = 0
-        choices = self.choice_set.all()
+        return self.stats().total_votes
+    total_votes.short_description = 'Votes'
+
+    def cast_random_votes(self, seed=None, weights=None, limit=None):
+        """
+        Make every pending voter (the first limit ones if given) vote for a
+        random choice. All assignments are drawn up front and written with
+        one UPDATE per choice plus one for the voters. weights optionally
+        maps choice pk to its relative weight.
+        Returns list of (voter, choice) pairs
+        """
+        choices = list(self.choice_set.order_by('pk'))
+        if weights is None:
+            weights = dict((choice.pk, 1) for choice in choices)
+        cum_weights = []
+        total_weight = 0
         for choice in choices:
-            total += choice.votes
-        return total            
+            total_weight += weights.get(choice.pk, 0)
+            cum_weights.append(total_weight)
+        if choices and total_weight <= 0:
+            raise ValueError('At least one choice needs a positive weight')
+
+        rand = random.Random(seed)
+        assignments = []
+        with transaction.atomic():
+            voters = self.take_pending_voters(limit) if choices else []
+            if voters:
+                # draw a choice for every voter in one pass
+                for voter in voters:
+                    idx = bisect.bisect_right(cum_weights, rand.random() * total_weight)
+                    assignments.append((voter, choices[min(idx, len(choices) - 1)]))
+                counts = collections.Counter(choice.pk for _, choice in assignments)
 
-    def vote_randomly(self):
+                for choice in choices:
+                    if counts[choice.pk]:
+                        Choice.objects.filter(pk=choice.pk)\
+                                      .update(votes=F('votes') + counts[choice.pk])
+                        choice.votes += counts[choice.pk]
+                Poll.objects.filter(pk=self.pk).update(**changed(
+                    n_voted=F('n_voted') + len(assignments),
+                    n_votes=F('n_votes') + len(assignments)))
+                self.version += 1
+                user_ids = [voter.user_id for voter, _ in assignments]
+                transaction.on_commit(
+                    lambda: vote_events.publish(self.pk, 'vote', users=user_ids))
+        self._clear_stats()
+        self.update_open_status()
+        return assignments
+
+    def take_pending_voters(self, limit=None):
         """
-        Perform random voting on this poll
+        Mark the pending voters (the first limit ones if given) as voted -
+        the registered ones first in pk order, then the unregistered
+        eligible users in pk order, who are registered as voted. Call it in
+        a transaction and count their votes. Returns list of the voters
         """
-        not_voted = list(self.voter_set.filter(has_voted=False))
-        choices = self.choice_set.all()
-        random.shuffle(not_voted)
-        for voter in not_voted:
-            rand_choice = random.choice(choices)
-            rand_choice.votes += 1
+        pending = self.segment_voters().filter(has_voted=False).order_by('pk')
+        voters = list(pending[:limit] if limit is not None else pending)
+        if voters:
+            pending.filter(pk__lte=voters[-1].pk).update(has_voted=True)
+        if limit is None or len(voters) < limit:
+            missing = self.missing_voters().order_by('pk').values_list('pk', flat=True)
+            if limit is not None:
+                missing = missing[:limit - len(voters)]
+            new_voters = [Voter(poll=self, user_id=user_id, has_voted=True)
+                          for user_id in missing]
+            Voter.objects.bulk_create(new_voters, batch_size=REGISTER_BATCH_SIZE)
+            voters.extend(new_voters)
+        for voter in voters:
             voter.has_voted = True
-            rand_choice.save()
-            voter.save()
-            yield (voter, rand_choice)
-        self.update_open_status()
+        return voters
+
+    def vote_randomly(self, seed=None, weights=None):
+        """
+        Perform random voting on this poll - generator over the
+        (voter, choice) pairs cast by cast_random_votes
+        """
+        for voter, choice in self.cast_random_votes(seed, weights):
+            yield (voter, choice)
+
+    def vote(self, user, choice):
+        """
+        Atomically cast user's vote for choice - returns False if the user
+        has already voted in this poll or is not eligible
+        """
+        choice_id = getattr(choice, 'pk', choice)
+        with transaction.atomic():
+            # flip has_voted only if it is still False - concurrent requests
+            # for the same voter cannot both get past this update
+            pending = self.segment_voters().filter(user=user, has_voted=False)
+            if not pending.update(has_voted=True) and \
+               self.register_voter(user, has_voted=True) is None:
+                # voted already or not eligible - unless registered by
+                # opening the poll meanwhile
+                if not pending.update(has_voted=True):
+                    return False
+            if not self._count_vote(choice_id):
+                # rolls back the voter update
+                raise Choice.DoesNotExist('Choice %s not in poll %s' % (choice_id, self.pk))
+            Poll.objects.filter(pk=self.pk).update(**changed(n_voted=F('n_voted') + 1,
+                                                             n_votes=F('n_votes') + 1))
+            user_id = getattr(user, 'pk', user)
+            transaction.on_commit(
+                lambda: vote_events.publish(self.pk, 'vote', users=[user_id]))
+        self.n_voted += 1
+        self.n_votes += 1
+        self.version += 1
+        self._clear_stats()
+        return True
+
+    def _count_vote(self, choice_id):
+        """
+        Add one vote to choice_id - on a random shard row when the poll is
+        sharded. Returns False if choice_id is not a choice of this poll
+        """
+        if not self.vote_shards:
+            return self.choice_set.filter(pk=choice_id).update(votes=F('votes') + 1) > 0
+
+        shard = random.randrange(self.vote_shards)
+        shard_votes = ChoiceShard.objects.filter(choice__poll=self, choice=choice_id,
+                                                 shard=shard)
+        if shard_votes.update(votes=F('votes') + 1):
+            return True
+        if not self.choice_set.filter(pk=choice_id).exists():
+            return False
+        # shard rows are created on first use
+        try:
+            with transaction.atomic():
+                ChoiceShard.objects.create(choice_id=choice_id, shard=shard, votes=1)
+        except IntegrityError:
+            # created by a concurrent vote meanwhile
+            shard_votes.update(votes=F('votes') + 1)
+        return True
+
+    def missing_voters(self):
+        """
+        Eligible users who are not registered as voters yet (anti-join)
+        """
+        return self.eligible_voters().exclude(voter__poll=self)
+
+    def register_voter(self, user, has_voted=False):
+        """
+        Register user as voter if eligible - done when the user first opens
+        or votes on the poll. Returns the new voter, None if user is not
+        eligible or registered already
+        """
+        user_id = getattr(user, 'pk', user)
+        if not self.eligible_voters().filter(pk=user_id).exists():
+            return None
+        try:
+            with transaction.atomic():
+                return Voter.objects.create(poll=self, user_id=user_id, has_voted=has_voted)
+        except IntegrityError:
+            return None
 
-    def register_voters(self):
-        """
-        Register voters for this poll
-        """
-        # voter count should be equal to total user count
-        eligible_voters = self.eligible_voters()
-        if len(eligible_voters) != self.voter_set.count:
-            usernames = set([u.username for u in eligible_voters])
-            voters = set([v.user.username for v in self.voter_set.all()])
-            not_added = usernames - voters
-            # add the difference of users to the voter list
-            if not_added:
-                not_added = list(not_added)
-                not_added.sort()
-                for username in not_added:
-                    user = User.objects.get(username=username)
-                    voter = Voter(poll=self, user=user, has_voted=False)
-                    voter.save()
-                    yield voter
+    def _missing_voter_batches(self, batch_size):
+        """
+        Yield lists of unsaved Voter objects for the missing voters - keyset
+        paginated on user pk so each batch is a single indexed query
+        """
+        missing = self.missing_voters().order_by('pk').only('pk', 'username')
+        last_pk = 0
+        while True:
+            users = list(missing.filter(pk__gt=last_pk)[:batch_size])
+            if not users:
+                return
+            last_pk = users[-1].pk
+            yield [Voter(poll=self, user=user, has_voted=False) for user in users]
+
+    def register_voters(self, batch_size=REGISTER_BATCH_SIZE):
+        """
+        Register every eligible user ahead of their first visit - streams
+        the created voters, one transaction per batch of batch_size voters.
+        Changes no counter, the eligible count comes from the segment
+        """
+        for voters in self._missing_voter_batches(batch_size):
+            Voter.objects.bulk_create(voters)
+            for voter in voters:
+                yield voter
+
+    def register_all_voters(self, batch_size=REGISTER_BATCH_SIZE):
+        """
+        Register every eligible user ahead of their first visit in a single
+        transaction. Returns number of voters registered
+        """
+        n_registered = 0
+        with transaction.atomic():
+            for voters in self._missing_voter_batches(batch_size):
+                Voter.objects.bulk_create(voters)
+                n_registered += len(voters)
+        return n_registered
 
     def save(self, *args, **kwargs):
         """
-        Save the Poll model - register users to Voter list upon form save
+        Save the Poll model - the eligible voters of an open poll are
+        counted, they are registered when they first open or vote on it.
+        A new segment takes the votes of the users outside it out of
+        n_voted
         """
-        super(Poll, self).save(*args, **kwargs)
-        if len(self.voter_set.all()) == 0:
-            list(self.register_voters())
-        
+        if self._state.adding or kwargs.get('force_insert'):
+            if self.is_open:
+                self.n_eligible_voters = self.eligible_voters().count()
+            super(Poll, self).save(*args, **kwargs)
+        else:
+            stored_segment = Poll.objects.filter(pk=self.pk)\
+                                         .values_list('segment', 'segment_group').first()
+            # edited - see version. The version and the counters of this
+            # instance may be behind, votes update them in the database, so
+            # they are not written from it but updated there and read back
+            update_fields = kwargs.get('update_fields')
+            if update_fields is None:
+                update_fields = [f.name for f in self._meta.concrete_fields
+                                 if not f.primary_key]
+            kwargs['update_fields'] = [name for name in update_fields
+                                       if name not in ('version', 'modified') +
+                                       self.COUNTER_FIELDS]
+            super(Poll, self).save(*args, **kwargs)
+            Poll.objects.filter(pk=self.pk).update(**changed())
+            if self.is_open:
+                Poll.objects.filter(pk=self.pk).refresh_eligible_counts(
+                    recount_voted=stored_segment != (self.segment, self.segment_group_id))
+            self.refresh_from_db(fields=('is_open', 'version', 'modified') +
+                                 self.COUNTER_FIELDS)
+
 class Choice(models.Model):
     """ Choice model """
     poll = models.ForeignKey(Poll)
@@ -134,17 +677,84 @@ class Choice(models.Model):
         """ represent object """
         return self.choice_text
 
+class ChoiceShard(models.Model):
+    """
+    Slice of the vote count of a choice in a sharded poll - the votes of a
+    choice are Choice.votes plus the votes of its shards
+    """
+    class Meta:
+        unique_together = ['choice', 'shard']
+
+    choice = models.ForeignKey(Choice)
+    shard = models.PositiveIntegerField()
+    votes = models.IntegerField(default=0)
+
 class Voter(models.Model):
     """
     Model to check which users have voted
     """
     class Meta:
+        # the unique index serves the lookups by (poll, user), the others
+        # the pending voters of a poll and the polls pending for a user.
+        # Together they serve the lookups by poll or user alone too, so
+        # neither foreign key needs an index of its own
         unique_together = ['poll', 'user']
+        index_together = [('poll', 'has_voted'), ('user', 'has_voted')]
 
-    poll = models.ForeignKey(Poll)
-    user = models.ForeignKey(User)
+    poll = models.ForeignKey(Poll, db_index=False)
+    user = models.ForeignKey(User, db_index=False)
     has_voted = models.BooleanField(default=False)
 
     def __unicode__(self):
         """ represent object """
         return self.user.username
+
+class PollTombstone(models.Model):
+    """
+    Deleted poll - a deletion leaves no modified date behind, so the latest
+    tombstone is part of the index version (see polls.views.get_index_version)
+    """
+    poll_id = models.IntegerField()
+    deleted = models.DateTimeField(default=timezone.now)
+
+    def __unicode__(self):
+        """ represent object """
+        return 'poll %d' % self.poll_id
+
+class Job(models.Model):
+    """
+    Background work queued by polls.jobs - the table is the durable queue
+    and the rows are kept afterwards as the status of the jobs
+    """
+    QUEUED = 'queued'
+    RUNNING = 'running'
+    DONE = 'done'
+    FAILED = 'failed'
+    STATUSES = (
+        (QUEUED, 'Queued'),
+        (RUNNING, 'Running'),
+        (DONE, 'Done'),
+        (FAILED, 'Failed'),
+    )
+
+    class Meta:
+        # serves the queued jobs of a key (see polls.jobs.JobQueue.enqueue)
+        # and the jobs of a status
+        index_together = [('status', 'key')]
+
+    # task registered in polls.jobs and its keyword arguments as JSON
+    name = models.CharField(max_length=100)
+    args = models.TextField(default='{}')
+    # name and a digest of args - jobs with the same key do the same work
+    key = models.CharField(max_length=150)
+    status = models.CharField(max_length=10, choices=STATUSES, default=QUEUED)
+    attempts = models.PositiveIntegerField(default=0)
+    # traceback of the last failed attempt
+    error = models.TextField(blank=True)
+    created = models.DateTimeField(default=timezone.now)
+    started = models.DateTimeField(null=True, blank=True)
+    finished = models.DateTimeField(null=True, blank=True)
+
+    def __unicode__(self):
+        """ represent object """
+        return '%s %s' % (self.name, self.args)
@@ -0,0 +1,71 @@
+"""
+Signal receivers of the poll app - keep the denormalized counters, the
+versions and the cached views of the polls in step with changes made
+outside of them. Connected by PollsConfig.ready
+"""
+from django.contrib.auth.models import User, Group
+from django.db.models.signals import post_save, post_delete, m2m_changed
+from django.dispatch import receiver
+
+from polls.models import Poll, PollTombstone, Choice, changed, recount_open_polls, \
+    SEGMENT_ALL, SEGMENT_GROUP
+from test_apps.utils import invalidate_app_preview_ctx
+
+@receiver(post_save, sender=Poll)
+@receiver(post_delete, sender=Poll)
+@receiver(post_save, sender=Choice)
+@receiver(post_delete, sender=Choice)
+def invalidate_preview_context(sender, **kwargs):
+    """
+    Drop the cached preview context when a poll or choice changes
+    """
+    invalidate_app_preview_ctx('polls')
+
+@receiver(post_delete, sender=Poll)
+def bump_index_deletions(sender, instance, **kwargs):
+    """
+    Leave a tombstone of the deleted poll - the latest one is part of the
+    index version of every process
+    """
+    PollTombstone.objects.create(poll_id=instance.pk)
+
+@receiver(post_save, sender=Choice)
+@receiver(post_delete, sender=Choice)
+def bump_poll_version(sender, instance, **kwargs):
+    """
+    Choices edited outside of voting (e.g. in the admin) change the results
+    """
+    Poll.objects.filter(pk=instance.poll_id).update(**changed())
+
+@receiver(post_save, sender=User)
+def count_new_user(sender, instance, created, **kwargs):
+    """
+    A new user is eligible for the open polls of all users
+    """
+    if created:
+        Poll.objects.filter(is_open=True, segment=SEGMENT_ALL).refresh_eligible_counts()
+
+@receiver(post_delete, sender=User)
+@receiver(post_delete, sender=Group)
+def count_deleted_user(sender, **kwargs):
+    """
+    A deleted user left the segments of the open polls, with their votes -
+    and the polls of a deleted group have no segment left. Bulk deletes
+    batch these, see batched_recounts
+    """
+    recount_open_polls()
+
+@receiver(m2m_changed, sender=User.groups.through)
+def count_group_members(sender, instance, action, reverse, pk_set, **kwargs):
+    """
+    Users joining or leaving groups change the group segments - the ones
+    leaving take their votes along
+    """
+    if action not in ('post_add', 'post_remove', 'post_clear'):
+        return
+    polls = Poll.objects.filter(is_open=True, segment=SEGMENT_GROUP)
+    if reverse:
+        polls = polls.filter(segment_group=instance)
+    elif pk_set:
+        polls = polls.filter(segment_group__in=pk_set)
+    polls.refresh_eligible_counts(recount_voted=action != 'post_add')
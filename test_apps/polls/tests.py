@@ -2,14 +2,31 @@
 Test class for polls
 """
 import datetime
+import os
+import re
+import shutil
+import tempfile
+import threading
+import time
 
-from django.test import TestCase
+from django.test import TestCase, TransactionTestCase
+from django.db import connection
+from django.db.models import Sum
+from django.test.utils import CaptureQueriesContext, override_settings
+from django.core.cache import cache
 from django.utils import timezone
-from polls.models import Poll, Choice
+from polls.models import Poll, PollStats, Choice, ChoiceShard, Voter, Job
 from django.core.urlresolvers import reverse
-from django.contrib.auth.models import User
+from django.contrib.auth.models import User, Group
+from django.core.management import call_command
+from django.utils.six import StringIO
 
 import test_apps.utils as utils
+from polls.views import results_cache_key
+from polls.events import VoteEventBus, vote_events, MAX_EVENTS
+from polls.vote_buffer import VoteBuffer, set_vote_buffer
+from polls.jobs import JobQueue, TASKS, job_status
+import polls.views
 from django.test.utils import setup_test_environment
 from django.test import Client
 import unittest
@@ -111,19 +128,23 @@ class PollMethodTests(utils.TestCaseWithUtils):
 
     def test_count_votes(self):
         """
-        Test vote counting
+        Test vote counting - users created after the poll vote too
         """
         for user in utils.create_users(count=3):
-            for voter in self.poll.register_voters():
-                self.client.login(username=voter.user.username, password=voter.user.username)
-                self.post('vote', self.poll.id, choice=1)
-                self.client.logout()
+            self.client.login(username=user.username, password=user.username)
+            self.post('vote', self.poll.id, choice=1)
+            self.client.logout()
         self.assertEqual(self.poll.total_votes(), 3)
 
 class PollIndexViewTests(utils.LoginMixin, utils.TestCaseWithUtils):
 
     """ Test the polls index view """
 
+    def get_index_data(self):
+        response = self.client.get(reverse('polls:index_data'))
+        self.assertEqual(response.status_code, 200)
+        return response.json()
+
     def test_index_view_with_no_polls(self):
         """
         Test index view without any polls created
@@ -131,7 +152,14 @@ class PollIndexViewTests(utils.LoginMixin, utils.TestCaseWithUtils):
         response = self.client.get(reverse('polls:index'))
         self.assertEqual(response.status_code, 200)
         self.assertContains(response, 'No polls.')
-        self.assertQuerysetEqual(response.context['polls']['all'], [])
+        self.assertEqual(self.get_index_data(), {
+            'tab': 'all',
+            'next': None,
+            'counts': {'all': 0, 'open': 0, 'closed': 0, 'user_open': 0},
+            'users': [],
+            'polls': {'id': [], 'question': [], 'is_open': [], 'voted': [],
+                      'pending': [], 'winner': [], 'winner_votes': []},
+        })
 
     def test_index_view_with_past_poll(self):
         """
@@ -139,9 +167,7 @@ class PollIndexViewTests(utils.LoginMixin, utils.TestCaseWithUtils):
         """
         question = 'test question'
         utils.create_poll(question=question, days=-30)
-        response = self.client.get(reverse('polls:index'))
-        self.assertEqual(response.status_code, 200)
-        self.assertEqual(str(response.context['polls']['all'][0]['ref']), question)
+        self.assertEqual(self.get_index_data()['polls']['question'], [question])
 
     def test_index_view_with_future_poll(self):
         """
@@ -149,10 +175,7 @@ class PollIndexViewTests(utils.LoginMixin, utils.TestCaseWithUtils):
         """
         question = 'test question'
         utils.create_poll(question=question, days=30)
-        response = self.client.get(reverse('polls:index'))
-        self.assertEqual(response.status_code, 200)
-        self.assertContains(response, 'No polls.')
-        self.assertQuerysetEqual(response.context['polls']['all'], [])
+        self.assertEqual(self.get_index_data()['polls']['question'], [])
 
     def test_index_view_with_future_and_past_poll(self):
         """
@@ -162,10 +185,7 @@ class PollIndexViewTests(utils.LoginMixin, utils.TestCaseWithUtils):
         utils.create_poll(question=question1, days=-30)
         question2 = 'test question2'
         utils.create_poll(question=question2, days=30)
-
-        response = self.client.get(reverse('polls:index'))
-        self.assertEqual(response.status_code, 200)
-        self.assertEqual(str(response.context['polls']['all'][0]['ref']), question1)
+        self.assertEqual(self.get_index_data()['polls']['question'], [question1])
 
     def test_index_view_with_two_past_polls(self):
         """
@@ -175,11 +195,217 @@ class PollIndexViewTests(utils.LoginMixin, utils.TestCaseWithUtils):
         utils.create_poll(question=question1, days=-30)
         question2 = 'test question2'
         utils.create_poll(question=question2, days=-40)
+        self.assertEqual(self.get_index_data()['polls']['question'], [question1, question2])
 
+    def test_index_shell(self):
+        """
+        Test that the index page holds no poll data and may be cached by
+        the browser
+        """
+        utils.create_poll(question='test question', days=-30)
         response = self.client.get(reverse('polls:index'))
         self.assertEqual(response.status_code, 200)
-        self.assertEqual(str(response.context['polls']['all'][0]['ref']), question1) 
-        self.assertEqual(str(response.context['polls']['all'][1]['ref']), question2)
+        self.assertNotContains(response, 'test question')
+        self.assertContains(response, reverse('polls:index_data'))
+        self.assertIn('private', response['Cache-Control'])
+        self.assertIn('max-age=%d' % polls.views.INDEX_SHELL_MAX_AGE, response['Cache-Control'])
+
+    def test_index_data_columns(self):
+        """
+        Test the voters of open polls and the winners of closed polls
+        """
+        open_poll = utils.create_default_poll()
+        closed_poll = utils.create_poll(question='closed question', days=-1)
+        choices = utils.add_default_choices(closed_poll)
+        list(closed_poll.vote_randomly(weights={choices[1].pk: 1}))
+        # registered by voting
+        self.assertTrue(open_poll.vote(self.user, open_poll.choice_set.all()[0]))
+
+        data = self.get_index_data()
+        users, polls = data['users'], data['polls']
+        # newest first
+        self.assertEqual(polls['id'], [closed_poll.pk, open_poll.pk])
+        self.assertEqual(polls['is_open'], [False, True])
+        # every eligible username once
+        self.assertEqual(sorted(users), sorted(u.username for u in open_poll.eligible_voters()))
+        self.assertEqual([users[i] for i in polls['voted'][1]], [self.user.username])
+        self.assertEqual(len(polls['pending'][1]), len(users) - 1)
+        self.assertEqual(polls['voted'][0], None)
+        self.assertEqual(polls['winner'], [choices[1].choice_text, None])
+        self.assertEqual(polls['winner_votes'], [closed_poll.total_votes(), None])
+        self.assertIn('no-cache', self.client.get(reverse('polls:index_data'))['Cache-Control'])
+
+
+class PollIndexQueryBudgetTests(utils.LoginMixin, utils.TestCaseWithUtils):
+
+    """ Index data query count must not grow with polls and voters """
+
+    # session, user, latest change, latest publication, latest deletion,
+    # tab counts aggregate, user_open count, polls, open poll voters, the
+    # users of their segment, closed poll choices and the session save
+    # (savepoint, update, release)
+    query_budget = 14
+    # the counts are cached until a poll changes
+    cached_counts_queries = 2
+
+    def setUp(self):
+        utils.LoginMixin.setUp(self)
+        cache.clear()
+
+    def create_polls(self, n_polls, n_users):
+        list(utils.create_users(prefix='budgetuser', count=n_users))
+        for i in range(n_polls):
+            poll = utils.create_poll(question='question %d' % i, days=-1)
+            utils.add_default_choices(poll)
+            if i % 2:
+                list(poll.vote_randomly())
+
+    def assert_index_budget(self, n_polls, n_users, n_queries=query_budget):
+        self.create_polls(n_polls, n_users)
+        with self.assertNumQueries(n_queries):
+            response = self.client.get(reverse('polls:index_data'))
+        self.assertEqual(response.status_code, 200)
+        data = response.json()
+        self.assertEqual(len(data['polls']['id']), n_polls)
+        return data
+
+    def test_index_budget_small(self):
+        """
+        One open poll, one voter - no closed poll choices to look up
+        """
+        self.assert_index_budget(1, 0, self.query_budget - 1)
+
+    def test_index_budget_medium(self):
+        """
+        Open and closed polls with a few voters
+        """
+        data = self.assert_index_budget(4, 3)
+        polls = data['polls']
+        self.assertEqual(polls['is_open'].count(False), 2)
+        closed = polls['is_open'].index(False)
+        closed_poll = Poll.objects.get(pk=polls['id'][closed])
+        self.assertEqual(polls['winner'][closed], closed_poll.get_winner().choice_text)
+
+    def test_index_budget_large(self):
+        """
+        Many open and closed polls with many voters
+        """
+        data = self.assert_index_budget(12, 10)
+        users, polls = data['users'], data['polls']
+        self.assertEqual(len(users), 11)
+        self.assertEqual(len(polls['pending'][polls['is_open'].index(True)]), 11)
+        user_index = users.index(self.user.username)
+        self.assertEqual(sum(1 for pending in polls['pending']
+                             if pending is not None and user_index in pending), 6)
+        self.assertEqual(data['counts'], {'all': 12, 'open': 6, 'closed': 6, 'user_open': 6})
+
+    def test_index_budget_cached_counts(self):
+        """
+        Until a poll changes the tabs are not counted again
+        """
+        data = self.assert_index_budget(4, 3)
+        with self.assertNumQueries(self.query_budget - self.cached_counts_queries):
+            response = self.client.get(reverse('polls:index_data'), {'limit': 10})
+        self.assertEqual(response.json()['counts'], data['counts'])
+
+    def test_index_budget_deep_page(self):
+        """
+        A page far down a tab costs as much as the first one
+        """
+        self.create_polls(12, 3)
+        first = self.client.get(reverse('polls:index_data'), {'tab': 'open', 'limit': 2}).json()
+        second = self.client.get(reverse('polls:index_data'),
+                                 {'tab': 'open', 'limit': 2, 'after': first['next']}).json()
+        # open polls only - no closed poll choices to look up
+        with self.assertNumQueries(self.query_budget - self.cached_counts_queries - 1):
+            response = self.client.get(reverse('polls:index_data'),
+                                       {'tab': 'open', 'limit': 2, 'after': second['next']})
+        last = response.json()
+        self.assertEqual(len(last['polls']['id']), 2)
+        self.assertEqual(last['next'], None)
+
+    def test_index_shell_budget(self):
+        """
+        The index page itself does not look at the polls
+        """
+        self.create_polls(4, 3)
+        # session, user and the session save
+        with self.assertNumQueries(5):
+            self.client.get(reverse('polls:index'))
+
+
+class PollIndexPaginationTests(utils.LoginMixin, utils.TestCaseWithUtils):
+
+    """ Test the keyset pagination of the index tabs """
+
+    n_test_users = 2
+
+    def setUp(self):
+        utils.LoginMixin.setUp(self)
+        # polls created together share their pub_date
+        self.polls = (utils.factory.create_polls(['old %d' % i for i in range(3)], days=-3) +
+                      utils.factory.create_polls(['new %d' % i for i in range(4)], days=-1))
+        for poll in self.polls[:2] + self.polls[4:5]:
+            poll.cast_random_votes()
+        # the user voted but the poll stays open
+        self.polls[5].vote(self.user, self.polls[5].choice_set.all()[0])
+
+    def get_tab(self, tab, limit):
+        """
+        Ids of all the polls of tab, paging through limit at a time
+        """
+        ids, after = [], None
+        while True:
+            params = {'tab': tab, 'limit': limit}
+            if after is not None:
+                params['after'] = after
+            data = self.client.get(reverse('polls:index_data'), params).json()
+            self.assertTrue(len(data['polls']['id']) <= limit)
+            ids.extend(data['polls']['id'])
+            after = data['next']
+            if after is None:
+                return ids, data['counts']
+
+    def expected(self, polls):
+        return [p.pk for p in sorted(polls, key=lambda p: (p.pub_date, p.pk), reverse=True)]
+
+    def test_pages(self):
+        """
+        Paging through a tab gives every poll once, newest first
+        """
+        for limit in (1, 2, 3, 7, 50):
+            ids, counts = self.get_tab('all', limit)
+            self.assertEqual(ids, self.expected(self.polls))
+        self.assertEqual(counts, {'all': 7, 'open': 4, 'closed': 3, 'user_open': 3})
+
+    def test_tabs(self):
+        """
+        Every tab has its polls only
+        """
+        closed = [self.polls[i] for i in (0, 1, 4)]
+        open_polls = [p for p in self.polls if p not in closed]
+        self.assertEqual(self.get_tab('open', 2)[0], self.expected(open_polls))
+        self.assertEqual(self.get_tab('closed', 2)[0], self.expected(closed))
+        self.assertEqual(self.get_tab('user_open', 2)[0],
+                         self.expected(p for p in open_polls if p != self.polls[5]))
+
+    def test_cursor(self):
+        """
+        Cursors come back as the (pub_date, pk) they were made of
+        """
+        poll = Poll.objects.get(pk=self.polls[3].pk)
+        self.assertEqual(polls.views.decode_cursor(polls.views.encode_cursor(poll)),
+                         (poll.pub_date, poll.pk))
+
+    def test_bad_parameters(self):
+        """
+        Unknown tabs and broken cursors are rejected
+        """
+        url = reverse('polls:index_data')
+        self.assertEqual(self.client.get(url, {'tab': 'nope'}).status_code, 400)
+        self.assertEqual(self.client.get(url, {'after': 'x.1'}).status_code, 400)
+        self.assertEqual(self.client.get(url, {'after': '9' * 23 + '.1'}).status_code, 400)
+        self.assertEqual(self.client.get(url, {'limit': 'ten'}).status_code, 400)
 
 
 class PollDetailViewTests(utils.LoginMixin, utils.TestCaseWithUtils):
@@ -202,6 +428,78 @@ class PollDetailViewTests(utils.LoginMixin, utils.TestCaseWithUtils):
         response = self.client.get(reverse('polls:detail', args=(past_poll.id,)))
         self.assertEqual(response.status_code, 200)
 
+class PollAccessDecoratorTests(utils.LoginMixin, utils.TestCaseWithUtils):
+
+    """ Test the shared poll/voter resolution of the access decorators """
+
+    def poll_queries(self, url):
+        """
+        Return the queries on the poll/voter tables run while fetching url
+        """
+        with CaptureQueriesContext(connection) as ctx:
+            response = self.client.get(url)
+        return response, [q['sql'] for q in ctx.captured_queries
+                          if 'FROM "polls_voter"' in q['sql'] or
+                             'FROM "polls_poll"' in q['sql']]
+
+    def test_detail_resolves_poll_and_voter_once(self):
+        """
+        Both stacked decorators share a single joined poll + voter query
+        """
+        poll = self.create_test_poll()
+        url = reverse('polls:detail', args=(poll.id,))
+        # the first visit registers the user - no voter yet, so the poll is
+        # fetched on its own before the eligibility check and the insert
+        response, queries = self.poll_queries(url)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(queries), 2)
+        self.assertTrue(poll.voter_set.filter(user=self.user, has_voted=False).exists())
+
+        response, queries = self.poll_queries(url)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(queries), 1)
+        self.assertIn('INNER JOIN "polls_poll"', queries[0])
+
+    def test_results_resolves_poll_and_voter_once(self):
+        """
+        The results page does not fetch the poll again either
+        """
+        poll = self.create_test_poll()
+        poll.cast_random_votes()
+        response, queries = self.poll_queries(reverse('polls:results', args=(poll.id,)))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len([q for q in queries if 'FROM "polls_voter"' in q]), 1)
+
+    def test_only_open_poll_pages_register(self):
+        """
+        The pages of a closed poll and the pages of voters do not register
+        anybody
+        """
+        poll = self.create_test_poll()
+        poll.cast_random_votes()
+        Voter.objects.filter(poll=poll, user=self.user).delete()
+        for name in ('detail', 'results', 'vote_given'):
+            self.client.get(reverse('polls:' + name, args=(poll.id,)))
+        self.assertFalse(poll.voter_set.filter(user=self.user).exists())
+        poll.reopen()
+        self.client.get(reverse('polls:results', args=(poll.id,)))
+        self.assertFalse(poll.voter_set.filter(user=self.user).exists())
+        self.client.get(reverse('polls:detail', args=(poll.id,)))
+        self.assertTrue(poll.voter_set.filter(user=self.user).exists())
+
+    def test_unregistered_user_redirected(self):
+        """
+        A user outside the segment of the poll is sent back to the index
+        """
+        poll = self.create_test_poll()
+        poll.segment, poll.segment_group = 'group', Group.objects.create(name='members')
+        poll.save()
+        response = self.client.get(reverse('polls:detail', args=(poll.id,)))
+        self.assertEqual(response.status_code, 302)
+        self.assertTrue(reverse('polls:index') in response['Location'])
+        self.assertFalse(poll.voter_set.exists())
+
+
 class PollVoteViewTests(utils.TestCaseWithUtils):
     """ Test the polls voting view """ 
 
@@ -285,6 +583,1292 @@ class PollResultsViewTests(utils.LoginMixin, utils.TestCaseWithUtils):
         response = self.client.get(reverse('polls:results', args=(poll.id,)))
         self.assertEqual(response.status_code, 200)
 
+class PollCounterTests(utils.TestCaseWithUtils):
+
+    """ Test the denormalized voter/vote counters of Poll """
+
+    n_test_users = 3
+
+    def setUp(self):
+        self.poll = self.create_test_poll()
+        self.choice = self.poll.choice_set.all()[0]
+
+    def reload(self):
+        return Poll.objects.get(pk=self.poll.pk)
+
+    def test_counters_after_register(self):
+        """
+        Registering voters counts them as eligible
+        """
+        self.assertEqual(self.reload().n_eligible_voters, 3)
+        self.assertEqual(self.reload().n_voted, 0)
+
+    def test_counters_after_vote(self):
+        """
+        Voting counts the voter and the vote
+        """
+        self.poll.vote(self.users[0], self.choice)
+        poll = self.reload()
+        self.assertEqual((poll.n_voted, poll.n_votes), (1, 1))
+        self.assertEqual(poll.update_open_status(), True)
+
+    def test_close_on_last_vote(self):
+        """
+        Poll closes once voted count reaches eligible count
+        """
+        for user in self.users:
+            self.poll.vote(user, self.choice)
+        self.assertEqual(self.poll.update_open_status(), False)
+        self.assertEqual(self.reload().is_open, False)
+
+    def test_counters_after_reopen(self):
+        """
+        Reopening resets the voted and vote counters
+        """
+        list(self.poll.vote_randomly())
+        self.poll.reopen()
+        poll = self.reload()
+        self.assertEqual((poll.n_eligible_voters, poll.n_voted, poll.n_votes), (3, 0, 0))
+
+    def test_reconcile_counters(self):
+        """
+        Drifted counters are reported and fixed by reconcile_poll_counters
+        """
+        self.poll.vote(self.users[0], self.choice)
+        Poll.objects.filter(pk=self.poll.pk).update(n_eligible_voters=10, n_votes=0)
+
+        out = StringIO()
+        call_command('reconcile_poll_counters', '--dry-run', stdout=out)
+        self.assertIn('2 counter(s) found', out.getvalue())
+        self.assertEqual(self.reload().n_eligible_voters, 10)
+
+        out = StringIO()
+        call_command('reconcile_poll_counters', stdout=out)
+        self.assertIn('n_eligible_voters 10 -> 3', out.getvalue())
+        poll = self.reload()
+        self.assertEqual((poll.n_eligible_voters, poll.n_voted, poll.n_votes), (3, 1, 1))
+        self.assertEqual(Poll.objects.reconcile_counters(), [])
+
+
+class PollRegisterVotersTests(utils.TestCaseWithUtils):
+
+    """ Test set based voter registration """
+
+    def setUp(self):
+        self.poll = self.create_test_poll()
+        self.users = list(utils.create_users(count=5))
+
+    def test_register_voters_streams_missing_voters(self):
+        """
+        Only users missing from the voter list are registered, in batches
+        """
+        Voter.objects.create(poll=self.poll, user=self.users[0])
+        voters = list(self.poll.register_voters(batch_size=2))
+        self.assertEqual(sorted(v.user.username for v in voters),
+                         [u.username for u in self.users[1:]])
+        self.assertEqual(self.poll.voter_set.count(), 5)
+        self.assertEqual(list(self.poll.register_voters()), [])
+
+    def test_register_all_voters(self):
+        """
+        All missing voters are registered with a constant number of queries per batch
+        """
+        with self.assertNumQueries(7):
+            # savepoint/release + 2 batches of (select, insert) + the final
+            # empty select
+            self.assertEqual(self.poll.register_all_voters(batch_size=3), 5)
+        self.assertEqual(self.poll.register_all_voters(), 0)
+
+    def test_save_counts_eligible_voters(self):
+        """
+        Saving a new poll counts the eligible users without registering them
+        """
+        with self.assertNumQueries(2):
+            poll = Poll.objects.create(question='another question', pub_date=timezone.now())
+        self.assertEqual(poll.voter_set.count(), 0)
+        self.assertEqual(poll.n_eligible_voters, User.objects.count())
+
+
+class PollSegmentTests(utils.TestCaseWithUtils):
+
+    """ Test eligibility segments and the lazy voter registration """
+
+    n_test_users = 4
+
+    def setUp(self):
+        self.group = Group.objects.create(name='members')
+        self.group.user_set.add(*self.users[:2])
+        self.poll = utils.create_poll(question='members question', days=-1)
+        self.choices = utils.add_default_choices(self.poll)
+        self.poll.segment, self.poll.segment_group = 'group', self.group
+        self.poll.save()
+
+    def reload(self):
+        return Poll.objects.get(pk=self.poll.pk)
+
+    def test_eligible_count_follows_members(self):
+        """
+        Joining and leaving the group, from either side, updates the count
+        """
+        self.assertEqual(self.reload().n_eligible_voters, 2)
+        self.users[2].groups.add(self.group)
+        self.assertEqual(self.reload().n_eligible_voters, 3)
+        self.group.user_set.remove(self.users[0])
+        self.assertEqual(self.reload().n_eligible_voters, 2)
+        self.users[1].groups.clear()
+        self.assertEqual(self.reload().n_eligible_voters, 1)
+        self.group.delete()
+        poll = self.reload()
+        self.assertEqual((poll.segment_group, poll.n_eligible_voters), (None, 0))
+
+    def test_new_users_counted(self):
+        """
+        New users join the polls of all users, open ones only
+        """
+        everyone = utils.create_poll(question='everyone question', days=-1)
+        closed = utils.create_poll(question='closed question', days=-1)
+        Poll.objects.filter(pk=closed.pk).update(is_open=False)
+        User.objects.create_user('newuser', password='newuser')
+        self.assertEqual(Poll.objects.get(pk=everyone.pk).n_eligible_voters, 5)
+        self.assertEqual(Poll.objects.get(pk=closed.pk).n_eligible_voters, 4)
+        self.assertEqual(self.reload().n_eligible_voters, 2)
+        self.assertEqual(Poll.objects.reconcile_counters(), [])
+
+    def test_vote_registers_voter(self):
+        """
+        Members are registered by their first vote, others cannot vote
+        """
+        self.assertFalse(self.poll.vote(self.users[3], self.choices[0]))
+        self.assertTrue(self.poll.vote(self.users[0], self.choices[0]))
+        self.assertFalse(self.poll.vote(self.users[0], self.choices[0]))
+        self.assertEqual(list(self.poll.voter_set.values_list('user', 'has_voted')),
+                         [(self.users[0].pk, True)])
+        self.assertEqual(list(self.poll.pending_voters()), [self.users[1]])
+
+    def test_closed_by_eligible_count(self):
+        """
+        The poll closes once every member voted, registered or not
+        """
+        self.poll.register_voter(self.users[0])
+        self.assertEqual(len(self.poll.cast_random_votes()), 2)
+        poll = self.reload()
+        self.assertEqual((poll.is_open, poll.n_voted, poll.voter_set.count()), (False, 2, 2))
+
+    def test_votes_of_leaving_members_not_counted(self):
+        """
+        Members leaving the group take their votes out of the count - the
+        poll only closes once every current member voted
+        """
+        self.users[2].groups.add(self.group)
+        self.assertTrue(self.poll.vote(self.users[0], self.choices[0]))
+        self.group.user_set.remove(self.users[0])
+        poll = self.reload()
+        self.assertEqual((poll.n_eligible_voters, poll.n_voted), (2, 0))
+        self.assertTrue(poll.vote(self.users[1], self.choices[0]))
+        self.assertTrue(poll.update_open_status())
+        # a former member cannot vote again - nor vote at all
+        self.assertFalse(poll.vote(self.users[0], self.choices[0]))
+        self.assertTrue(poll.vote(self.users[2], self.choices[1]))
+        self.assertFalse(poll.update_open_status())
+        poll = self.reload()
+        self.assertEqual((poll.is_open, poll.n_voted), (False, 2))
+        self.assertEqual(Poll.objects.reconcile_counters(), [])
+
+    def test_segment_edit_recounts_voted(self):
+        """
+        Moving a poll to a group leaves the votes of non-members out of
+        n_voted - the poll only closes once the members voted
+        """
+        everyone = utils.create_poll(question='everyone question', days=-1)
+        choice = utils.add_default_choices(everyone)[0]
+        for user in self.users[2:]:
+            everyone.vote(user, choice)
+        everyone.segment, everyone.segment_group = 'group', self.group
+        everyone.save()
+        self.assertEqual((everyone.n_eligible_voters, everyone.n_voted), (2, 0))
+        self.assertTrue(everyone.update_open_status())
+        for user in self.users[:2]:
+            everyone.vote(user, choice)
+        self.assertFalse(everyone.update_open_status())
+        self.assertEqual(Poll.objects.reconcile_counters(), [])
+
+    def test_last_pending_user_deleted(self):
+        """
+        Deleting the only user who has not voted closes the poll
+        """
+        member = User.objects.create_user('member', password='member')
+        member.groups.add(self.group)
+        self.poll.vote(member, self.choices[0])
+        everyone = utils.create_poll(question='everyone question', days=-1)
+        choice = utils.add_default_choices(everyone)[0]
+        for user in self.users:
+            everyone.vote(user, choice)
+        self.assertTrue(Poll.objects.get(pk=everyone.pk).is_open)
+        member.delete()
+        everyone = Poll.objects.get(pk=everyone.pk)
+        self.assertEqual((everyone.is_open, everyone.n_eligible_voters, everyone.n_voted),
+                         (False, 4, 4))
+        # a member who voted was deleted - the group poll stays open
+        poll = self.reload()
+        self.assertEqual((poll.is_open, poll.n_eligible_voters, poll.n_voted), (True, 2, 0))
+
+    def test_pending_for(self):
+        """
+        The polls pending for a user are the open polls of their segments
+        they have not voted on
+        """
+        everyone = utils.create_poll(question='everyone question', days=-1)
+        pending = lambda user: sorted(Poll.objects.pending_for(user).values_list('pk', flat=True))
+        self.assertEqual(pending(self.users[0]), sorted([self.poll.pk, everyone.pk]))
+        self.assertEqual(pending(self.users[3]), [everyone.pk])
+        self.poll.vote(self.users[0], self.choices[0])
+        self.assertEqual(pending(self.users[0]), [everyone.pk])
+
+
+class PollJobTests(utils.TestCaseWithUtils):
+
+    """ Test the background jobs - run inline by the test runner """
+
+    n_test_users = 3
+
+    def setUp(self):
+        self.poll = utils.create_poll(question='jobs question', days=-1)
+        self.failures = []
+        TASKS['flaky'] = self.flaky
+
+    def tearDown(self):
+        del TASKS['flaky']
+
+    def flaky(self, fail):
+        """
+        Task failing its first fail attempts
+        """
+        if len(self.failures) < fail:
+            self.failures.append(True)
+            raise ValueError('attempt %d failed' % len(self.failures))
+
+    def test_new_user_counted_inline(self):
+        """
+        The eligible counts are not left to a job - the close check
+        compares against them right away
+        """
+        User.objects.create_user('newuser', password='newuser')
+        self.assertEqual(Poll.objects.get(pk=self.poll.pk).n_eligible_voters, 4)
+        self.assertFalse(Job.objects.exists())
+
+    def test_register_voters_job(self):
+        """
+        Registering the voters of a poll is idempotent
+        """
+        job_queue = JobQueue(sync=True)
+        job_queue.enqueue('register_voters', poll_id=self.poll.pk)
+        job_queue.enqueue('register_voters', poll_id=self.poll.pk)
+        self.assertEqual(self.poll.voter_set.count(), 3)
+        self.assertEqual(list(Job.objects.filter(name='register_voters')
+                                         .values_list('status', 'attempts')),
+                         [(Job.DONE, 1), (Job.DONE, 1)])
+        self.assertEqual(job_status()[Job.DONE], 2)
+
+    @override_settings(SQLITE_PROFILE={'ENABLED': True})
+    def test_queued_job_not_queued_twice(self):
+        """
+        Jobs wait for the commit of the test transaction, which never comes -
+        the same task and arguments are queued once meanwhile
+        """
+        job_queue = JobQueue(threads=1)
+        try:
+            job = job_queue.enqueue('register_voters', poll_id=self.poll.pk)
+            self.assertEqual(job_queue.enqueue('register_voters', poll_id=self.poll.pk), job)
+            self.assertNotEqual(job_queue.enqueue('register_voters', poll_id=0), job)
+            self.assertEqual(job.status, Job.QUEUED)
+        finally:
+            job_queue.close()
+
+    def test_failed_attempts_retried(self):
+        """
+        A failing job is attempted max_attempts times before it fails
+        """
+        job_queue = JobQueue(max_attempts=3, retry_delay_ms=0, sync=True)
+        job = job_queue.enqueue('flaky', fail=2)
+        self.assertEqual((job.status, job.attempts, job.error), (Job.DONE, 3, ''))
+        self.failures = []
+        job = job_queue.enqueue('flaky', fail=3)
+        self.assertEqual((job.status, job.attempts), (Job.FAILED, 3))
+        self.assertIn('attempt 3 failed', job.error)
+
+    def test_retry_failed_jobs(self):
+        """
+        Failed jobs queued again run with a fresh number of attempts
+        """
+        job_queue = JobQueue(max_attempts=1, retry_delay_ms=0, sync=True)
+        job = job_queue.enqueue('flaky', fail=2)
+        self.assertEqual(job.status, Job.FAILED)
+        self.assertEqual(job_queue.retry(), 1)
+        self.assertEqual(Job.objects.get(pk=job.pk).status, Job.FAILED)
+        self.assertEqual(job_queue.retry([job.pk]), 1)
+        job = Job.objects.get(pk=job.pk)
+        self.assertEqual((job.status, job.attempts), (Job.DONE, 1))
+        self.assertEqual(job_queue.retry(), 0)
+
+    def test_jobs_command(self):
+        """
+        manage.py jobs reports the jobs
+        """
+        JobQueue(max_attempts=1, sync=True).enqueue('flaky', fail=1)
+        out = StringIO()
+        call_command('jobs', 'status', stdout=out)
+        self.assertIn('failed   1', out.getvalue())
+        out = StringIO()
+        call_command('jobs', 'list', '--status', 'failed', stdout=out)
+        self.assertIn('ValueError: attempt 1 failed', out.getvalue())
+
+
+class PollBulkReopenTests(utils.TestCaseWithUtils):
+
+    """ Test reopening many polls at once """
+
+    n_test_users = 3
+
+    def create_closed_polls(self, count):
+        polls = []
+        for i in range(count):
+            poll = utils.create_poll(question='question %d' % i, days=-1)
+            utils.add_default_choices(poll)
+            list(poll.vote_randomly())
+            polls.append(poll)
+        return polls
+
+    def assert_reopened(self, polls):
+        for poll in Poll.objects.filter(pk__in=[p.pk for p in polls]):
+            self.assertEqual((poll.is_open, poll.n_voted, poll.n_votes), (True, 0, 0))
+            self.assertEqual(poll.total_votes(), 0)
+            self.assertFalse(poll.voter_set.filter(has_voted=True).exists())
+
+    def test_queryset_reopen_constant_queries(self):
+        """
+        Reopening N polls runs the same number of queries for any N
+        """
+        for count in (1, 4):
+            polls = self.create_closed_polls(count)
+            # poll ids + savepoint/release + choices, shards, voters and
+            # polls updates + the segments and a count and update per segment
+            with self.assertNumQueries(10):
+                n_reopened = Poll.objects.filter(pk__in=[p.pk for p in polls]).reopen()
+            self.assertEqual(n_reopened, count)
+            self.assert_reopened(polls)
+            Poll.objects.all().delete()
+
+    def test_reopen_closed_polls(self):
+        """
+        Reopening the closed polls counts the users who joined meanwhile
+        """
+        poll = self.create_closed_polls(1)[0]
+        User.objects.create_user('newuser', password='newuser')
+        self.assertEqual(Poll.objects.filter(is_open=False).reopen(), 1)
+        poll = Poll.objects.get(pk=poll.pk)
+        self.assertEqual((poll.is_open, poll.n_eligible_voters), (True, 4))
+        choice = poll.choice_set.all()[0]
+        for user in User.objects.exclude(username='newuser'):
+            poll.vote(user, choice)
+        self.assertTrue(poll.update_open_status())
+
+    def test_reopen_view(self):
+        """
+        The reopen view reopens all selected polls
+        """
+        polls = self.create_closed_polls(2)
+        self.client.login(username='testuser1', password='testuser1')
+        response = self.client.post(reverse('polls:reopen'),
+                                    {'poll_ids': [p.pk for p in polls]})
+        self.assertEqual(response.status_code, 302)
+        self.assert_reopened(polls)
+
+    def test_admin_reopen_action(self):
+        """
+        The admin bulk action reopens all selected polls
+        """
+        polls = self.create_closed_polls(2)
+        User.objects.create_superuser('admin', 'admin@admin.com', 'admin')
+        self.client.login(username='admin', password='admin')
+        response = self.client.post(reverse('admin:polls_poll_changelist'), {
+            'action': 'reopen_polls',
+            '_selected_action': [p.pk for p in polls],
+        }, follow=True)
+        self.assertContains(response, '2 poll(s) reopened')
+        self.assert_reopened(polls)
+
+
+class PollRandomVoteTests(utils.TestCaseWithUtils):
+
+    """ Test the batch random voting engine """
+
+    n_test_users = 6
+
+    def setUp(self):
+        self.poll = self.create_test_poll()
+        self.choices = list(self.poll.choice_set.order_by('pk'))
+
+    def test_random_votes_close_poll(self):
+        """
+        Every pending voter votes once and the poll gets closed
+        """
+        pairs = list(self.poll.vote_randomly())
+        self.assertEqual(len(pairs), 6)
+        self.assertEqual(self.poll.is_open, False)
+        self.assertEqual(self.poll.total_votes(), 6)
+        poll = Poll.objects.get(pk=self.poll.pk)
+        self.assertEqual((poll.is_open, poll.n_voted, poll.n_votes), (False, 6, 6))
+
+    def test_random_votes_seed(self):
+        """
+        The same seed draws the same assignments
+        """
+        first = [(v.user_id, c.pk) for v, c in self.poll.cast_random_votes(seed=42)]
+        self.poll.reopen()
+        # registered by the first round this time
+        second = [(v.user_id, c.pk) for v, c in self.poll.cast_random_votes(seed=42)]
+        self.assertEqual(first, second)
+
+    def test_random_votes_weights(self):
+        """
+        Choices with zero weight get no votes
+        """
+        self.poll.cast_random_votes(weights={self.choices[1].pk: 1})
+        votes = [c.votes for c in self.poll.choice_set.order_by('pk')]
+        self.assertEqual(votes, [0, 6, 0])
+        self.assertRaises(ValueError, self.poll.cast_random_votes, weights={})
+
+    def test_random_votes_limit(self):
+        """
+        Only the first limit pending voters vote
+        """
+        pairs = self.poll.cast_random_votes(seed=1, limit=4)
+        self.assertEqual(len(pairs), 4)
+        self.assertEqual(self.poll.voter_set.filter(has_voted=True).count(), 4)
+        self.assertEqual(self.poll.total_votes(), 4)
+        self.assertEqual(self.poll.is_open, True)
+        self.assertEqual(len(self.poll.cast_random_votes(seed=1)), 2)
+        self.assertEqual(self.poll.is_open, False)
+
+    def test_random_votes_constant_queries(self):
+        """
+        Query count does not depend on the number of voters
+        """
+        list(utils.create_users(prefix='extrauser', count=10))
+        poll = utils.create_poll(question='another question', days=-1)
+        utils.add_default_choices(poll)
+        # savepoint/release, choices, registered voters, unregistered
+        # eligible users, voter insert, 3 choice updates, counter update,
+        # close
+        with self.assertNumQueries(11):
+            poll.cast_random_votes(seed=1)
+        with self.assertNumQueries(11):
+            self.poll.cast_random_votes(seed=1)
+        # registered voters are updated instead
+        self.poll.reopen()
+        with self.assertNumQueries(11):
+            self.poll.cast_random_votes(seed=1)
+
+
+class PollStatsTests(utils.TestCaseWithUtils):
+
+    """ Test the batched poll statistics """
+
+    n_test_users = 3
+
+    def create_polls(self, count):
+        polls = []
+        n_existing = Poll.objects.count()
+        for i in range(count):
+            poll = utils.create_poll(question='question %d' % (n_existing + i), days=-1)
+            utils.add_default_choices(poll)
+            if i % 2:
+                poll.cast_random_votes(seed=i)
+            polls.append(poll)
+        return polls
+
+    def test_stats_single_query(self):
+        """
+        Statistics of many polls take one query and are reused by the
+        Poll methods
+        """
+        self.create_polls(4)
+        polls = list(Poll.objects.order_by('pk'))
+        with self.assertNumQueries(1):
+            stats = PollStats.for_polls(polls)
+        with self.assertNumQueries(0):
+            for poll in polls:
+                self.assertEqual(poll.total_votes(), stats[poll.pk].total_votes)
+                self.assertEqual(poll.has_voting_started(), poll.total_votes() > 0)
+                self.assertEqual(poll.get_winner() is None, poll.is_open)
+        self.assertEqual([s.total_votes for s in Poll.objects.stats().values()].count(3), 2)
+
+    def test_ranked_choices_and_winner(self):
+        """
+        Choices are ranked by votes, the first one of a closed poll wins
+        """
+        poll = self.create_polls(2)[1]
+        stats = PollStats.for_polls([poll])[poll.pk]
+        votes = [c.votes for c in stats.ranked_choices]
+        self.assertEqual(votes, sorted(votes, reverse=True))
+        self.assertEqual(stats.winner, stats.ranked_choices[0])
+        self.assertEqual(poll.get_winner(), stats.winner)
+
+    def test_stats_cleared_on_vote(self):
+        """
+        Votes cast through the instance are not hidden by kept statistics
+        """
+        poll = self.create_polls(1)[0]
+        PollStats.for_polls([poll])
+        self.assertEqual(poll.total_votes(), 0)
+        poll.vote(self.users[0], poll.choice_set.all()[0])
+        self.assertEqual(poll.total_votes(), 1)
+        self.assertTrue(poll.has_voting_started())
+
+    def test_admin_changelist_constant_queries(self):
+        """
+        The admin poll list computes the statistics of all polls at once
+        """
+        User.objects.create_superuser('admin', 'admin@admin.com', 'admin')
+        self.client.login(username='admin', password='admin')
+        url = reverse('admin:polls_poll_changelist')
+        self.create_polls(2)
+        with CaptureQueriesContext(connection) as few_polls:
+            self.client.get(url)
+        self.create_polls(6)
+        with CaptureQueriesContext(connection) as many_polls:
+            response = self.client.get(url)
+        self.assertContains(response, 'choice1')
+        self.assertEqual(len(few_polls), len(many_polls))
+
+
+class PollVoteShardTests(utils.TestCaseWithUtils):
+
+    """ Test the sharded vote counters """
+
+    n_test_users = 6
+
+    def setUp(self):
+        self.poll = self.create_test_poll()
+        self.poll.set_vote_shards(4)
+        self.choices = list(self.poll.choice_set.order_by('pk'))
+
+    def test_votes_go_to_shards(self):
+        """
+        Votes of a sharded poll land on shard rows, reads add them up
+        """
+        for user in self.users[:4]:
+            self.poll.vote(user, self.choices[1])
+        self.poll.vote(self.users[4], self.choices[0])
+        self.assertEqual(Choice.objects.get(pk=self.choices[1].pk).votes, 0)
+        self.assertEqual(ChoiceShard.objects.filter(choice=self.choices[1])
+                                            .aggregate(Sum('votes'))['votes__sum'], 4)
+        self.assertTrue(ChoiceShard.objects.filter(choice=self.choices[1]).count() <= 4)
+        self.assertEqual(self.poll.total_votes(), 5)
+        stats = PollStats.for_polls([self.poll])[self.poll.pk]
+        self.assertEqual([c.votes for c in stats.ranked_choices], [4, 1, 0])
+        self.assertEqual(Poll.objects.reconcile_counters(), [])
+
+    def test_close_rolls_up_shards(self):
+        """
+        Closing the poll folds the shards into Choice.votes
+        """
+        for user in self.users:
+            self.poll.vote(user, self.choices[2])
+        self.assertEqual(self.poll.update_open_status(), False)
+        self.assertEqual(Choice.objects.get(pk=self.choices[2].pk).votes, 6)
+        self.assertFalse(ChoiceShard.objects.exclude(votes=0).exists())
+        self.assertEqual(self.poll.get_winner(), self.choices[2])
+        self.assertEqual(self.poll.total_votes(), 6)
+
+    def test_switch_off_keeps_votes(self):
+        """
+        Turning sharding off rolls up the pending shard counts
+        """
+        self.poll.vote(self.users[0], self.choices[0])
+        self.poll.set_vote_shards(0)
+        self.assertEqual(Choice.objects.get(pk=self.choices[0].pk).votes, 1)
+        self.poll.vote(self.users[1], self.choices[0])
+        self.assertEqual(Poll.objects.get(pk=self.poll.pk).total_votes(), 2)
+
+    def test_reopen_resets_shards(self):
+        """
+        Reopening zeroes the shard counts too
+        """
+        self.poll.vote(self.users[0], self.choices[0])
+        self.poll.reopen()
+        self.assertEqual(self.poll.total_votes(), 0)
+
+    def test_invalid_choice(self):
+        """
+        A choice of another poll is refused on a sharded poll
+        """
+        other = utils.create_poll(question='other question', days=-1)
+        other_choice = utils.add_default_choices(other)[0]
+        self.assertRaises(Choice.DoesNotExist, self.poll.vote, self.users[0], other_choice)
+        self.assertFalse(ChoiceShard.objects.exists())
+
+
+class PollResultsCacheTests(utils.LoginMixin, utils.TestCaseWithUtils):
+
+    """ Test the versioned results cache """
+
+    def setUp(self):
+        utils.LoginMixin.setUp(self)
+        cache.clear()
+        self.poll = self.create_test_poll()
+        self.url = reverse('polls:results', args=(self.poll.id,))
+
+    def choice_queries(self):
+        with CaptureQueriesContext(connection) as ctx:
+            response = self.client.get(self.url)
+        self.assertEqual(response.status_code, 200)
+        return response, [q for q in ctx.captured_queries
+                          if 'FROM "polls_choice"' in q['sql']]
+
+    def test_results_rendered_once(self):
+        """
+        Repeated hits on a closed poll serve the cached results table
+        """
+        self.poll.cast_random_votes(weights={self.poll.choice_set.all()[0].pk: 1})
+        response, queries = self.choice_queries()
+        self.assertTrue(queries)
+        self.assertContains(response, '<td>1</td>')
+        response, queries = self.choice_queries()
+        self.assertEqual(queries, [])
+        self.assertContains(response, 'Back to results summary')
+
+    def test_reopen_bumps_version(self):
+        """
+        Reopening the poll moves the results to a new cache key
+        """
+        self.poll.cast_random_votes()
+        old_key = results_cache_key(Poll.objects.get(pk=self.poll.pk))
+        self.choice_queries()
+        self.assertTrue(cache.get(old_key))
+
+        self.poll.reopen()
+        new_key = results_cache_key(Poll.objects.get(pk=self.poll.pk))
+        self.assertNotEqual(old_key, new_key)
+        self.poll.cast_random_votes()
+        response, queries = self.choice_queries()
+        self.assertTrue(queries)
+
+    def test_results_with_file_cache(self):
+        """
+        The results cache works with the file based backend
+        """
+        cache_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, cache_dir)
+        self.poll.cast_random_votes()
+        with override_settings(CACHES={'default': {
+                'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+                'LOCATION': cache_dir}}):
+            first, queries = self.choice_queries()
+            self.assertTrue(queries)
+            second, queries = self.choice_queries()
+            self.assertEqual(queries, [])
+        self.assertEqual(first.context['results_table'], second.context['results_table'])
+
+
+class PollConditionalGetTests(utils.LoginMixin, utils.TestCaseWithUtils):
+
+    """ Test the ETag/Last-Modified conditional responses of the poll pages """
+
+    n_test_users = 2
+
+    def setUp(self):
+        utils.LoginMixin.setUp(self)
+        self.poll = self.create_test_poll()
+        self.choice = self.poll.choice_set.all()[0]
+
+    def revalidate(self, url, response, **headers):
+        """
+        GET url again with the validators of response
+        """
+        return self.client.get(url, HTTP_IF_NONE_MATCH=response['ETag'],
+                               HTTP_IF_MODIFIED_SINCE=response['Last-Modified'], **headers)
+
+    def test_version_bumped(self):
+        """
+        Votes, closing, reopening and edits change the poll version
+        """
+        versions = [Poll.objects.get(pk=self.poll.pk).version]
+        def bumped():
+            versions.append(Poll.objects.get(pk=self.poll.pk).version)
+            return versions[-1] > versions[-2]
+        self.poll.vote(self.user, self.choice)
+        self.assertTrue(bumped())
+        self.poll.cast_random_votes()
+        self.assertTrue(bumped())
+        self.assertFalse(Poll.objects.get(pk=self.poll.pk).is_open)
+        self.poll.reopen()
+        self.assertTrue(bumped())
+        self.poll.question = 'edited question'
+        self.poll.save()
+        self.assertTrue(bumped())
+        self.assertEqual(self.poll.version, versions[-1])
+
+    def test_stale_edit_keeps_counters(self):
+        """
+        Saving an instance loaded before a vote keeps the vote counted
+        """
+        stale = Poll.objects.get(pk=self.poll.pk)
+        self.poll.vote(self.user, self.choice)
+        stale.question = 'edited question'
+        stale.save()
+        self.assertEqual((stale.n_voted, stale.n_votes), (1, 1))
+        poll = Poll.objects.get(pk=self.poll.pk)
+        self.assertEqual((poll.question, poll.n_voted, poll.n_votes),
+                         ('edited question', 1, 1))
+        self.assertEqual(Poll.objects.reconcile_counters(), [])
+
+    def test_results_not_modified(self):
+        """
+        A closed poll's results are rendered once per client
+        """
+        self.poll.cast_random_votes()
+        url = reverse('polls:results', args=(self.poll.id,))
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('no-cache', response['Cache-Control'])
+
+        with CaptureQueriesContext(connection) as ctx:
+            not_modified = self.revalidate(url, response)
+        self.assertEqual(not_modified.status_code, 304)
+        self.assertEqual(not_modified.content, b'')
+        self.assertEqual(not_modified.templates, [])
+        self.assertFalse([q for q in ctx.captured_queries if 'FROM "polls_choice"' in q['sql']])
+
+        # another user gets their own page
+        other = User.objects.exclude(pk=self.user.pk)[0]
+        self.client.force_login(other)
+        self.assertEqual(self.revalidate(url, response).status_code, 200)
+
+    def test_results_changed_after_reopen(self):
+        """
+        A reopened and closed again poll has new results
+        """
+        self.poll.cast_random_votes()
+        url = reverse('polls:results', args=(self.poll.id,))
+        response = self.client.get(url)
+        self.poll.reopen()
+        self.poll.cast_random_votes()
+        changed = self.revalidate(url, response)
+        self.assertEqual(changed.status_code, 200)
+        self.assertNotEqual(changed['ETag'], response['ETag'])
+
+    def test_vote_given_changed_by_votes(self):
+        """
+        The pending voters of vote_given change with every vote
+        """
+        self.poll.vote(self.user, self.choice)
+        url = reverse('polls:vote_given', args=(self.poll.id,))
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(self.revalidate(url, response).status_code, 304)
+        # Last-Modified alone
+        self.assertEqual(self.client.get(url, HTTP_IF_MODIFIED_SINCE=response['Last-Modified'])
+                                    .status_code, 304)
+
+        other = User.objects.exclude(pk=self.user.pk)[0]
+        self.poll.vote(other, self.choice)
+        self.assertEqual(self.revalidate(url, response).status_code, 200)
+
+    def test_index_data_not_modified(self):
+        """
+        The index data is sent again only when a poll changed
+        """
+        url = reverse('polls:index_data')
+        response = self.client.get(url)
+        not_modified = self.client.get(url, HTTP_IF_NONE_MATCH=response['ETag'])
+        self.assertEqual(not_modified.status_code, 304)
+
+        self.poll.vote(self.user, self.choice)
+        changed = self.client.get(url, HTTP_IF_NONE_MATCH=response['ETag'])
+        self.assertEqual(changed.status_code, 200)
+        self.assertEqual(changed.json()['polls']['voted'][0], [changed.json()['users'].index(self.user.username)])
+
+        another = utils.create_poll(question='another question', days=-1)
+        added = self.client.get(url, HTTP_IF_NONE_MATCH=changed['ETag'])
+        self.assertEqual(added.status_code, 200)
+        self.assertEqual(added.json()['counts']['all'], 2)
+
+        # the remaining poll is not newer than before - and the deletion
+        # shows in the version of processes with a cache of their own
+        another.delete()
+        cache.clear()
+        deleted = self.client.get(url, HTTP_IF_NONE_MATCH=added['ETag'])
+        self.assertEqual(deleted.status_code, 200)
+        self.assertEqual(deleted.json()['counts']['all'], 1)
+
+
+class PollQueryPlanTests(utils.LoginMixin, utils.TestCaseWithUtils):
+
+    """ The polls views must not make SQLite scan whole tables """
+
+    n_test_users = 3
+
+    def setUp(self):
+        utils.LoginMixin.setUp(self)
+        cache.clear()
+        self.open_poll, self.closed_poll = utils.factory.create_polls(
+            ['open question', 'closed question'], days=-1)
+        # the segment of all users is read whole by design - a group
+        # segment is looked up by its members
+        group = Group.objects.create(name='members')
+        group.user_set.add(self.user, *self.users[:2])
+        polls = Poll.objects.all()
+        polls.update(segment='group', segment_group=group)
+        polls.refresh_eligible_counts()
+        self.closed_poll.refresh_from_db()
+        self.closed_poll.cast_random_votes()
+        self.choice = self.open_poll.choice_set.all()[0]
+
+    def test_full_scan_detected(self):
+        """
+        A lookup by an unindexed column is reported
+        """
+        with utils.QueryPlanCapture() as capture:
+            list(Poll.objects.filter(question__contains='open'))
+        self.assertEqual([table for table, sql in capture.full_scans()], ['polls_poll'])
+        self.assertEqual(capture.full_scans(allowed_tables=['polls_poll']), [])
+
+    def test_index_data(self):
+        """
+        Every index tab, first and later pages
+        """
+        for tab in polls.views.INDEX_TABS:
+            with self.assertNoFullScans():
+                data = self.client.get(reverse('polls:index_data'),
+                                       {'tab': tab, 'limit': 1}).json()
+                self.client.get(reverse('polls:index_data'),
+                                {'tab': tab, 'limit': 1, 'after': data['next'] or ''})
+
+    def test_poll_pages(self):
+        """
+        The pages of an open and of a closed poll
+        """
+        with self.assertNoFullScans():
+            for poll in (self.open_poll, self.closed_poll):
+                self.client.get(reverse('polls:detail', args=(poll.pk,)))
+                self.client.get(reverse('polls:results', args=(poll.pk,)))
+                self.client.get(reverse('polls:vote_given', args=(poll.pk,)))
+
+    def test_voting(self):
+        """
+        Voting, random votes and reopening
+        """
+        with self.assertNoFullScans():
+            self.client.post(reverse('polls:vote', args=(self.open_poll.pk,)),
+                             {'choice': self.choice.pk})
+            self.client.post(reverse('polls:vote_randomly'), {'poll_ids': [self.open_poll.pk]})
+            self.client.post(reverse('polls:reopen'),
+                             {'poll_ids': [self.open_poll.pk, self.closed_poll.pk]})
+            self.open_poll.register_voters()
+            PollStats.for_polls([self.open_poll, self.closed_poll])
+
+    def test_voter_indexes(self):
+        """
+        Pending voters are looked up by poll or by user in one index range
+        """
+        with utils.QueryPlanCapture() as capture:
+            list(self.open_poll.voter_set.filter(has_voted=False).order_by('pk'))
+            list(Voter.objects.filter(user=self.user, has_voted=False))
+        (_, by_poll), (_, by_user) = capture.plans()
+        self.assertIn('(poll_id=? AND has_voted=?)', by_poll[0])
+        self.assertNotIn('TEMP B-TREE', ' '.join(by_poll))
+        self.assertIn('(user_id=? AND has_voted=?)', by_user[0])
+
+
+class PollVoteBufferTests(utils.TestCaseWithUtils):
+
+    """ Test write-behind voting """
+
+    n_test_users = 4
+
+    def setUp(self):
+        self.poll = self.create_test_poll()
+        self.choices = list(self.poll.choice_set.order_by('pk'))
+        journal_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, journal_dir)
+        self.journal = os.path.join(journal_dir, 'votes.log')
+        self.buffer = VoteBuffer(journal=self.journal, fsync=False, autoflush=False)
+
+    def choice_votes(self):
+        return [c.votes for c in self.poll.choice_set.order_by('pk')]
+
+    def test_flush_merges_votes_per_choice(self):
+        """
+        A batch is written with one update per choice
+        """
+        for user, choice in zip(self.users, [0, 0, 0, 1]):
+            self.assertTrue(self.buffer.add(self.poll.id, user.id, self.choices[choice].id))
+        self.assertEqual(self.choice_votes(), [0, 0, 0])
+        # savepoint/release, polls, registered voters, eligible unregistered
+        # ones, voter insert, 2 choice updates, counter update, open polls,
+        # close
+        with self.assertNumQueries(11):
+            self.assertEqual(self.buffer.flush(), 4)
+        self.assertEqual(self.choice_votes(), [3, 1, 0])
+        poll = Poll.objects.get(pk=self.poll.pk)
+        self.assertEqual((poll.is_open, poll.n_voted, poll.n_votes), (False, 4, 4))
+
+    def test_duplicate_votes_skipped(self):
+        """
+        Second pending vote and votes of users who voted directly are dropped
+        """
+        user1, user2 = self.users[:2]
+        self.assertTrue(self.buffer.add(self.poll.id, user1.id, self.choices[0].id))
+        self.assertFalse(self.buffer.add(self.poll.id, user1.id, self.choices[1].id))
+        self.assertTrue(self.buffer.is_pending(self.poll.id, user1.id))
+        self.buffer.add(self.poll.id, user2.id, self.choices[0].id)
+        self.poll.vote(user2, self.choices[1])
+        self.assertEqual(self.buffer.flush(), 1)
+        self.assertEqual(self.choice_votes(), [1, 1, 0])
+        self.assertFalse(self.buffer.is_pending(self.poll.id, user1.id))
+
+    def test_votes_for_deleted_choice_dropped(self):
+        """
+        Votes for a choice deleted before the flush are not counted and
+        their voters may vote again
+        """
+        user1, user2 = self.users[:2]
+        self.poll.register_voter(user1)
+        self.buffer.add(self.poll.id, user1.id, self.choices[2].id)
+        self.buffer.add(self.poll.id, user2.id, self.choices[2].id)
+        self.buffer.add(self.poll.id, self.users[2].id, self.choices[0].id)
+        self.choices[2].delete()
+        self.assertEqual(self.buffer.flush(), 1)
+        poll = Poll.objects.get(pk=self.poll.pk)
+        self.assertEqual((poll.n_voted, poll.n_votes), (1, 1))
+        self.assertEqual(list(poll.voter_set.filter(has_voted=True).values_list('user', flat=True)),
+                         [self.users[2].pk])
+        self.assertTrue(poll.vote(user1, self.choices[1]))
+        self.assertEqual(Poll.objects.reconcile_counters(), [])
+
+    def test_journal_replay(self):
+        """
+        Votes journaled by a crashed process are written on replay
+        """
+        for user in self.users[:2]:
+            self.buffer.add(self.poll.id, user.id, self.choices[2].id)
+        # simulate a crash - a new buffer picks up the journal
+        with open(self.journal, 'a') as journal:
+            journal.write('{"poll": 1, "us')
+        recovered = VoteBuffer(journal=self.journal, fsync=False, autoflush=False)
+        self.assertEqual(recovered.replay(), 2)
+        self.assertEqual(self.choice_votes(), [0, 0, 2])
+        self.assertEqual(os.path.getsize(self.journal), 0)
+        # replaying again is a no-op
+        self.assertEqual(self.buffer.replay(), 0)
+
+    def test_vote_view_write_behind(self):
+        """
+        The vote view acknowledges the vote before it is written
+        """
+        set_vote_buffer(self.buffer)
+        self.addCleanup(set_vote_buffer, None)
+        self.client.login(username='testuser1', password='testuser1')
+        response = self.client.post(reverse('polls:vote', args=(self.poll.id,)),
+                                    {'choice': self.choices[0].id})
+        self.assertTrue(reverse('polls:vote_given', args=(self.poll.id,)) in response['Location'])
+        self.assertEqual(self.choice_votes(), [0, 0, 0])
+        # pending vote already counts for the access decorators
+        response = self.client.get(reverse('polls:detail', args=(self.poll.id,)))
+        self.assertEqual(response.status_code, 302)
+        self.buffer.flush()
+        self.assertEqual(self.choice_votes(), [1, 0, 0])
+
+
+class VoteEventBusTests(unittest.TestCase):
+
+    """ Test the in process vote event bus """
+
+    def test_wait_returns_poll_events(self):
+        """
+        Only the events of the given poll newer than after are returned
+        """
+        bus = VoteEventBus()
+        bus.publish(1, 'vote', users=[1])
+        bus.publish(2, 'vote', users=[2])
+        bus.publish(1, 'closed')
+        events = bus.wait(1, 0, timeout=0)
+        self.assertEqual([e.type for e in events], ['vote', 'closed'])
+        self.assertEqual([e.type for e in bus.wait(1, events[0].seq, timeout=0)], ['closed'])
+        self.assertEqual(bus.wait(1, bus.last_seq, timeout=0.01), [])
+
+    def test_wait_wakes_up_on_publish(self):
+        """
+        A waiting client is woken up by a publish from another thread
+        """
+        bus = VoteEventBus()
+        timer = threading.Timer(0.05, bus.publish, args=(1, 'vote'), kwargs={'users': [3]})
+        timer.start()
+        events = bus.wait(1, 0, timeout=5)
+        timer.join()
+        self.assertEqual(events[0].data, {'users': [3]})
+
+    def test_resync_when_behind(self):
+        """
+        Clients that missed events dropped from the buffer are told to resync
+        """
+        bus = VoteEventBus(max_events=2)
+        for user_id in range(4):
+            bus.publish(1, 'vote', users=[user_id])
+        self.assertEqual(bus.wait(1, 0, timeout=0)[0].type, 'resync')
+
+    def test_resync_when_ahead(self):
+        """
+        Clients with a sequence number this bus never reached (another
+        process, a restart) are told to resync - at the current number
+        """
+        bus = VoteEventBus()
+        bus.publish(1, 'vote', users=[1])
+        events = bus.wait(1, 50, timeout=0)
+        self.assertEqual([(e.type, e.seq) for e in events], [('resync', 1)])
+        bus.publish(1, 'closed')
+        self.assertEqual([e.type for e in bus.wait(1, events[0].seq, timeout=0)], ['closed'])
+
+
+class PollVoteEventStreamTests(utils.TestCaseWithUtils):
+
+    """ Test the Server-Sent Events stream of vote_given """
+
+    def setUp(self):
+        self.user = utils.create_user(username='testuser1')
+        self.other = utils.create_user(username='testuser2')
+        self.poll = self.create_test_poll()
+        self.poll.vote(self.user, self.poll.choice_set.all()[0])
+        self.login()
+        self.url = reverse('polls:vote_events', args=(self.poll.id,))
+
+    def test_stream_until_closed(self):
+        """
+        Votes and the close of the poll are streamed, then the stream ends
+        """
+        after = vote_events.last_seq
+        vote_events.publish(self.poll.id, 'vote', users=[self.other.id])
+        vote_events.publish(self.poll.id + 1, 'vote', users=[self.other.id])
+        vote_events.publish(self.poll.id, 'closed')
+        response = self.client.get(self.url, {'after': after})
+        self.assertEqual(response['Content-Type'], 'text/event-stream')
+        body = ''.join(response.streaming_content)
+        self.assertEqual(body.count('event: vote'), 1)
+        self.assertIn('data: {"users": [%d]}' % self.other.id, body)
+        self.assertTrue(body.endswith('event: closed\ndata: {}\n\n'))
+
+    def test_stream_keepalive_and_last_event_id(self):
+        """
+        Idle streams send keep-alives and resume from Last-Event-ID
+        """
+        old = polls.views.EVENT_STREAM_KEEPALIVE, polls.views.EVENT_STREAM_MAX_DURATION
+        polls.views.EVENT_STREAM_KEEPALIVE, polls.views.EVENT_STREAM_MAX_DURATION = 0.01, 0.05
+        try:
+            vote_events.publish(self.poll.id, 'vote', users=[self.other.id])
+            response = self.client.get(self.url, HTTP_LAST_EVENT_ID=str(vote_events.last_seq))
+            body = ''.join(response.streaming_content)
+        finally:
+            polls.views.EVENT_STREAM_KEEPALIVE, polls.views.EVENT_STREAM_MAX_DURATION = old
+        self.assertNotIn('event:', body)
+        self.assertIn(': keep-alive', body)
+
+    def test_resync_resumes_from_its_id(self):
+        """
+        A client behind the ring buffer gets a resync it can resume from -
+        the page reconnects with its id instead of reloading a cached copy
+        """
+        old = polls.views.EVENT_STREAM_KEEPALIVE, polls.views.EVENT_STREAM_MAX_DURATION
+        polls.views.EVENT_STREAM_KEEPALIVE, polls.views.EVENT_STREAM_MAX_DURATION = 0.01, 0.05
+        try:
+            after = vote_events.last_seq
+            for _ in range(MAX_EVENTS + 5):
+                vote_events.publish(self.poll.id + 1, 'vote', users=[self.other.id])
+            body = ''.join(self.client.get(self.url, {'after': after}).streaming_content)
+            self.assertIn('event: resync', body)
+            resync_id = re.search(r'id: (\d+)\nevent: resync', body).group(1)
+            body = ''.join(self.client.get(self.url, HTTP_LAST_EVENT_ID=resync_id)
+                           .streaming_content)
+        finally:
+            polls.views.EVENT_STREAM_KEEPALIVE, polls.views.EVENT_STREAM_MAX_DURATION = old
+        self.assertNotIn('event:', body)
+        page = self.client.get(reverse('polls:vote_given', args=(self.poll.id,)))
+        self.assertContains(page, 'connect(e.lastEventId)')
+
+    def test_vote_given_passes_event_seq(self):
+        """
+        vote_given tells the page where to start streaming from
+        """
+        response = self.client.get(reverse('polls:vote_given', args=(self.poll.id,)))
+        self.assertEqual(response.context['event_seq'], vote_events.last_seq)
+        self.assertContains(response, "data-user-id='%d'" % self.other.id)
+
+
+class PollConcurrentVoteTests(TransactionTestCase):
+
+    """ Hammer a single poll with votes from many threads """
+
+    n_users = 8
+    n_attempts = 3
+
+    def setUp(self):
+        if connection.is_in_memory_db(connection.settings_dict['NAME']):
+            self.skipTest('in-memory sqlite cannot be shared between threads')
+        self.users = list(utils.create_users(count=self.n_users))
+        self.poll = utils.create_default_poll()
+        self.choice = self.poll.choice_set.all()[0]
+
+    def cast_votes(self, users):
+        """
+        Vote for self.choice once per user from a separate thread each
+        """
+        results = []
+        def worker(user):
+            try:
+                results.append(self.poll.vote(user, self.choice))
+            finally:
+                connection.close()
+        threads = [threading.Thread(target=worker, args=(u,)) for u in users]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return results
+
+    def test_concurrent_votes_are_not_lost(self):
+        """
+        Every user votes once concurrently - every vote is counted
+        """
+        results = self.cast_votes(self.users)
+        self.assertEqual(results.count(True), self.n_users)
+        self.assertEqual(Choice.objects.get(pk=self.choice.pk).votes, self.n_users)
+        self.assertEqual(self.poll.voter_set.filter(has_voted=False).count(), 0)
+
+    def test_concurrent_duplicate_votes_count_once(self):
+        """
+        Every user votes several times concurrently - only one vote counted per user
+        """
+        results = self.cast_votes(self.users * self.n_attempts)
+        self.assertEqual(results.count(True), self.n_users)
+        self.assertEqual(Choice.objects.get(pk=self.choice.pk).votes, self.n_users)
+
+    def test_votes_published_on_commit(self):
+        """
+        Committed votes and the close of the poll reach the event bus
+        """
+        after = vote_events.last_seq
+        self.cast_votes(self.users)
+        self.poll.update_open_status()
+        events = vote_events.wait(self.poll.id, after, timeout=0)
+        voted = sorted(u for e in events if e.type == 'vote' for u in e.data['users'])
+        self.assertEqual(voted, sorted(u.id for u in self.users))
+        self.assertEqual(events[-1].type, 'closed')
+
+    def test_write_behind_autoflush(self):
+        """
+        The flush thread writes buffered votes after max_delay
+        """
+        vote_buffer = VoteBuffer(max_batch=100, max_delay_ms=20, autoflush=True)
+        self.addCleanup(vote_buffer.close)
+        for user in self.users:
+            vote_buffer.add(self.poll.id, user.id, self.choice.id)
+        deadline = time.time() + 5
+        while (vote_buffer.is_pending(self.poll.id, self.users[-1].id) and
+               time.time() < deadline):
+            time.sleep(0.01)
+        self.assertEqual(Choice.objects.get(pk=self.choice.pk).votes, self.n_users)
+        self.assertEqual(Poll.objects.get(pk=self.poll.pk).is_open, False)
+
+    def test_concurrent_sharded_votes_are_not_lost(self):
+        """
+        Every user votes once concurrently on a sharded poll
+        """
+        self.poll.set_vote_shards(4)
+        results = self.cast_votes(self.users)
+        self.assertEqual(results.count(True), self.n_users)
+        self.assertEqual(Poll.objects.get(pk=self.poll.pk).total_votes(), self.n_users)
+
+    def test_vote_for_invalid_choice_rolls_back(self):
+        """
+        Voting for a choice outside the poll leaves the voter untouched -
+        or unregistered if the vote was to register it
+        """
+        self.assertRaises(Choice.DoesNotExist, self.poll.vote, self.users[0], 111)
+        self.assertFalse(Voter.objects.filter(poll=self.poll, user=self.users[0]).exists())
+        self.poll.register_voter(self.users[0])
+        self.assertRaises(Choice.DoesNotExist, self.poll.vote, self.users[0], 111)
+        voter = Voter.objects.get(poll=self.poll, user=self.users[0])
+        self.assertEqual(voter.has_voted, False)
+
+
+class PollJobThreadTests(TransactionTestCase):
+
+    """ Jobs run by the thread pool once committed - which needs the SQLite profile """
+
+    def setUp(self):
+        if connection.is_in_memory_db(connection.settings_dict['NAME']):
+            self.skipTest('in-memory sqlite cannot be shared between threads')
+        # connect again with the profile, and without it once done
+        profile = override_settings(SQLITE_PROFILE={'ENABLED': True})
+        profile.enable()
+        self.addCleanup(profile.disable)
+        connection.close()
+        self.addCleanup(connection.close)
+        self.users = list(utils.create_users(count=4))
+        self.polls = [utils.create_poll(question='question %d' % i, days=-1)
+                      for i in range(3)]
+
+    def test_jobs_run_in_pool(self):
+        """
+        The jobs run after the commit, each once
+        """
+        job_queue = JobQueue(threads=2)
+        self.assertFalse(job_queue.sync)
+        try:
+            for poll in self.polls:
+                job_queue.enqueue('register_voters', poll_id=poll.pk)
+        finally:
+            job_queue.close()
+        self.assertEqual(list(Job.objects.values_list('status', 'attempts')),
+                         [(Job.DONE, 1)] * 3)
+        self.assertEqual(Voter.objects.count(), 12)
+
+    def test_user_changes_while_jobs_run(self):
+        """
+        Users and group members change while the pool writes - both sides
+        wait for the database instead of failing (see TRANSACTION_MODE of
+        the SQLite profile)
+        """
+        group = Group.objects.create(name='members')
+        group_poll = utils.create_poll(question='members question', days=-1)
+        group_poll.segment, group_poll.segment_group = 'group', group
+        group_poll.save()
+        utils.factory.create_users([{'username': 'jobuser%d' % i} for i in range(3000)])
+        job_queue = JobQueue(threads=2)
+        try:
+            for poll in self.polls:
+                job_queue.enqueue('register_voters', poll_id=poll.pk)
+            for i in range(30):
+                User.objects.create_user('member%d' % i, password='x').groups.add(group)
+        finally:
+            job_queue.close()
+        self.assertEqual(list(Job.objects.values_list('status', flat=True)), [Job.DONE] * 3)
+        self.assertEqual(Poll.objects.get(pk=group_poll.pk).n_eligible_voters, 30)
+        self.assertEqual(Poll.objects.reconcile_counters(), [])
+
+    def test_inline_without_transaction_mode(self):
+        """
+        Without the SQLite profile's transaction mode the jobs run inline
+        """
+        for profile in ({'ENABLED': False}, {'ENABLED': True, 'TRANSACTION_MODE': None}):
+            with override_settings(SQLITE_PROFILE=profile):
+                job_queue = JobQueue(threads=2)
+                self.assertTrue(job_queue.sync)
+                job_queue.enqueue('register_voters', poll_id=self.polls[0].pk)
+                job_queue.close()
+            Job.objects.all().delete()
+        self.assertEqual(Voter.objects.count(), 4)
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -3,10 +3,12 @@ from polls import views
 
 urlpatterns = patterns('',
     url(r'^$', views.index, name='index'),
+    url(r'^data/$', views.index_data, name='index_data'),
     url(r'^(?P<poll_id>\d+)/$', views.detail, name='detail'),
     url(r'^(?P<poll_id>\d+)/results/$', views.results, name='results'),
     url(r'^(?P<poll_id>\d+)/vote/$', views.vote, name='vote'),
     url(r'^(?P<poll_id>\d+)/vote_given/$', views.vote_given, name='vote_given'),
+    url(r'^(?P<poll_id>\d+)/vote_given/events/$', views.vote_events_stream, name='vote_events'),
     url(r'^reopen/$', views.reopen, name='reopen'),
     url(r'^vote_randomly/$', views.vote_randomly, name='vote_randomly'),
 )
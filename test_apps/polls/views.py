@@ -3,18 +3,54 @@ Poll views file
 """
 
 from django.shortcuts import render
-from django.http import HttpResponseRedirect
+from django.template.loader import render_to_string
+from django.utils.safestring import mark_safe
+from django.http import HttpResponseRedirect, StreamingHttpResponse, JsonResponse
+from django.http import HttpResponseBadRequest
 from django.core.urlresolvers import reverse
 from django.utils import timezone
+from django.utils.cache import patch_cache_control
 from django.contrib.auth.decorators import login_required
 from django.contrib.auth.models import User
+from django.db.models import Q, Count, Sum, Max, Case, When, IntegerField
 
-from polls.models import Poll, Choice
+from polls.models import Poll, PollStats, PollTombstone, Choice, Voter
+from polls.events import vote_events, format_sse
+from polls.vote_buffer import get_vote_buffer
 from test_apps.utils import anonymous_required, required_poll_status, required_voting_status
 from test_apps.utils import render_template
+from test_apps.utils import cache_get_or_compute, conditional_page, conditional_poll_page
+from test_apps.sqlite_profile import retry_on_locked
+
+import datetime
+import time
 
 # Create your views here.
 
+# seconds a rendered results table stays cached - the key changes anyway
+# when the poll is reopened
+RESULTS_CACHE_TIMEOUT = 24 * 60 * 60
+
+# seconds browsers may reuse the index page - it holds no poll data, the
+# tables are filled in from index_data on every visit
+INDEX_SHELL_MAX_AGE = 5 * 60
+
+# tabs of the index page, polls per page of a tab by default and at most
+INDEX_TABS = ('all', 'open', 'closed', 'user_open')
+INDEX_PAGE_SIZE = 50
+MAX_INDEX_PAGE_SIZE = 500
+
+CURSOR_EPOCH = datetime.datetime(1970, 1, 1, tzinfo=timezone.utc)
+
+# seconds the tab counts of an index version stay cached - the key changes
+# anyway with every poll change
+INDEX_COUNTS_CACHE_TIMEOUT = 60 * 60
+
+# seconds between keep-alive comments on the vote event stream and before
+# the stream is ended - EventSource reconnects by itself with Last-Event-ID
+EVENT_STREAM_KEEPALIVE = 15
+EVENT_STREAM_MAX_DURATION = 300
+
 def get_preview_context():
     return {
         'app_objects': Poll.objects.all(),
@@ -23,54 +59,189 @@ def get_preview_context():
 @login_required
 def index(request):
     """
-    Index page
+    Index page - a shell without poll data, loaded from index_data by the
+    page itself. Only depends on the user, so browsers may keep it a while
     """
-    polls = Poll.objects.filter(pub_date__lte=timezone.now())
-    open_polls = [p for p in polls if p.is_open is True]
-    closed_polls = list(set(polls) - set(open_polls))
-    user_open_polls = [p for p in open_polls for v in \
-                       p.voter_set.filter(user=request.user) if v.has_voted is False]
+    response = render_template(request, 'polls/index.html')
+    patch_cache_control(response, private=True, max_age=INDEX_SHELL_MAX_AGE)
+    return response
 
-    context = {
-        'polls': {
-            'all': [],
-            'open': [],
-            'closed': [],
-            'user_open': [],
-        },
-    }
+def encode_cursor(poll):
+    """
+    Cursor of the index page after poll - its pub_date in microseconds
+    since the epoch and its pk
+    """
+    delta = poll.pub_date - CURSOR_EPOCH
+    micros = (delta.days * 86400 + delta.seconds) * 10 ** 6 + delta.microseconds
+    return '%d.%d' % (micros, poll.pk)
 
-    for poll in polls:
-        poll_data = {}
-        poll_data['ref'] = poll
-        poll_data['status'] = 'closed'
-        if poll in open_polls:
-            if poll in user_open_polls:
-                poll_data['status'] = 'user_open'
-            else:
-                poll_data['status'] = 'open'
-        context['polls']['all'].append(poll_data)
+def decode_cursor(cursor):
+    """
+    (pub_date, pk) of a cursor made by encode_cursor - ValueError if it
+    is not one
+    """
+    micros, pk = cursor.split('.')
+    try:
+        return CURSOR_EPOCH + datetime.timedelta(microseconds=int(micros)), int(pk)
+    except OverflowError:
+        raise ValueError('Cursor %s out of range' % cursor)
+
+def get_index_version(request):
+    """
+    Version of the published polls - the latest poll change (see
+    Poll.modified), the latest publication and the latest deletion (see
+    PollTombstone). All three are the max of an indexed column, so it
+    costs the same however many polls there are. Cached on the request
+    with 'now', the time the polls are published by
+    """
+    version = request.__dict__.get('_index_version')
+    if version is None:
+        now = timezone.now()
+        modified = Poll.objects.aggregate(modified=Max('modified'))['modified']
+        published = Poll.objects.filter(pub_date__lte=now).aggregate(
+            published=Max('pub_date'))['published']
+        request._index_now = now
+        request._index_version = version = '%s-%s-%d' % (
+            modified.isoformat() if modified else '',
+            published.isoformat() if published else '',
+            PollTombstone.objects.aggregate(deleted=Max('pk'))['deleted'] or 0)
+    return version
+
+def get_index_counts(request):
+    """
+    Published polls per index tab - counting them takes a pass over the
+    polls, so they are cached per index version and only counted again
+    after a change. user_open is cached per user
+    """
+    version = get_index_version(request)
+    now = request._index_now
+
+    def count_tabs():
+        counts = Poll.objects.filter(pub_date__lte=now).aggregate(
+            all=Count('pk'),
+            open=Sum(Case(When(is_open=True, then=1), default=0,
+                          output_field=IntegerField())))
+        counts['open'] = counts['open'] or 0
+        counts['closed'] = counts['all'] - counts['open']
+        return counts
+
+    def count_user_open():
+        return Poll.objects.filter(pub_date__lte=now).pending_for(request.user).count()
+
+    counts = dict(cache_get_or_compute('polls:index:counts:%s' % version, count_tabs,
+                                       INDEX_COUNTS_CACHE_TIMEOUT))
+    counts['user_open'] = cache_get_or_compute(
+        'polls:index:user_open:%s:%d' % (version, request.user.pk), count_user_open,
+        INDEX_COUNTS_CACHE_TIMEOUT)
+    return counts
+
+def index_data_etag(request):
+    """
+    ETag of the index data - changes with the index version, which covers
+    the user's votes and voter registrations too
+    """
+    return '%s-%d' % (get_index_version(request), request.user.pk)
+
+@login_required
+@conditional_page(index_data_etag)
+def index_data(request):
+    """
+    A page of an index tab as JSON - see get_index_page and get_index_data.
+    GET parameters tab, after (the cursor of the previous page) and limit
+    """
+    tab = request.GET.get('tab', 'all')
+    try:
+        if tab not in INDEX_TABS:
+            raise ValueError('No tab %s' % tab)
+        after = decode_cursor(request.GET['after']) if request.GET.get('after') else None
+        limit = min(max(int(request.GET.get('limit', INDEX_PAGE_SIZE)), 1), MAX_INDEX_PAGE_SIZE)
+    except ValueError as error:
+        return HttpResponseBadRequest(str(error))
+
+    polls, next_cursor = get_index_page(request, tab, after, limit)
+    counts = get_index_counts(request)
+    data = get_index_data(polls)
+    data.update({
+        'tab': tab,
+        'next': next_cursor,
+        'counts': dict((name, counts[name]) for name in INDEX_TABS),
+    })
+    return JsonResponse(data, json_dumps_params={'separators': (',', ':')})
+
+def get_index_page(request, tab, after=None, limit=INDEX_PAGE_SIZE):
+    """
+    limit published polls of an index tab, newest first, following the
+    cursor after. Keyset paginated on (pub_date, pk) so a page costs the
+    same however deep it is. Returns (polls, cursor of the next page or
+    None)
+    """
+    get_index_version(request)
+    polls = Poll.objects.filter(pub_date__lte=request._index_now)
+    if tab == 'open':
+        polls = polls.filter(is_open=True)
+    elif tab == 'closed':
+        polls = polls.filter(is_open=False)
+    elif tab == 'user_open':
+        polls = polls.pending_for(request.user)
+    if after is not None:
+        pub_date, pk = after
+        polls = polls.filter(Q(pub_date__lt=pub_date) | Q(pub_date=pub_date, pk__lt=pk))
+    polls = list(polls.order_by('-pub_date', '-pk')[:limit + 1])
+    if len(polls) > limit:
+        return polls[:limit], encode_cursor(polls[limit - 1])
+    return polls, None
+
+def get_index_data(polls):
+    """
+    Index page data of polls, the same for every user. Column oriented - a
+    list per field with an entry per poll. voted and pending hold indexes
+    into users, where every username of an eligible voter of an open poll
+    appears once, and are null for closed polls as are the winner fields of
+    open polls. Runs a constant number of queries however many polls and
+    voters there are - plus one per eligibility segment of the open polls
+    """
+    # winners of the closed polls
+    PollStats.for_polls(poll for poll in polls if not poll.is_open)
 
+    users, user_index = [], {}
+
+    def index_of(username):
+        if username not in user_index:
+            user_index[username] = len(users)
+            users.append(username)
+        return user_index[username]
+
+    open_polls = [poll for poll in polls if poll.is_open]
+    voted, pending = {}, {}
+    voted_names = Voter.objects.filter(poll__in=[poll.pk for poll in open_polls], has_voted=True)\
+                               .order_by('pk').values_list('poll', 'user__username')
+    for poll_id, username in voted_names:
+        voted.setdefault(poll_id, []).append(index_of(username))
+
+    # pending voters are the eligible users who have not voted - registered
+    # or not
+    segments = {}
     for poll in open_polls:
-        poll_data = {}
-        n_eligible_voters = len(poll.eligible_voters())
-        poll_data['ref'] = poll
-        poll_data['poll_voters'] = [v for v in poll.voter_set.all() if v.has_voted is True]
-        poll_data['pending_voters'] = [v for v in poll.voter_set.all() if v.has_voted is False]
-        context['polls']['open'].append(poll_data)
-
-    for poll in closed_polls:
-        poll_data = {}
-        poll_data['ref'] = poll
-        poll_data['winner'] = poll.get_winner()
-        context['polls']['closed'].append(poll_data)
-
-    for poll in user_open_polls:
-        poll_data = {}
-        poll_data['ref'] = poll
-        context['polls']['user_open'].append(poll_data)
-
-    return render_template(request, 'polls/index.html', context)
+        segment = (poll.segment, poll.segment_group_id)
+        if segment not in segments:
+            segments[segment] = [index_of(username) for username in
+                                 poll.eligible_voters().order_by('pk')
+                                     .values_list('username', flat=True)]
+        poll_voted = set(voted.get(poll.pk, ()))
+        pending[poll.pk] = [i for i in segments[segment] if i not in poll_voted]
+
+    columns = dict((name, []) for name in ('id', 'question', 'is_open', 'voted',
+                                            'pending', 'winner', 'winner_votes'))
+    for poll in polls:
+        winner = None if poll.is_open else poll.get_winner()
+        columns['id'].append(poll.pk)
+        columns['question'].append(poll.question)
+        columns['is_open'].append(poll.is_open)
+        columns['voted'].append(voted.get(poll.pk, []) if poll.is_open else None)
+        columns['pending'].append(pending.get(poll.pk, []) if poll.is_open else None)
+        columns['winner'].append(winner.choice_text if winner else None)
+        columns['winner_votes'].append(winner.votes if winner else None)
+    return {'users': users, 'polls': columns}
 
 @required_poll_status(True)
 @required_voting_status(False)
@@ -98,15 +269,17 @@ def vote(request, poll_id, **kwargs):
             'error_message': "You did not select a choice"
         })
     else:
-        # increment vote count
-        selected_choice.votes += 1
-        selected_choice.save()
-
-        # set has_voted True for this user for this poll
-        voter = kwargs['voter']
-        voter.has_voted = True
-        voter.save()
-        
+        vote_buffer = get_vote_buffer()
+        if vote_buffer is not None:
+            # write-behind - the vote is written with the next batch
+            vote_buffer.add(poll.id, request.user.pk, selected_choice.pk)
+            return HttpResponseRedirect(reverse('polls:vote_given', args=(poll.id,)))
+
+        # mark voter as voted and increment vote count in one transaction
+        if not retry_on_locked(poll.vote)(request.user, selected_choice):
+            # lost the race against another request by the same user
+            return HttpResponseRedirect(reverse('polls:vote_given', args=(poll.id,)))
+
         # check how many pending voters left
         poll.update_open_status()
         if poll.is_open:
@@ -116,32 +289,93 @@ def vote(request, poll_id, **kwargs):
 @required_poll_status(True)
 @required_voting_status(True)
 @login_required
+@conditional_poll_page
 def vote_given(request, poll_id, **kwargs):
     """
     Voting done handler
     """
     poll = kwargs['poll']
+    # the event stream picks up from here - read it before the voters
+    event_seq = vote_events.last_seq
     # get pending voters
-    all_voters = poll.voter_set.all()
-    pending_voters = poll.voter_set.filter(has_voted=False)
+    pending_voters = poll.pending_voters().order_by('pk')
 
     context = {
         'poll': poll,
-        'all_voters': all_voters,
-        'pending_voters': pending_voters
+        'pending_voters': pending_voters,
+        'event_seq': event_seq,
     }
     return render_template(request, 'polls/vote_given.html', context)
 
+@required_poll_status(True)
+@required_voting_status(True)
+@login_required
+def vote_events_stream(request, poll_id, **kwargs):
+    """
+    Server-Sent Events stream of the votes cast in an open poll
+    """
+    poll = kwargs['poll']
+    after = request.META.get('HTTP_LAST_EVENT_ID') or request.GET.get('after')
+    try:
+        after = int(after)
+    except (TypeError, ValueError):
+        after = vote_events.last_seq
+    response = StreamingHttpResponse(stream_vote_events(poll.id, after),
+                                     content_type='text/event-stream')
+    response['Cache-Control'] = 'no-cache'
+    return response
+
+def stream_vote_events(poll_id, after):
+    """
+    Yield the events of poll_id after sequence number after until the poll
+    closes or EVENT_STREAM_MAX_DURATION is over
+    """
+    deadline = time.time() + EVENT_STREAM_MAX_DURATION
+    while time.time() < deadline:
+        timeout = min(EVENT_STREAM_KEEPALIVE, deadline - time.time())
+        events = vote_events.wait(poll_id, after, timeout)
+        if not events:
+            yield ': keep-alive\n\n'
+            continue
+        for event in events:
+            yield format_sse(event)
+            after = event.seq
+            if event.type in ('closed', 'resync'):
+                return
+
 @required_poll_status(False)
 @required_voting_status(True)
 @login_required
+@conditional_poll_page
 def results(request, poll_id, **kwargs):
     """
     Results page
     """
     poll = kwargs['poll']
-    ranked_choices = poll.choice_set.order_by('-votes')
-    return render_template(request, 'polls/results.html', {'poll': poll, 'ranked_choices': ranked_choices })
+    context = {
+        'poll': poll,
+        'results_table': render_results_table(poll),
+    }
+    return render_template(request, 'polls/results.html', context)
+
+def results_cache_key(poll):
+    """
+    Cache key of the rendered results table of poll
+    """
+    return 'polls:results:%d:%d' % (poll.pk, poll.version)
+
+def render_results_table(poll):
+    """
+    Render the ranked choices of a closed poll - cached per poll version,
+    concurrent misses render it only once
+    """
+    def render():
+        stats = poll.stats()
+        return render_to_string('polls/results_table.html',
+                                {'poll': poll, 'stats': stats,
+                                 'ranked_choices': stats.ranked_choices})
+    return mark_safe(cache_get_or_compute(results_cache_key(poll), render,
+                                          RESULTS_CACHE_TIMEOUT))
 
 #@required_poll_status(False)
 #@required_voting_status(True)
@@ -150,10 +384,7 @@ def reopen(request, **kwargs):
     """
     Reopen selected polls
     """
-    for poll_id in request.POST.getlist('poll_ids'):
-        poll = Poll.objects.get(pk=poll_id)
-        print poll
-        poll.reopen()
+    Poll.objects.filter(pk__in=request.POST.getlist('poll_ids')).reopen()
     return HttpResponseRedirect(reverse('polls:index') + '#open_polls_tab')
 
 @login_required
@@ -161,7 +392,6 @@ def vote_randomly(request, **kwargs):
     """
     Randomly vote in the selected polls
     """
-    for poll_id in request.POST.getlist('poll_ids'):
-        poll = Poll.objects.get(pk=poll_id)
-        list(poll.vote_randomly())
+    for poll in Poll.objects.filter(pk__in=request.POST.getlist('poll_ids')):
+        poll.cast_random_votes()
     return HttpResponseRedirect(reverse('polls:index') + '#closed_polls_tab')
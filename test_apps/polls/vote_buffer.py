@@ -0,0 +1,283 @@
+"""
+Write-behind voting - votes are validated and acknowledged in memory,
+journaled to a local append-only file and written to the database in
+batches, one transaction per batch with the votes merged per choice.
+
+Enabled with settings.POLLS_VOTE_BUFFER['ENABLED']. Pending votes only live
+in the process that took them, so run a single process when enabling it.
+"""
+from django.conf import settings
+from django.db import transaction
+from django.db.models import F
+
+from polls.models import Poll, Choice, Voter, changed
+from polls.events import vote_events
+
+import atexit
+import collections
+import json
+import os
+import threading
+
+DEFAULT_OPTIONS = {
+    'ENABLED': False,
+    # flush once this many votes are pending ...
+    'MAX_BATCH': 100,
+    # ... or this many milliseconds after the first pending vote
+    'MAX_DELAY_MS': 50,
+    # append-only journal replayed on startup - None to keep votes in memory only
+    'JOURNAL': None,
+    # fsync the journal before acknowledging a vote
+    'FSYNC': True,
+}
+
+_vote_buffer = None
+_vote_buffer_lock = threading.Lock()
+
+
+def apply_votes(votes):
+    """
+    Write a batch of {(poll_id, user_id): choice_id} votes in one
+    transaction - votes of users who have voted meanwhile are skipped, and
+    eligible users who never opened the poll are registered as voted.
+    Votes for choices deleted meanwhile are dropped, their voters may vote
+    again. Returns number of votes written
+    """
+    by_poll = collections.defaultdict(dict)
+    for (poll_id, user_id), choice_id in votes.items():
+        by_poll[poll_id][user_id] = choice_id
+
+    n_applied = 0
+    with transaction.atomic():
+        polls = Poll.objects.in_bulk(list(by_poll))
+        for poll_id, poll_votes in by_poll.items():
+            if poll_id not in polls:
+                continue
+            # voters who left the segment are neither registered nor eligible
+            registered = dict(polls[poll_id].segment_voters()
+                                            .filter(user_id__in=list(poll_votes))
+                                            .values_list('user_id', 'has_voted'))
+            user_ids = [user_id for user_id, has_voted in registered.items() if not has_voted]
+            unregistered = [user_id for user_id in poll_votes if user_id not in registered]
+            new_ids = []
+            if unregistered:
+                new_ids = list(polls[poll_id].eligible_voters().filter(pk__in=unregistered)
+                                             .values_list('pk', flat=True))
+            # choices first - the voters of a choice that is gone are left alone
+            counts = collections.Counter(poll_votes[user_id] for user_id in user_ids + new_ids)
+            deleted = set(choice_id for choice_id, n_votes in counts.items()
+                          if not Choice.objects.filter(pk=choice_id, poll_id=poll_id)
+                                               .update(votes=F('votes') + n_votes))
+            if deleted:
+                user_ids = [user_id for user_id in user_ids if poll_votes[user_id] not in deleted]
+                new_ids = [user_id for user_id in new_ids if poll_votes[user_id] not in deleted]
+            if user_ids:
+                Voter.objects.filter(poll_id=poll_id, user_id__in=user_ids)\
+                             .update(has_voted=True)
+            if new_ids:
+                Voter.objects.bulk_create([Voter(poll_id=poll_id, user_id=user_id, has_voted=True)
+                                           for user_id in new_ids])
+                user_ids.extend(new_ids)
+            if not user_ids:
+                continue
+            Poll.objects.filter(pk=poll_id).update(**changed(
+                n_voted=F('n_voted') + len(user_ids),
+                n_votes=F('n_votes') + len(user_ids)))
+            transaction.on_commit(
+                lambda poll_id=poll_id, user_ids=user_ids:
+                    vote_events.publish(poll_id, 'vote', users=user_ids))
+            n_applied += len(user_ids)
+
+    for poll in Poll.objects.filter(pk__in=list(by_poll), is_open=True):
+        poll.update_open_status()
+    return n_applied
+
+
+class VoteBuffer(object):
+    """
+    Pending votes waiting to be flushed to the database
+    """
+    def __init__(self, max_batch=DEFAULT_OPTIONS['MAX_BATCH'],
+                 max_delay_ms=DEFAULT_OPTIONS['MAX_DELAY_MS'],
+                 journal=None, fsync=True, autoflush=True):
+        self.max_batch = max_batch
+        self.max_delay = max_delay_ms / 1000.0
+        self.journal = journal
+        self.fsync = fsync
+        self._pending = collections.OrderedDict()
+        # batch being written by flush
+        self._inflight = {}
+        self._lock = threading.Condition()
+        self._flush_lock = threading.Lock()
+        self._journal_file = None
+        self._closed = False
+        self._thread = None
+        if autoflush:
+            self._thread = threading.Thread(target=self._flush_loop, name='vote-buffer')
+            self._thread.daemon = True
+            self._thread.start()
+
+    def __len__(self):
+        return len(self._pending)
+
+    def is_pending(self, poll_id, user_id):
+        """
+        Has user_id a vote for poll_id waiting to be flushed
+        """
+        key = (int(poll_id), int(user_id))
+        return key in self._pending or key in self._inflight
+
+    def add(self, poll_id, user_id, choice_id):
+        """
+        Acknowledge a vote - returns False if the user already has a
+        pending vote for this poll
+        """
+        key = (int(poll_id), int(user_id))
+        with self._lock:
+            if key in self._pending or key in self._inflight:
+                return False
+            self._append_journal(key, int(choice_id))
+            self._pending[key] = int(choice_id)
+            if len(self._pending) == 1 or len(self._pending) >= self.max_batch:
+                self._lock.notify_all()
+        return True
+
+    def flush(self):
+        """
+        Write all pending votes to the database. Returns number of votes written
+        """
+        with self._flush_lock:
+            with self._lock:
+                batch, self._pending = self._pending, collections.OrderedDict()
+                self._inflight = batch
+            if not batch:
+                return 0
+            try:
+                n_applied = apply_votes(batch)
+            except Exception:
+                # keep the votes for the next flush
+                with self._lock:
+                    batch.update(self._pending)
+                    self._pending = batch
+                    self._inflight = {}
+                raise
+            with self._lock:
+                self._inflight = {}
+            self._compact_journal()
+            return n_applied
+
+    def replay(self):
+        """
+        Load the votes left in the journal by a previous process and write them
+        """
+        if self.journal is None or not os.path.exists(self.journal):
+            return 0
+        with self._lock:
+            with open(self.journal) as journal:
+                for line in journal:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        # torn write of the last line before a crash
+                        continue
+                    key = (entry['poll'], entry['user'])
+                    self._pending.setdefault(key, entry['choice'])
+        return self.flush()
+
+    def close(self):
+        """
+        Stop the flush thread and write what is left
+        """
+        with self._lock:
+            self._closed = True
+            self._lock.notify_all()
+        if self._thread is not None:
+            self._thread.join()
+        self.flush()
+        if self._journal_file is not None:
+            self._journal_file.close()
+            self._journal_file = None
+
+    def _flush_loop(self):
+        """
+        Flush when max_batch votes are pending or max_delay after the first one
+        """
+        while True:
+            with self._lock:
+                while not self._pending and not self._closed:
+                    self._lock.wait()
+                if self._closed:
+                    return
+                if len(self._pending) < self.max_batch:
+                    self._lock.wait(self.max_delay)
+            try:
+                self.flush()
+            except Exception:
+                # votes were put back - retry after the next delay
+                with self._lock:
+                    self._lock.wait(self.max_delay)
+
+    def _append_journal(self, key, choice_id):
+        """
+        Append a vote to the journal - called with self._lock held
+        """
+        if self.journal is None:
+            return
+        if self._journal_file is None:
+            self._journal_file = open(self.journal, 'a')
+        self._journal_file.write(json.dumps({'poll': key[0], 'user': key[1],
+                                             'choice': choice_id}) + '\n')
+        self._journal_file.flush()
+        if self.fsync:
+            os.fsync(self._journal_file.fileno())
+
+    def _compact_journal(self):
+        """
+        Rewrite the journal with only the votes still pending
+        """
+        if self.journal is None:
+            return
+        with self._lock:
+            tmp_path = self.journal + '.tmp'
+            with open(tmp_path, 'w') as tmp:
+                for (poll_id, user_id), choice_id in self._pending.items():
+                    tmp.write(json.dumps({'poll': poll_id, 'user': user_id,
+                                          'choice': choice_id}) + '\n')
+                tmp.flush()
+                if self.fsync:
+                    os.fsync(tmp.fileno())
+            if self._journal_file is not None:
+                self._journal_file.close()
+                self._journal_file = None
+            os.rename(tmp_path, self.journal)
+
+
+def get_vote_buffer():
+    """
+    Return the process wide vote buffer - None if write-behind voting is off
+    """
+    global _vote_buffer
+    if _vote_buffer is not None:
+        return _vote_buffer
+    options = dict(DEFAULT_OPTIONS, **getattr(settings, 'POLLS_VOTE_BUFFER', {}))
+    if not options['ENABLED']:
+        return None
+    with _vote_buffer_lock:
+        if _vote_buffer is None:
+            vote_buffer = VoteBuffer(max_batch=options['MAX_BATCH'],
+                                     max_delay_ms=options['MAX_DELAY_MS'],
+                                     journal=options['JOURNAL'],
+                                     fsync=options['FSYNC'])
+            # votes acknowledged by a process that died before flushing
+            vote_buffer.replay()
+            atexit.register(vote_buffer.close)
+            _vote_buffer = vote_buffer
+    return _vote_buffer
+
+def set_vote_buffer(vote_buffer):
+    """
+    Install vote_buffer as the process wide buffer (None to drop it)
+    """
+    global _vote_buffer
+    with _vote_buffer_lock:
+        _vote_buffer = vote_buffer
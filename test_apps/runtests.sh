@@ -1 +1,6 @@
-coverage run manage.py test test_apps polls && coverage report -m --omit '*virtualenvs*'
+coverage erase
+coverage run manage.py test test_apps polls "$@"
+status=$?
+# merge the data files of the test worker processes
+coverage combine && coverage report -m --omit '*virtualenvs*'
+exit $status
@@ -0,0 +1,13 @@
+"""
+App config of the project package
+"""
+from django.apps import AppConfig
+
+
+class TestAppsConfig(AppConfig):
+    name = 'test_apps'
+    verbose_name = 'Test apps'
+
+    def ready(self):
+        from test_apps import sqlite_profile
+        sqlite_profile.connect_signals()
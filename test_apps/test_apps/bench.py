@@ -0,0 +1,119 @@
+"""
+Helpers shared by the benchmark management commands
+"""
+from django.db import connection, close_old_connections
+from django.test.utils import CaptureQueriesContext
+from django.test.utils import setup_test_environment, teardown_test_environment
+from django.contrib.auth.models import User
+
+from test_apps.utils import factory
+
+import contextlib
+import math
+import time
+
+# users inserted per bulk_create call while seeding benchmark data
+SEED_BATCH_SIZE = 10000
+
+
+@contextlib.contextmanager
+def bench_database(verbosity=0):
+    """
+    Run the enclosed benchmark against a throwaway test database, with the
+    test environment set up so that the test client can be used
+    """
+    old_name = connection.settings_dict['NAME']
+    setup_test_environment()
+    connection.creation.create_test_db(verbosity=verbosity, autoclobber=True,
+                                       serialize=False)
+    try:
+        yield connection
+    finally:
+        connection.creation.destroy_test_db(old_name, verbosity=verbosity)
+        teardown_test_environment()
+
+def timed(func, *args, **kwargs):
+    """
+    Call func - return (seconds taken, number of queries run, result)
+    """
+    with CaptureQueriesContext(connection) as queries:
+        start = time.time()
+        result = func(*args, **kwargs)
+        elapsed = time.time() - start
+    return elapsed, len(queries), result
+
+def timed_request(client, method, path, data=None):
+    """
+    Send a request with the test client - return (seconds taken, response).
+    Handles the connection at the end of the request like a WSGI server
+    would, which the test client itself skips
+    """
+    start = time.time()
+    response = getattr(client, method)(path, data or {})
+    close_old_connections()
+    return time.time() - start, response
+
+def measure_request(client, method, path, data=None):
+    """
+    Send a request with the test client - return (seconds taken, number of
+    queries run, response)
+    """
+    with CaptureQueriesContext(connection) as queries:
+        elapsed, response = timed_request(client, method, path, data)
+    return elapsed, len(queries), response
+
+def percentile(values, pct):
+    """
+    Nearest rank percentile of values - None if there are none
+    """
+    if not values:
+        return None
+    ordered = sorted(values)
+    rank = int(math.ceil(pct / 100.0 * len(ordered)))
+    return ordered[max(rank, 1) - 1]
+
+def summarize(timings, query_counts):
+    """
+    Latency percentiles (milliseconds) and query counts of a benchmark
+    """
+    ms = [t * 1000 for t in timings]
+    return {
+        'runs': len(ms),
+        'mean_ms': sum(ms) / len(ms) if ms else None,
+        'p50_ms': percentile(ms, 50),
+        'p90_ms': percentile(ms, 90),
+        'p99_ms': percentile(ms, 99),
+        'max_ms': max(ms) if ms else None,
+        'queries': percentile(query_counts, 50),
+        'max_queries': max(query_counts) if query_counts else None,
+    }
+
+def compare_to_baseline(results, baseline, max_regression=0.2):
+    """
+    Compare benchmark summaries to a saved baseline - returns list of
+    (name, metric, baseline value, current value) for the benchmarks whose
+    median latency grew by more than max_regression (a fraction) or that
+    run more queries
+    """
+    regressions = []
+    for name, current in sorted(results.items()):
+        before = baseline.get(name)
+        if not before:
+            continue
+        if before['p50_ms'] and current['p50_ms'] > before['p50_ms'] * (1 + max_regression):
+            regressions.append((name, 'p50_ms', before['p50_ms'], current['p50_ms']))
+        if current['max_queries'] > before['max_queries']:
+            regressions.append((name, 'max_queries', before['max_queries'],
+                                current['max_queries']))
+    return regressions
+
+def seed_users(count, prefix='benchuser'):
+    """
+    Make sure count benchmark users exist - all with the password prefix
+    """
+    n_existing = User.objects.filter(username__startswith=prefix).count()
+    for start in range(n_existing, count, SEED_BATCH_SIZE):
+        stop = min(start + SEED_BATCH_SIZE, count)
+        factory.create_users([{'username': '%s%d' % (prefix, i), 'password': prefix}
+                              for i in range(start, stop)])
+    return count
@@ -0,0 +1,97 @@
+"""
+Compare vote and index throughput with the SQLite profile on and off
+"""
+from django.core.management.base import BaseCommand
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.urlresolvers import reverse
+from django.db import connection
+from django.test import Client
+from django.test.utils import override_settings
+
+from test_apps.bench import bench_database, timed_request, seed_users
+from test_apps.utils import create_poll, add_default_choices
+
+import threading
+
+
+class Command(BaseCommand):
+    help = 'Benchmark vote and index throughput with the SQLite profile on and off'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--users', type=int, default=200,
+                            help='Users - each casts one vote')
+        parser.add_argument('--index-requests', type=int, default=100,
+                            help='Index page requests per client thread')
+        parser.add_argument('--threads', type=int, default=1,
+                            help='Concurrent client threads')
+
+    def handle(self, *args, **options):
+        row = '%-8s %12s %12s'
+        self.stdout.write(row % ('profile', 'votes/s', 'index req/s'))
+        for enabled in (False, True):
+            votes_rate, index_rate = self.run_profile(enabled, options)
+            self.stdout.write(row % ('on' if enabled else 'off',
+                                     '%.1f' % votes_rate, '%.1f' % index_rate))
+
+    def run_profile(self, enabled, options):
+        """
+        Return (votes/s, index requests/s) on a fresh database
+        """
+        profile = dict(settings.SQLITE_PROFILE, ENABLED=enabled)
+        old_settings = dict(connection.settings_dict)
+        connection.close()
+        connection.settings_dict['CONN_MAX_AGE'] = 600 if enabled else 0
+        connection.settings_dict['OPTIONS'] = {'timeout': 20 if enabled else 5}
+        try:
+            with override_settings(SQLITE_PROFILE=profile), bench_database():
+                seed_users(options['users'])
+                poll = create_poll(question='bench poll', days=-1)
+                choice_ids = [c.id for c in add_default_choices(poll)]
+                users = list(User.objects.filter(username__startswith='benchuser'))
+
+                vote_url = reverse('polls:vote', args=(poll.id,))
+                def vote(thread_users):
+                    for i, user in enumerate(thread_users):
+                        client = Client()
+                        client.force_login(user)
+                        yield timed_request(client, 'post', vote_url,
+                                            {'choice': choice_ids[i % len(choice_ids)]})[0]
+                votes_rate = self.rate(users, vote, options['threads'])
+
+                index_url = reverse('polls:index')
+                def index(thread_users):
+                    client = Client()
+                    client.force_login(thread_users[0])
+                    for _ in range(options['index_requests']):
+                        yield timed_request(client, 'get', index_url)[0]
+                index_rate = self.rate(users, index, options['threads'])
+        finally:
+            connection.close()
+            connection.settings_dict.update(old_settings)
+        return votes_rate, index_rate
+
+    def rate(self, users, work, n_threads):
+        """
+        Split users over n_threads running work - return requests per second
+        of wall time spent in requests
+        """
+        timings = []
+        def worker(thread_users):
+            try:
+                timings.extend(work(thread_users))
+            finally:
+                if n_threads > 1:
+                    connection.close()
+        if n_threads == 1:
+            worker(users)
+            elapsed = sum(timings)
+        else:
+            threads = [threading.Thread(target=worker, args=(users[i::n_threads],))
+                       for i in range(n_threads)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            elapsed = sum(timings) / n_threads
+        return len(timings) / elapsed if elapsed else 0
@@ -0,0 +1,103 @@
+"""
+List the request profiles saved by the profiling middleware and diff two of
+them
+"""
+from django.core.management.base import BaseCommand, CommandError
+
+from test_apps.profiling import get_store
+
+
+class Command(BaseCommand):
+    help = ('List the latest request profiles, or diff two of them - the two '
+            'latest ones unless ids (or id prefixes) are given')
+
+    def add_arguments(self, parser):
+        parser.add_argument('action', choices=('list', 'diff'))
+        parser.add_argument('ids', nargs='*', help='Profiles to diff - old then new')
+        parser.add_argument('--limit', type=int, default=20,
+                            help='Profiles listed, or functions and types diffed')
+
+    def handle(self, *args, **options):
+        self.store = get_store()
+        if options['action'] == 'list':
+            self.list_profiles(options['limit'])
+        else:
+            self.diff_profiles(options['ids'], options['limit'])
+
+    def load(self, profile_id):
+        try:
+            return self.store.load(profile_id)
+        except KeyError as error:
+            raise CommandError(error.args[0])
+
+    def list_profiles(self, limit):
+        row = '%-42s %-6s %-24s %9s %7s %6s %s'
+        self.stdout.write(row % ('id', 'method', 'url name', 'view ms', 'queries',
+                                 'status', 'modes'))
+        for profile_id in self.store.ids()[:limit]:
+            meta = self.store.load(profile_id)
+            self.stdout.write(row % (profile_id, meta['method'], meta['url_name'],
+                                     '%.2f' % meta['view_ms'], meta.get('queries', '-'),
+                                     meta['status'], ','.join(meta['modes'])))
+
+    def diff_profiles(self, ids, limit):
+        if not ids:
+            ids = self.store.ids()[:2][::-1]
+        if len(ids) != 2:
+            raise CommandError('Need two profiles to diff')
+        old, new = self.load(ids[0]), self.load(ids[1])
+        self.stdout.write('%s -> %s' % (old['id'], new['id']))
+        self.stdout.write('view ms: %.2f -> %.2f' % (old['view_ms'], new['view_ms']))
+        if 'queries' in old and 'queries' in new:
+            self.stdout.write('queries: %d -> %d' % (old['queries'], new['queries']))
+        old_stats, new_stats = self.store.load_stats(old), self.store.load_stats(new)
+        if old_stats is not None and new_stats is not None:
+            self.diff_cpu(old_stats, new_stats, limit)
+        if 'memory' in old and 'memory' in new:
+            self.diff_memory(old['memory'], new['memory'], limit)
+
+    def diff_cpu(self, old_stats, new_stats, limit):
+        """
+        Functions whose cumulative time changed the most
+        """
+        old_times, new_times = cumulative_times(old_stats), cumulative_times(new_stats)
+        changes = sorted(((new_times.get(f, (0, 0))[1] - old_times.get(f, (0, 0))[1], f)
+                          for f in set(old_times) | set(new_times)),
+                         key=lambda change: -abs(change[0]))
+        row = '%10s %10s %10s %8s %8s  %s'
+        self.stdout.write('')
+        self.stdout.write(row % ('old ms', 'new ms', 'delta ms', 'old n', 'new n',
+                                 'function (cumulative)'))
+        for delta, func in changes[:limit]:
+            old_calls, old_time = old_times.get(func, (0, 0))
+            new_calls, new_time = new_times.get(func, (0, 0))
+            self.stdout.write(row % ('%.2f' % (old_time * 1000), '%.2f' % (new_time * 1000),
+                                     '%+.2f' % (delta * 1000), old_calls, new_calls,
+                                     '%s:%d(%s)' % func))
+
+    def diff_memory(self, old_memory, new_memory, limit):
+        """
+        Types whose allocated object count changed the most
+        """
+        self.stdout.write('')
+        self.stdout.write('objects allocated: %d -> %d' % (old_memory['objects'],
+                                                           new_memory['objects']))
+        self.stdout.write('max rss growth kB: %d -> %d' % (old_memory['max_rss_growth_kb'],
+                                                           new_memory['max_rss_growth_kb']))
+        old_types, new_types = dict(old_memory['types']), dict(new_memory['types'])
+        changes = sorted(((new_types.get(t, 0) - old_types.get(t, 0), t)
+                          for t in set(old_types) | set(new_types)),
+                         key=lambda change: -abs(change[0]))
+        row = '%8s %8s %8s  %s'
+        self.stdout.write(row % ('old', 'new', 'delta', 'type'))
+        for delta, name in changes[:limit]:
+            if delta:
+                self.stdout.write(row % (old_types.get(name, 0), new_types.get(name, 0),
+                                         '%+d' % delta, name))
+
+def cumulative_times(stats):
+    """
+    Function to (calls, cumulative seconds) of a pstats.Stats
+    """
+    return dict((func, (nc, ct)) for func, (cc, nc, tt, ct, callers)
+                in stats.stats.items())
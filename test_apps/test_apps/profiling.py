@@ -0,0 +1,217 @@
+"""
+On-demand profiling of single requests - staff add ?profile=cpu, mem or all
+(or an X-Profile header with the same values) to a request and its view runs
+under cProfile and/or an object allocation snapshot. The pstats dump and a
+JSON file with the request metadata are saved per request. Configured with
+settings.PROFILING, see the profiles command for listing and diffing them
+"""
+from django.conf import settings
+from django.core.exceptions import MiddlewareNotUsed
+from django.db import connections
+
+import cProfile
+import collections
+import datetime
+import gc
+import json
+import os
+import pstats
+import resource
+import threading
+import time
+
+DEFAULT_OPTIONS = {
+    'ENABLED': False,
+    'DIRECTORY': 'profiles',
+    # profiles kept - the oldest are removed beyond it
+    'KEEP': 50,
+    # object types kept in the allocation snapshot
+    'TOP_TYPES': 30,
+}
+
+QUERY_PARAM = 'profile'
+HEADER = 'HTTP_X_PROFILE'
+MODES = ('cpu', 'mem')
+
+# cProfile cannot profile two requests at once
+_profile_lock = threading.Lock()
+
+
+def get_options():
+    return dict(DEFAULT_OPTIONS, **getattr(settings, 'PROFILING', {}))
+
+def requested_modes(request):
+    """
+    Profiling modes asked for by request - empty unless a staff member asked
+    """
+    value = request.GET.get(QUERY_PARAM) or request.META.get(HEADER)
+    if not value or not getattr(request, 'user', None) or not request.user.is_staff:
+        return ()
+    values = set(v.strip().lower() for v in value.split(','))
+    if values & set(['all', '1', 'true']):
+        return MODES
+    return tuple(mode for mode in MODES if mode in values)
+
+def count_objects():
+    """
+    Live objects per type - only those tracked by the garbage collector,
+    i.e. containers and instances, not strings or numbers
+    """
+    counts = collections.Counter()
+    for obj in gc.get_objects():
+        cls = type(obj)
+        counts['%s.%s' % (cls.__module__, cls.__name__)] += 1
+    return counts
+
+def max_rss_kb():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+class AllocationSnapshot(object):
+    """
+    Objects allocated and still alive between start and stop, per type. The
+    cycle collector runs before start only, so garbage left by the view is
+    counted too. The standard library of this Python has no tracemalloc
+    """
+    def start(self):
+        gc.collect()
+        self.before = count_objects()
+        self.max_rss_before = max_rss_kb()
+
+    def stop(self, top_types):
+        after = count_objects()
+        after.subtract(self.before)
+        growth = [(name, n) for name, n in after.most_common() if n > 0]
+        return {
+            'objects': sum(n for _, n in growth),
+            'types': growth[:top_types],
+            'max_rss_kb': max_rss_kb(),
+            'max_rss_growth_kb': max_rss_kb() - self.max_rss_before,
+        }
+
+
+class ProfileStore(object):
+    """
+    Saved profiles - <id>.json with the metadata and <id>.prof with the
+    pstats dump of the cpu mode. Ids sort by time
+    """
+    def __init__(self, directory):
+        self.directory = directory
+
+    def path(self, profile_id, extension):
+        return os.path.join(self.directory, profile_id + extension)
+
+    def new_id(self, url_name):
+        stamp = datetime.datetime.now().strftime('%Y%m%d-%H%M%S-%f')
+        return '%s-%s' % (stamp, url_name.replace(':', '.').replace(os.sep, '_'))
+
+    def save(self, profile_id, metadata, profiler=None):
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+        if profiler is not None:
+            profiler.dump_stats(self.path(profile_id, '.prof'))
+            metadata['stats'] = profile_id + '.prof'
+        with open(self.path(profile_id, '.json'), 'w') as meta_file:
+            json.dump(metadata, meta_file, indent=2, sort_keys=True)
+
+    def ids(self):
+        """
+        Ids of the saved profiles, newest first
+        """
+        if not os.path.isdir(self.directory):
+            return []
+        return sorted((name[:-len('.json')] for name in os.listdir(self.directory)
+                       if name.endswith('.json')), reverse=True)
+
+    def load(self, profile_id):
+        """
+        Metadata of the profile whose id starts with profile_id
+        """
+        matches = [i for i in self.ids() if i.startswith(profile_id)]
+        if len(matches) != 1:
+            raise KeyError('%s matches %d profiles' % (profile_id, len(matches)))
+        with open(self.path(matches[0], '.json')) as meta_file:
+            return json.load(meta_file)
+
+    def load_stats(self, metadata):
+        """
+        pstats.Stats of a profile - None unless it ran in cpu mode
+        """
+        if not metadata.get('stats'):
+            return None
+        return pstats.Stats(os.path.join(self.directory, metadata['stats']))
+
+    def prune(self, keep):
+        for profile_id in self.ids()[keep:]:
+            for extension in ('.json', '.prof'):
+                if os.path.exists(self.path(profile_id, extension)):
+                    os.remove(self.path(profile_id, extension))
+
+def get_store():
+    directory = get_options()['DIRECTORY']
+    if not os.path.isabs(directory):
+        directory = os.path.join(settings.PROJECT_DIR, directory)
+    return ProfileStore(directory)
+
+
+class ProfilingMiddleware(object):
+    """
+    Run the view under the profilers a staff member asked for. Goes last in
+    MIDDLEWARE_CLASSES since it calls the view itself - the process_view of
+    the middleware after it would be skipped
+    """
+    def __init__(self):
+        options = get_options()
+        if not options['ENABLED']:
+            raise MiddlewareNotUsed()
+        self.options = options
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        modes = requested_modes(request)
+        if not modes:
+            return None
+        with _profile_lock:
+            return self.profile_view(request, modes, view_func, view_args, view_kwargs)
+
+    def profile_view(self, request, modes, view_func, view_args, view_kwargs):
+        profiler = cProfile.Profile() if 'cpu' in modes else None
+        snapshot = AllocationSnapshot() if 'mem' in modes else None
+        n_queries = sum(len(conn.queries_log) for conn in connections.all())
+        if snapshot is not None:
+            snapshot.start()
+        response = None
+        start = time.time()
+        try:
+            if profiler is not None:
+                response = profiler.runcall(view_func, request, *view_args, **view_kwargs)
+            else:
+                response = view_func(request, *view_args, **view_kwargs)
+        finally:
+            elapsed = time.time() - start
+            resolver_match = getattr(request, 'resolver_match', None)
+            url_name = resolver_match.view_name if resolver_match else view_func.__name__
+            store = get_store()
+            profile_id = store.new_id(url_name)
+            metadata = {
+                'id': profile_id,
+                'url_name': url_name,
+                'method': request.method,
+                'path': request.get_full_path(),
+                'user': request.user.get_username(),
+                'started': datetime.datetime.fromtimestamp(start).isoformat(),
+                'view_ms': elapsed * 1000,
+                'status': response.status_code if response is not None else None,
+                'modes': list(modes),
+                'pid': os.getpid(),
+            }
+            # queries are only logged with DEBUG on
+            if any(conn.queries_logged for conn in connections.all()):
+                metadata['queries'] = sum(len(conn.queries_log)
+                                          for conn in connections.all()) - n_queries
+            if snapshot is not None:
+                metadata['memory'] = snapshot.stop(self.options['TOP_TYPES'])
+            store.save(profile_id, metadata, profiler)
+            store.prune(self.options['KEEP'])
+        if response is not None:
+            response['X-Profile-Id'] = profile_id
+        return response
@@ -0,0 +1,72 @@
+"""
+Test runner spreading the test classes over worker processes - django's
+--parallel, on by default with one worker per CPU (TEST_PARALLEL in the
+environment overrides it). Every worker gets its own copy of the SQLite
+test database file
+"""
+from django.conf import settings
+from django.db import connections
+from django.test.runner import DiscoverRunner, default_test_processes
+
+import os
+
+# password hashing only slows down the logins of the tests
+TEST_PASSWORD_HASHERS = ['django.contrib.auth.hashers.MD5PasswordHasher']
+
+TEST_POLLS_JOBS = {'SYNC': True, 'RETRY_DELAY_MS': 0}
+
+
+def default_parallel():
+    return int(os.environ.get('TEST_PARALLEL') or default_test_processes())
+
+
+class ParallelTestRunner(DiscoverRunner):
+    """
+    DiscoverRunner with parallel workers by default
+    """
+    @classmethod
+    def add_arguments(cls, parser):
+        super(ParallelTestRunner, cls).add_arguments(parser)
+        parser.set_defaults(parallel=default_parallel())
+
+    def setup_test_environment(self, **kwargs):
+        super(ParallelTestRunner, self).setup_test_environment(**kwargs)
+        settings.PASSWORD_HASHERS = TEST_PASSWORD_HASHERS
+        # background jobs run inline - their effects are checked right away
+        settings.POLLS_JOBS = dict(getattr(settings, 'POLLS_JOBS', {}), **TEST_POLLS_JOBS)
+
+    def setup_databases(self, **kwargs):
+        """
+        Create the test databases, then the copies of the workers. The copies
+        are made once the WAL of the SQLite profile is written back to the
+        database file since only that file is copied
+        """
+        parallel, self.parallel = self.parallel, 1
+        try:
+            old_config = super(ParallelTestRunner, self).setup_databases(**kwargs)
+        finally:
+            self.parallel = parallel
+        if self.parallel > 1:
+            for connection, _, created in old_config:
+                if not created:
+                    continue
+                if connection.vendor == 'sqlite':
+                    with connection.cursor() as cursor:
+                        cursor.execute('PRAGMA wal_checkpoint(TRUNCATE)')
+                for index in range(self.parallel):
+                    connection.creation.clone_test_db(number=index + 1,
+                                                      verbosity=self.verbosity,
+                                                      keepdb=self.keepdb)
+        return old_config
+
+    def teardown_databases(self, old_config, **kwargs):
+        super(ParallelTestRunner, self).teardown_databases(old_config, **kwargs)
+        # journal files the workers' connections left behind
+        for connection, _, created in old_config:
+            if not created or connection.vendor != 'sqlite' or self.keepdb:
+                continue
+            for index in range(self.parallel if self.parallel > 1 else 0):
+                name = connection.creation.get_test_db_clone_settings(index + 1)['NAME']
+                for suffix in ('-wal', '-shm'):
+                    if os.path.exists(name + suffix):
+                        os.remove(name + suffix)
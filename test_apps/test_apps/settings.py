@@ -41,9 +41,10 @@ INSTALLED_APPS = (
     'django.contrib.sessions',
     'django.contrib.messages',
     'django.contrib.staticfiles',
-    'polls',
+    'polls.apps.PollsConfig',
     'blogs',
     'session_security',
+    'test_apps.apps.TestAppsConfig',
 )
 
 MIDDLEWARE_CLASSES = (
@@ -53,9 +54,31 @@ MIDDLEWARE_CLASSES = (
     'django.contrib.auth.middleware.AuthenticationMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
-    'session_security.middleware.SessionSecurityMiddleware'
+    'session_security.middleware.SessionSecurityMiddleware',
+    # times the view only. Opt-in, see REQUEST_TIMING
+    'test_apps.timing.RequestTimingMiddleware',
+    # last - calls the view itself when profiling, see PROFILING
+    'test_apps.profiling.ProfilingMiddleware',
 )
 
+# Per-request SQL/template/view timing in Server-Timing headers and a
+# summary per URL name at /timing/ - see test_apps/timing.py.
+# REQUEST_TIMING=1 in the environment turns it on
+REQUEST_TIMING = {
+    'ENABLED': os.environ.get('REQUEST_TIMING', '0') == '1',
+    'SLOW_QUERIES': 3,
+    'WINDOW': 200,
+}
+
+# Staff profile a single request with ?profile=cpu|mem|all or an X-Profile
+# header - see test_apps/profiling.py, list and diff the saved profiles
+# with manage.py profiles. PROFILING=1 in the environment turns it on
+PROFILING = {
+    'ENABLED': os.environ.get('PROFILING', '0') == '1',
+    'DIRECTORY': os.path.join(PROJECT_DIR, 'profiles'),
+    'KEEP': 50,
+}
+
 ROOT_URLCONF = 'test_apps.urls'
 
 WSGI_APPLICATION = 'test_apps.wsgi.application'
@@ -64,10 +87,62 @@ WSGI_APPLICATION = 'test_apps.wsgi.application'
 # Database
 # https://docs.djangoproject.com/en/1.6/ref/settings/#databases
 
+# High throughput SQLite profile - see test_apps/sqlite_profile.py for the
+# pragmas, transaction mode and retry policy. It trades durability
+# (synchronous=NORMAL) for speed and takes the write lock in every
+# transaction, so it is opt-in: SQLITE_PROFILE=1 in the environment turns
+# it on
+SQLITE_PROFILE = {
+    'ENABLED': os.environ.get('SQLITE_PROFILE', '0') == '1',
+}
+
 DATABASES = {
     'default': {
         'ENGINE': 'django.db.backends.sqlite3',
         'NAME': os.path.join(PROJECT_DIR, 'storage.db.sqlite3'),
+        # persistent connections and busy timeout (seconds) of the profile
+        'CONN_MAX_AGE': 600 if SQLITE_PROFILE['ENABLED'] else 0,
+        'OPTIONS': {
+            'timeout': 20 if SQLITE_PROFILE['ENABLED'] else 5,
+        },
+        # file backed test db - in-memory sqlite cannot be shared between
+        # the threads of the concurrency tests
+        'TEST': {
+            'NAME': os.path.join(PROJECT_DIR, 'test.db.sqlite3'),
+        },
+    }
+}
+
+# Tests run in parallel worker processes - see test_apps/runner.py
+TEST_RUNNER = 'test_apps.runner.ParallelTestRunner'
+
+# Write-behind voting - see polls/vote_buffer.py
+POLLS_VOTE_BUFFER = {
+    'ENABLED': False,
+    'MAX_BATCH': 100,
+    'MAX_DELAY_MS': 50,
+    'JOURNAL': os.path.join(PROJECT_DIR, 'vote_journal.log'),
+    'FSYNC': True,
+}
+
+# Background jobs - see polls/jobs.py. The test runner sets SYNC
+POLLS_JOBS = {
+    'THREADS': 2,
+    'MAX_ATTEMPTS': 3,
+    'RETRY_DELAY_MS': 1000,
+    'SYNC': False,
+}
+
+# Cache
+# https://docs.djangoproject.com/en/1.9/topics/cache/
+# results pages are cached here - the file based backend works as well:
+# 'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+# 'LOCATION': os.path.join(PROJECT_DIR, 'cache'),
+
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        'LOCATION': 'test_apps',
     }
 }
 
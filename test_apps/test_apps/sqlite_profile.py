@@ -0,0 +1,138 @@
+"""
+High throughput SQLite profile - WAL journal, fewer fsyncs, a bigger page
+cache and memory mapped reads on every new connection, transactions that
+take the write lock up front, persistent connections with a periodic
+health check and retries of writes that hit a locked database.
+Configured with settings.SQLITE_PROFILE
+"""
+from django.conf import settings
+from django.db import connections, OperationalError
+from django.db.backends.signals import connection_created
+from django.core.signals import request_started
+
+from functools import wraps
+import time
+
+DEFAULT_PROFILE = {
+    'ENABLED': False,
+    'PRAGMAS': (
+        ('journal_mode', 'WAL'),
+        # with WAL only a power loss can lose the last commits
+        ('synchronous', 'NORMAL'),
+        # negative - size in KiB
+        ('cache_size', -64000),
+        ('mmap_size', 256 * 1024 * 1024),
+        ('temp_store', 'MEMORY'),
+    ),
+    # seconds between health checks of a persistent connection
+    'HEALTH_CHECK_INTERVAL': 30,
+    # BEGIN of the transactions - IMMEDIATE takes the write lock up front,
+    # so a transaction that read first waits for other writers (busy
+    # timeout) instead of failing with 'database is locked' when it writes.
+    # None for SQLite's default, DEFERRED
+    'TRANSACTION_MODE': 'IMMEDIATE',
+    # attempts and first backoff (seconds) of retry_on_locked
+    'LOCKED_RETRIES': 3,
+    'LOCKED_BACKOFF': 0.05,
+}
+
+
+def get_profile():
+    """
+    Return the configured SQLite profile merged over the defaults
+    """
+    return dict(DEFAULT_PROFILE, **getattr(settings, 'SQLITE_PROFILE', {}))
+
+def is_sqlite(connection):
+    return connection.vendor == 'sqlite'
+
+def waits_for_writers(connection):
+    """
+    Whether a transaction on connection that reads before it writes waits
+    for other writers - SQLite only does with the TRANSACTION_MODE of the
+    profile, otherwise it fails with 'database is locked'
+    """
+    if not is_sqlite(connection):
+        return True
+    profile = get_profile()
+    return bool(profile['ENABLED'] and
+                profile['TRANSACTION_MODE'] in ('IMMEDIATE', 'EXCLUSIVE'))
+
+def apply_pragmas(sender, connection, **kwargs):
+    """
+    connection_created hook - set the profile pragmas and the transaction
+    mode on a new connection
+    """
+    profile = get_profile()
+    if not profile['ENABLED'] or not is_sqlite(connection):
+        return
+    cursor = connection.connection.cursor()
+    try:
+        for name, value in profile['PRAGMAS']:
+            cursor.execute('PRAGMA %s = %s' % (name, value))
+    finally:
+        cursor.close()
+    if profile['TRANSACTION_MODE']:
+        begin = 'BEGIN %s' % profile['TRANSACTION_MODE']
+        # what atomic() runs to start a transaction
+        connection._start_transaction_under_autocommit = \
+            lambda: connection.cursor().execute(begin)
+    connection.last_health_check = time.time()
+
+def check_connections(sender, **kwargs):
+    """
+    request_started hook - drop persistent connections that stopped working.
+    Pings a connection at most once per HEALTH_CHECK_INTERVAL
+    """
+    profile = get_profile()
+    if not profile['ENABLED']:
+        return
+    for conn in connections.all():
+        check_connection(conn, profile['HEALTH_CHECK_INTERVAL'])
+
+def check_connection(conn, interval):
+    """
+    Ping an open SQLite connection unless it was checked within interval
+    seconds - close it if the ping fails. Returns False if it was closed
+    """
+    now = time.time()
+    if conn.connection is None or not is_sqlite(conn):
+        return True
+    if now - getattr(conn, 'last_health_check', 0) < interval:
+        return True
+    try:
+        conn.connection.execute('SELECT 1').fetchall()
+    except Exception:
+        conn.close()
+        return False
+    conn.last_health_check = now
+    return True
+
+def connect_signals():
+    connection_created.connect(apply_pragmas, dispatch_uid='sqlite_profile_pragmas')
+    request_started.connect(check_connections, dispatch_uid='sqlite_profile_health')
+
+def is_locked_error(error):
+    return 'database is locked' in str(error)
+
+def retry_on_locked(func):
+    """
+    Decorator - retry func with exponential backoff when SQLite reports the
+    database as locked. Only retries outside of an atomic block since the
+    enclosing transaction is broken by then
+    """
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+        profile = get_profile()
+        backoff = profile['LOCKED_BACKOFF']
+        for attempt in range(profile['LOCKED_RETRIES'] + 1):
+            try:
+                return func(*args, **kwargs)
+            except OperationalError as error:
+                in_atomic = any(conn.in_atomic_block for conn in connections.all())
+                if (not is_locked_error(error) or in_atomic or
+                        attempt == profile['LOCKED_RETRIES']):
+                    raise
+            time.sleep(backoff)
+            backoff *= 2
+    return wrapper
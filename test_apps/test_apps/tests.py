@@ -2,15 +2,34 @@
 Test class for polls
 """
 import datetime
+import threading
+import time
 
 from django.utils import timezone
 from django.test import TestCase
 from django.core.urlresolvers import reverse
 from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.db import connections, OperationalError
+from django.test.utils import override_settings, CaptureQueriesContext
+from django.core.management import call_command, CommandError
+from django.utils.six import StringIO
 from django.test.utils import setup_test_environment
 setup_test_environment()
 
 import test_apps.utils as utils
+from polls.models import Poll, Voter
+from test_apps import sqlite_profile
+from test_apps import bench
+from test_apps import timing
+from test_apps import profiling
+
+import os
+import re
+import shutil
+import sqlite3
+import tempfile
+import unittest
 
 VALID_CREDS = {
     'username': 'testuser',
@@ -34,6 +53,67 @@ class UtilsTest(TestCase):
         preview_data = utils.get_app_preview_ctx('polls')
         self.assertTrue(len(preview_data.keys()) > 0)
 
+    def test_target_apps_cached(self):
+        """
+        Test that the app registry is built once and previews are lazy
+        """
+        target_apps = utils.get_target_apps()
+        self.assertTrue(utils.get_target_apps() is target_apps)
+        self.assertEqual([a['name'] for a in target_apps], ['polls', 'blogs'])
+        with self.assertNumQueries(0):
+            utils.get_target_apps()
+
+    def test_app_preview_ctx_invalidation(self):
+        """
+        Test that saving or deleting a poll drops the cached preview context
+        """
+        utils.invalidate_app_preview_ctx()
+        preview_ctx = utils.get_target_apps()[0]['preview_ctx']
+        self.assertEqual(len(preview_ctx['app_objects']), 0)
+        self.assertTrue(utils.get_app_preview_ctx('polls') is
+                        utils.get_app_preview_ctx('polls'))
+
+        poll = utils.create_default_poll()
+        self.assertEqual(list(preview_ctx['app_objects']), [poll])
+        with self.assertNumQueries(0):
+            list(preview_ctx['app_objects'])
+
+        poll.delete()
+        self.assertEqual(len(preview_ctx['app_objects']), 0)
+        self.assertEqual(len(utils.get_target_apps()[1]['preview_ctx']['app_objects']), 0)
+
+    def test_cache_get_or_compute_single_flight(self):
+        """
+        Test that concurrent cache misses compute the value only once
+        """
+        cache.delete('single-flight-test')
+        calls, results = [], []
+        def compute():
+            calls.append(1)
+            time.sleep(0.2)
+            return 'value'
+        def worker():
+            results.append(utils.cache_get_or_compute('single-flight-test', compute))
+        threads = [threading.Thread(target=worker) for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(results, ['value'] * 8)
+
+    def test_cache_get_or_compute_stale_lock(self):
+        """
+        Test that a lock left behind by a dead process only delays the fill
+        """
+        cache.delete('stale-lock-test')
+        cache.set('stale-lock-test:lock', 1)
+        value = utils.cache_get_or_compute('stale-lock-test', lambda: 'value',
+                                           lock_timeout=0.1)
+        self.assertEqual(value, 'value')
+        self.assertEqual(cache.get('stale-lock-test'), 'value')
+        self.assertEqual(cache.get('stale-lock-test:lock'), None)
+
     def test_create_delete_users(self):
         user_info = [
             {'username': 'u1', 'email': 'u1@u1.com', 'password': 'u1'},
@@ -42,6 +122,374 @@ class UtilsTest(TestCase):
         list(utils.create_users(user_info))
         list(utils.create_users())
 
+class BulkFactoryTest(TestCase):
+    """
+    Test the bulk fixture factory
+    """
+    def test_create_users_constant_queries(self):
+        """
+        Test that many users take a few queries and can log in
+        """
+        info = [{'username': 'bulkuser%d' % i} for i in range(50)]
+        # existing users, insert, new users, segments of the open polls
+        with self.assertNumQueries(4):
+            users = utils.factory.create_users(info)
+        self.assertEqual([u.username for u in users], [i['username'] for i in info])
+        self.assertTrue(self.client.login(username='bulkuser7', password='bulkuser7'))
+        # existing users are returned, not created again
+        with self.assertNumQueries(1):
+            self.assertEqual(utils.factory.create_users(info[:3]), users[:3])
+
+    def test_password_hashed_once(self):
+        """
+        Test that users sharing a password share its hash
+        """
+        users = utils.factory.create_users([{'username': 'shared%d' % i, 'password': 'secret'}
+                                            for i in range(3)])
+        self.assertEqual(len(set(u.password for u in users)), 1)
+        self.assertTrue(users[2].check_password('secret'))
+
+    def test_create_polls_with_votes(self):
+        """
+        Test that polls get choices, eligible voters and the seeded votes
+        """
+        utils.factory.create_users([{'username': 'bulkuser%d' % i} for i in range(6)])
+        polls = utils.factory.create_polls(['q1', 'q2'], days=-1, votes=[3, 1, 0])
+        self.assertEqual([p.question for p in polls], ['q1', 'q2'])
+        poll = Poll.objects.get(pk=polls[0].pk)
+        self.assertEqual((poll.n_eligible_voters, poll.n_voted, poll.n_votes), (6, 4, 4))
+        self.assertEqual([c.votes for c in poll.choice_set.order_by('pk')], [3, 1, 0])
+        self.assertEqual(Poll.objects.reconcile_counters(), [])
+        self.assertTrue(poll.is_open)
+
+        closed = utils.factory.create_polls(['q3'], votes=[2, 2, 2])[0]
+        self.assertEqual(Poll.objects.get(pk=closed.pk).is_open, False)
+        self.assertRaises(ValueError, utils.factory.create_polls, ['q4'], votes=[7])
+
+    def test_delete_users(self):
+        """
+        Test that users are deleted with their voters and counters fixed
+        """
+        utils.factory.create_users([{'username': 'bulkuser%d' % i} for i in range(4)])
+        poll = utils.factory.create_polls(['q1'], votes=[1])[0]
+        deleted = utils.factory.delete_users(['bulkuser0', 'bulkuser1', 'nosuchuser'])
+        self.assertEqual(sorted(deleted), ['bulkuser0', 'bulkuser1'])
+        # only the voter who voted was registered
+        self.assertEqual(Voter.objects.filter(poll=poll).count(), 0)
+        poll = Poll.objects.get(pk=poll.pk)
+        self.assertEqual((poll.n_eligible_voters, poll.n_voted, poll.n_votes), (2, 0, 1))
+
+    def test_delete_users_constant_queries(self):
+        """
+        Test that the open polls are recounted once however many users go
+        """
+        utils.factory.create_users([{'username': 'bulkuser%d' % i} for i in range(60)])
+        utils.factory.create_polls(['q1', 'q2'], votes=[5])
+        query_counts = []
+        for usernames in (['bulkuser%d' % i for i in range(10, 20)],
+                          ['bulkuser%d' % i for i in range(20, 60)]):
+            with CaptureQueriesContext(connections['default']) as queries:
+                utils.factory.delete_users(usernames)
+            query_counts.append(len(queries))
+        self.assertEqual(query_counts[0], query_counts[1])
+        self.assertEqual(Poll.objects.reconcile_counters(), [])
+
+    def test_helpers_keep_signatures(self):
+        """
+        Test that the old helpers go through the factory
+        """
+        users = list(utils.create_users(count=3))
+        self.assertEqual([u.username for u in users], ['testuser1', 'testuser2', 'testuser3'])
+        poll = utils.create_default_poll()
+        self.assertEqual((poll.n_eligible_voters, poll.voter_set.count()), (3, 0))
+        self.assertEqual([c.choice_text for c in utils.add_default_choices(poll)],
+                         ['choice1', 'choice2', 'choice3'])
+        self.assertEqual(sorted(utils.delete_users(count=3)), [u.username for u in users])
+        self.assertRaises(ValueError, list, utils.create_users(count=utils.MAX_TESTUSER_COUNT + 1))
+
+
+@override_settings(REQUEST_TIMING={'ENABLED': True, 'SLOW_QUERIES': 2})
+class RequestTimingTest(utils.LoginMixin, utils.TestCaseWithUtils):
+    """
+    Test the request timing middleware
+    """
+    def setUp(self):
+        super(RequestTimingTest, self).setUp()
+        timing.request_timings.clear()
+        self.poll = utils.create_default_poll()
+
+    def test_server_timing_header(self):
+        """
+        Test that query, template and view timings are sent back - with
+        the slowest statements to staff only
+        """
+        response = self.client.get(reverse('polls:detail', args=(self.poll.id,)))
+        header = response['Server-Timing']
+        entries = dict(re.findall(r'(?:^|, )(\w+);dur=([\d.]+)', header))
+        self.assertEqual(sorted(entries), ['sql', 'tpl', 'view'])
+        self.assertNotIn('SELECT', header)
+        self.assertRegexpMatches(header, r'^sql;dur=[\d.]+;desc="\d+ queries", ')
+        self.assertTrue(float(entries['tpl']) > 0)
+        User.objects.filter(pk=self.user.pk).update(is_staff=True)
+        response = self.client.get(reverse('polls:detail', args=(self.poll.id,)))
+        # statement previews in desc may contain commas
+        entries = dict(re.findall(r'(?:^|, )(\w+);dur=([\d.]+)', response['Server-Timing']))
+        self.assertEqual(sorted(entries), ['sql', 'sql1', 'sql2', 'tpl', 'view'])
+
+    def test_summary_per_url_name(self):
+        """
+        Test that requests are summarized per URL name
+        """
+        for _ in range(3):
+            self.client.get(reverse('polls:index_data'))
+        self.client.get(reverse('loggedin_view'))
+        summary = timing.request_timings.summary()
+        self.assertEqual(summary['polls:index_data']['requests'], 3)
+        self.assertEqual(summary['loggedin_view']['requests'], 1)
+        self.assertTrue(summary['polls:index_data']['queries_mean'] > 0)
+        slowest = summary['polls:index_data']['slowest_sql']
+        self.assertEqual(len(slowest), 2)
+        self.assertTrue(slowest[0]['ms'] >= slowest[1]['ms'])
+        self.assertTrue(slowest[0]['sql'].startswith('SELECT'))
+
+    def test_summary_view_staff_only(self):
+        """
+        Test that only staff gets the summary
+        """
+        response = self.client.get(reverse('timing_view'))
+        self.assertEqual(response.status_code, 302)
+        User.objects.filter(pk=self.user.pk).update(is_staff=True)
+        response = self.client.get(reverse('timing_view'))
+        self.assertIn('timing_view', response.json())
+
+    @override_settings(REQUEST_TIMING={'ENABLED': False})
+    def test_disabled(self):
+        """
+        Test that nothing is collected unless enabled
+        """
+        response = self.client.get(reverse('polls:index'))
+        self.assertFalse(response.has_header('Server-Timing'))
+        self.assertEqual(timing.request_timings.summary(), {})
+
+    def test_slowest_queries_kept(self):
+        """
+        Test that only the slowest statements are kept
+        """
+        request_timing = timing.RequestTiming(n_slow_queries=2)
+        for i, elapsed in enumerate([0.3, 0.1, 0.5, 0.2]):
+            request_timing.add_query('SELECT %d' % i, elapsed)
+        self.assertEqual(request_timing.slowest_queries(), [(0.5, 'SELECT 2'), (0.3, 'SELECT 0')])
+        self.assertEqual(request_timing.n_queries, 4)
+        self.assertAlmostEqual(request_timing.sql_time, 1.1)
+
+
+class ProfilingTest(utils.LoginMixin, utils.TestCaseWithUtils):
+    """
+    Test the on-demand request profiling
+    """
+    def setUp(self):
+        super(ProfilingTest, self).setUp()
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+        settings_override = override_settings(PROFILING={'ENABLED': True, 'KEEP': 3,
+                                                         'DIRECTORY': self.directory})
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+        utils.create_default_poll()
+
+    def make_staff(self):
+        User.objects.filter(pk=self.user.pk).update(is_staff=True)
+
+    def test_staff_only(self):
+        """
+        Test that the profiling trigger is ignored for non-staff users
+        """
+        response = self.client.get(reverse('polls:index'), {'profile': 'all'})
+        self.assertEqual(response.status_code, 200)
+        self.assertFalse(response.has_header('X-Profile-Id'))
+        self.assertEqual(profiling.get_store().ids(), [])
+
+    def test_profile_saved(self):
+        """
+        Test that the pstats dump and the metadata of a request are saved
+        """
+        self.make_staff()
+        response = self.client.get(reverse('polls:index'), {'profile': 'all'})
+        self.assertEqual(response.status_code, 200)
+        store = profiling.get_store()
+        self.assertEqual(store.ids(), [response['X-Profile-Id']])
+        metadata = store.load(response['X-Profile-Id'])
+        self.assertEqual(metadata['url_name'], 'polls:index')
+        self.assertEqual(metadata['user'], self.user.username)
+        self.assertEqual(metadata['status'], 200)
+        self.assertEqual(metadata['modes'], ['cpu', 'mem'])
+        self.assertTrue(metadata['memory']['objects'] > 0)
+        stats = store.load_stats(metadata)
+        self.assertTrue(any(func[2] == 'index' for func in stats.stats))
+
+    def test_header_trigger(self):
+        """
+        Test that the X-Profile header picks the modes
+        """
+        self.make_staff()
+        response = self.client.get(reverse('polls:index'), HTTP_X_PROFILE='mem')
+        metadata = profiling.get_store().load(response['X-Profile-Id'])
+        self.assertEqual(metadata['modes'], ['mem'])
+        self.assertNotIn('stats', metadata)
+        self.assertIn('memory', metadata)
+
+    def test_oldest_pruned(self):
+        """
+        Test that only the latest KEEP profiles are kept
+        """
+        self.make_staff()
+        ids = [self.client.get(reverse('polls:index'), {'profile': 'cpu'})['X-Profile-Id']
+               for _ in range(4)]
+        self.assertEqual(profiling.get_store().ids(), ids[:0:-1])
+        self.assertEqual(len(os.listdir(self.directory)), 6)
+
+    def test_profiles_command(self):
+        """
+        Test listing and diffing the saved profiles
+        """
+        self.make_staff()
+        old_id = self.client.get(reverse('polls:index'), {'profile': 'all'})['X-Profile-Id']
+        new_id = self.client.get(reverse('polls:index'), {'profile': 'all'})['X-Profile-Id']
+        out = StringIO()
+        call_command('profiles', 'list', stdout=out)
+        lines = out.getvalue().splitlines()
+        self.assertEqual([line.split()[0] for line in lines[1:]], [new_id, old_id])
+
+        out = StringIO()
+        call_command('profiles', 'diff', stdout=out)
+        self.assertIn('%s -> %s' % (old_id, new_id), out.getvalue())
+        self.assertIn('function (cumulative)', out.getvalue())
+        self.assertIn('objects allocated', out.getvalue())
+        self.assertRaises(CommandError, call_command, 'profiles', 'diff', old_id)
+
+
+class BenchReportTest(unittest.TestCase):
+    """
+    Test the benchmark summaries and the baseline comparison
+    """
+    def test_percentile(self):
+        """
+        Test nearest rank percentiles
+        """
+        values = range(1, 101)
+        self.assertEqual(bench.percentile(values, 50), 50)
+        self.assertEqual(bench.percentile(values, 99), 99)
+        self.assertEqual(bench.percentile(values, 100), 100)
+        self.assertEqual(bench.percentile([3], 0), 3)
+        self.assertEqual(bench.percentile([], 50), None)
+
+    def test_summarize(self):
+        """
+        Test that timings are reported in milliseconds with query counts
+        """
+        summary = bench.summarize([0.001, 0.002, 0.003], [4, 4, 6])
+        self.assertEqual(summary['runs'], 3)
+        self.assertAlmostEqual(summary['p50_ms'], 2)
+        self.assertAlmostEqual(summary['max_ms'], 3)
+        self.assertEqual((summary['queries'], summary['max_queries']), (4, 6))
+
+    def test_compare_to_baseline(self):
+        """
+        Test that slower medians and extra queries are regressions
+        """
+        baseline = {
+            'index': bench.summarize([0.010] * 5, [8] * 5),
+            'vote': bench.summarize([0.010] * 5, [13] * 5),
+        }
+        results = {
+            'index': bench.summarize([0.011] * 5, [8] * 5),
+            'vote': bench.summarize([0.013] * 5, [14] * 5),
+            'results': bench.summarize([0.010] * 5, [6] * 5),
+        }
+        regressions = bench.compare_to_baseline(results, baseline, max_regression=0.2)
+        self.assertEqual([(name, metric) for name, metric, _, _ in regressions],
+                         [('vote', 'p50_ms'), ('vote', 'max_queries')])
+
+
+class SqliteProfileTest(unittest.TestCase):
+    """
+    Test the high throughput SQLite profile
+    """
+    def setUp(self):
+        db_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, db_dir)
+        settings_dict = dict(connections['default'].settings_dict, NAME=os.path.join(db_dir, 'profile.db'))
+        self.conn = connections['default'].__class__(settings_dict, alias='profile_test')
+        self.addCleanup(self.conn.close)
+
+    def pragma(self, name):
+        return self.conn.connection.execute('PRAGMA %s' % name).fetchone()[0]
+
+    def test_pragmas_on_new_connection(self):
+        """
+        Test that a new connection gets the profile pragmas
+        """
+        with override_settings(SQLITE_PROFILE={'ENABLED': True}):
+            self.conn.ensure_connection()
+        self.assertEqual(self.pragma('journal_mode'), 'wal')
+        self.assertEqual(self.pragma('synchronous'), 1)
+        self.assertEqual(self.pragma('cache_size'), -64000)
+
+    def test_pragmas_disabled(self):
+        """
+        Test that the pragmas are left alone with the profile off
+        """
+        with override_settings(SQLITE_PROFILE={'ENABLED': False}):
+            self.conn.ensure_connection()
+        self.assertEqual(self.pragma('journal_mode'), 'delete')
+
+    def test_transactions_take_write_lock(self):
+        """
+        Test that a transaction holds the write lock before it writes
+        """
+        with override_settings(SQLITE_PROFILE={'ENABLED': True}):
+            self.conn.ensure_connection()
+        other = sqlite3.connect(self.conn.settings_dict['NAME'], timeout=0)
+        self.addCleanup(other.close)
+        # how atomic() starts a transaction on SQLite
+        self.conn.set_autocommit(False, force_begin_transaction_with_broken_autocommit=True)
+        self.conn.cursor().execute('SELECT 1')
+        self.assertRaises(sqlite3.OperationalError, other.execute, 'CREATE TABLE t (x)')
+        self.conn.rollback()
+        self.conn.set_autocommit(True)
+        other.execute('CREATE TABLE t (x)')
+
+    def test_health_check_closes_broken_connection(self):
+        """
+        Test that a broken persistent connection is dropped
+        """
+        self.conn.ensure_connection()
+        self.conn.last_health_check = 0
+        self.assertTrue(sqlite_profile.check_connection(self.conn, 30))
+        self.conn.connection.close()
+        self.assertTrue(sqlite_profile.check_connection(self.conn, 30))
+        self.conn.last_health_check = 0
+        self.assertFalse(sqlite_profile.check_connection(self.conn, 30))
+        self.assertEqual(self.conn.connection, None)
+
+    def test_retry_on_locked(self):
+        """
+        Test that locked database errors are retried and others are not
+        """
+        calls = []
+        def flaky(error):
+            calls.append(1)
+            if len(calls) < 3:
+                raise OperationalError(error)
+            return 'done'
+        with override_settings(SQLITE_PROFILE={'LOCKED_BACKOFF': 0}):
+            self.assertEqual(sqlite_profile.retry_on_locked(flaky)('database is locked'), 'done')
+            calls[:] = []
+            self.assertRaises(OperationalError,
+                              sqlite_profile.retry_on_locked(flaky), 'no such table')
+        self.assertEqual(len(calls), 1)
+
+
 class LoginViewTest(TestCase):
     """
     Test the login page
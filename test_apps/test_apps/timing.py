@@ -0,0 +1,253 @@
+"""
+Per-request timing - query count, SQL time, the slowest statements,
+template render time and view time of every request, sent back in a
+Server-Timing header and kept in a rolling summary per URL name. The
+statements themselves are only shown to staff - in the header of their
+own requests and in the summary. Configured with settings.REQUEST_TIMING
+"""
+from django.conf import settings
+from django.core.exceptions import MiddlewareNotUsed
+from django.db import connections
+from django.template.base import Template
+
+import collections
+import heapq
+import threading
+import time
+
+DEFAULT_OPTIONS = {
+    'ENABLED': False,
+    # slowest statements kept per request
+    'SLOW_QUERIES': 3,
+    # requests per URL name kept in the rolling summary
+    'WINDOW': 200,
+    # characters of a statement shown in the Server-Timing header of staff
+    'SQL_PREVIEW': 60,
+}
+
+_current = threading.local()
+_install_lock = threading.Lock()
+
+
+def get_options():
+    return dict(DEFAULT_OPTIONS, **getattr(settings, 'REQUEST_TIMING', {}))
+
+def current_timing():
+    """
+    RequestTiming of the request handled by this thread - None outside of
+    a timed request
+    """
+    return getattr(_current, 'timing', None)
+
+
+class RequestTiming(object):
+    """
+    Timings collected during one request
+    """
+    def __init__(self, n_slow_queries):
+        self.n_slow_queries = n_slow_queries
+        self.n_queries = 0
+        self.sql_time = 0.0
+        # min-heap of (seconds, sql) - the slowest statements
+        self.slow_queries = []
+        self.template_time = 0.0
+        self.template_depth = 0
+        self.view_start = None
+        self.view_time = None
+
+    def add_query(self, sql, elapsed):
+        self.n_queries += 1
+        self.sql_time += elapsed
+        if len(self.slow_queries) < self.n_slow_queries:
+            heapq.heappush(self.slow_queries, (elapsed, sql))
+        elif self.slow_queries and elapsed > self.slow_queries[0][0]:
+            heapq.heapreplace(self.slow_queries, (elapsed, sql))
+
+    def slowest_queries(self):
+        return sorted(self.slow_queries, reverse=True)
+
+    def server_timing(self, sql_preview, statements=False):
+        """
+        Server-Timing header value - durations in milliseconds, with the
+        slowest statements if statements is set
+        """
+        entries = [
+            'sql;dur=%.2f;desc="%d queries"' % (self.sql_time * 1000, self.n_queries),
+            'tpl;dur=%.2f' % (self.template_time * 1000),
+        ]
+        if self.view_time is not None:
+            entries.append('view;dur=%.2f' % (self.view_time * 1000))
+        if not statements:
+            return ', '.join(entries)
+        for i, (elapsed, sql) in enumerate(self.slowest_queries()):
+            preview = ' '.join(sql.split())[:sql_preview].replace('\\', '').replace('"', "'")
+            entries.append('sql%d;dur=%.2f;desc="%s"' % (i + 1, elapsed * 1000, preview))
+        return ', '.join(entries)
+
+
+class TimingSummary(object):
+    """
+    Rolling summary of the last window requests per URL name
+    """
+    def __init__(self, window=DEFAULT_OPTIONS['WINDOW'],
+                 slow_queries=DEFAULT_OPTIONS['SLOW_QUERIES']):
+        self.window = window
+        self.slow_queries = slow_queries
+        self._timings = {}
+        self._lock = threading.Lock()
+
+    def add(self, url_name, timing):
+        record = (timing.view_time or 0.0, timing.sql_time, timing.n_queries,
+                  timing.template_time, timing.slowest_queries())
+        with self._lock:
+            if url_name not in self._timings:
+                self._timings[url_name] = collections.deque(maxlen=self.window)
+            self._timings[url_name].append(record)
+
+    def clear(self):
+        with self._lock:
+            self._timings.clear()
+
+    def summary(self):
+        """
+        Dict of URL name to request count and mean/p50/p95 view time,
+        mean SQL time, queries and template time (milliseconds), and the
+        slowest statements of the window
+        """
+        with self._lock:
+            timings = dict((name, list(records)) for name, records in self._timings.items())
+        summary = {}
+        for name, records in timings.items():
+            view_times = sorted(r[0] * 1000 for r in records)
+            n = len(records)
+            summary[name] = {
+                'requests': n,
+                'view_ms_mean': sum(view_times) / n,
+                'view_ms_p50': view_times[(n - 1) // 2],
+                'view_ms_p95': view_times[min(n - 1, int(n * 0.95))],
+                'sql_ms_mean': sum(r[1] for r in records) * 1000 / n,
+                'queries_mean': float(sum(r[2] for r in records)) / n,
+                'template_ms_mean': sum(r[3] for r in records) * 1000 / n,
+                'slowest_sql': [{'ms': elapsed * 1000, 'sql': ' '.join(sql.split())}
+                                for elapsed, sql in heapq.nlargest(
+                                    self.slow_queries, (q for r in records for q in r[4]))],
+            }
+        return summary
+
+request_timings = TimingSummary()
+
+
+class TimedCursor(object):
+    """
+    Cursor wrapper reporting the statements to the current RequestTiming
+    """
+    def __init__(self, cursor):
+        self.cursor = cursor
+
+    def __getattr__(self, attr):
+        return getattr(self.cursor, attr)
+
+    def __iter__(self):
+        return iter(self.cursor)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return self.cursor.__exit__(*exc_info)
+
+    def _timed(self, method, sql, *args):
+        timing = current_timing()
+        if timing is None:
+            return method(sql, *args)
+        start = time.time()
+        try:
+            return method(sql, *args)
+        finally:
+            timing.add_query(sql, time.time() - start)
+
+    def execute(self, sql, params=None):
+        return self._timed(self.cursor.execute, sql, params)
+
+    def executemany(self, sql, param_list):
+        return self._timed(self.cursor.executemany, sql, param_list)
+
+def install_cursor_timing(connection):
+    """
+    Wrap the cursors handed out by connection in TimedCursor - once per
+    connection object
+    """
+    if getattr(connection, '_timed_cursors', False):
+        return
+    make_cursor = connection.make_cursor
+    make_debug_cursor = connection.make_debug_cursor
+    connection.make_cursor = lambda cursor: TimedCursor(make_cursor(cursor))
+    connection.make_debug_cursor = lambda cursor: TimedCursor(make_debug_cursor(cursor))
+    connection._timed_cursors = True
+
+def install_template_timing():
+    """
+    Time the renders of top level templates - includes are part of their
+    parent's render
+    """
+    with _install_lock:
+        if getattr(Template.render, 'timed', False):
+            return
+        render = Template.render
+
+        def timed_render(self, *args, **kwargs):
+            timing = current_timing()
+            if timing is None:
+                return render(self, *args, **kwargs)
+            timing.template_depth += 1
+            start = time.time()
+            try:
+                return render(self, *args, **kwargs)
+            finally:
+                timing.template_depth -= 1
+                if timing.template_depth == 0:
+                    timing.template_time += time.time() - start
+        timed_render.timed = True
+        Template.render = timed_render
+
+
+class RequestTimingMiddleware(object):
+    """
+    Collect the timings of every request. Goes last in MIDDLEWARE_CLASSES so
+    that the view time covers the view only. SQL run while rendering
+    templates counts in both the SQL and the template time
+    """
+    def __init__(self):
+        options = get_options()
+        if not options['ENABLED']:
+            raise MiddlewareNotUsed()
+        self.options = options
+        request_timings.window = options['WINDOW']
+        request_timings.slow_queries = options['SLOW_QUERIES']
+        install_template_timing()
+
+    def process_request(self, request):
+        for connection in connections.all():
+            install_cursor_timing(connection)
+        _current.timing = RequestTiming(self.options['SLOW_QUERIES'])
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        timing = current_timing()
+        if timing is not None:
+            timing.view_start = time.time()
+
+    def process_response(self, request, response):
+        timing = current_timing()
+        if timing is None:
+            return response
+        _current.timing = None
+        if timing.view_start is not None:
+            timing.view_time = time.time() - timing.view_start
+        resolver_match = getattr(request, 'resolver_match', None)
+        url_name = resolver_match.view_name if resolver_match else '<unresolved>'
+        request_timings.add(url_name, timing)
+        # statements give the schema away - staff only
+        user = getattr(request, 'user', None)
+        response['Server-Timing'] = timing.server_timing(
+            self.options['SQL_PREVIEW'], statements=user is not None and user.is_staff)
+        return response
@@ -15,4 +15,5 @@ urlpatterns = patterns('',
     url(r'^accounts/login/$', 'test_apps.views.login_view', name='login_view'),
     url(r'^accounts/loggedin/$', 'test_apps.views.loggedin_view', name='loggedin_view'),
     url(r'^accounts/logout/$', 'test_apps.views.logout_view', name='logout_view'),
+    url(r'^timing/$', 'test_apps.views.timing_view', name='timing_view'),
 )
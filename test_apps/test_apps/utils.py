@@ -4,21 +4,213 @@ Utility functions used in the project
 from django.template import RequestContext
 from django.utils import timezone
 from django.shortcuts import render_to_response
-from django.http import HttpResponse, HttpResponseRedirect
+from django.http import HttpResponse, HttpResponseRedirect, Http404
 from django.contrib.auth.models import User
+from django.contrib.auth.hashers import make_password
+from django.db import connection, transaction
+from django.db.models import F
 from django.test import TestCase
 from django.core.urlresolvers import reverse
 from django.shortcuts import get_object_or_404
+from django.core.cache import cache
+from django.utils.cache import patch_cache_control
+from django.views.decorators.http import condition
 from functools import wraps
 
 import test_apps.settings as settings
-from polls.models import Poll, Choice
+from polls.models import Poll, Choice, Voter, changed, batched_recounts, SEGMENT_ALL
+from polls.vote_buffer import get_vote_buffer
+import collections
+import contextlib
 import datetime
 import importlib
+import re
+import threading
+import time
 
 MAX_TESTUSER_COUNT = 10
 
+# values per IN (...) lookup and rows per Voter bulk_create of the
+# BulkFactory - sqlite allows 999 query parameters. Other bulk_create calls
+# leave the batch size to the database backend
+FACTORY_BATCH_SIZE = 500
 
+DEFAULT_CHOICES = ('choice1', 'choice2', 'choice3')
+
+# (app name, index url, navbar caption) of the apps reachable from the navbar
+TARGET_APPS = (
+    ('polls', 'polls:index', 'Polls'),
+    ('blogs', 'blogs:index', 'Blogs'),
+)
+
+# per process caches - see get_target_apps and get_app_preview_ctx
+_target_apps = None
+_preview_ctx_cache = {}
+
+# single flight cache fills - see cache_get_or_compute
+SINGLE_FLIGHT_LOCK_TIMEOUT = 10
+SINGLE_FLIGHT_POLL_INTERVAL = 0.05
+_single_flight_locks = [threading.Lock() for _ in range(64)]
+_cache_miss = object()
+
+# EXPLAIN QUERY PLAN detail of a full table scan - a scan in index order,
+# e.g. for ORDER BY ... LIMIT, names the index it walks
+FULL_SCAN_RE = re.compile(r'^SCAN (?:TABLE )?(\w+)(?: AS \w+)?$')
+
+
+
+class BulkFactory(object):
+    """
+    Create and delete test users, polls, choices and voters in batches - a
+    few queries per batch instead of a few per object. Every distinct
+    password is hashed once per process
+    """
+    _password_hashes = {}
+
+    def __init__(self, batch_size=FACTORY_BATCH_SIZE):
+        self.batch_size = batch_size
+
+    def chunks(self, values):
+        values = list(values)
+        for start in range(0, len(values), self.batch_size):
+            yield values[start:start + self.batch_size]
+
+    def hash_password(self, password):
+        if password not in self._password_hashes:
+            self._password_hashes[password] = make_password(password)
+        return self._password_hashes[password]
+
+    def get_users(self, usernames):
+        """
+        Return dict of username to user for the existing ones of usernames
+        """
+        users = {}
+        for chunk in self.chunks(usernames):
+            users.update((user.username, user)
+                         for user in User.objects.filter(username__in=chunk))
+        return users
+
+    def create_users(self, user_info):
+        """
+        Create the users described by user_info - dicts with username and
+        optionally email and password (defaults to the username) - unless
+        they exist. Returns the users in user_info order
+        """
+        usernames = [info['username'] for info in user_info]
+        users = self.get_users(usernames)
+        new_users = collections.OrderedDict()
+        for info in user_info:
+            username = info['username']
+            if username in users or username in new_users:
+                continue
+            new_users[username] = User(
+                username=username,
+                email=info.get('email', '%s@%s.com' % (username, username)),
+                password=self.hash_password(info.get('password', username)))
+        # sqlite does not hand back the primary keys - fetch the users again
+        User.objects.bulk_create(new_users.values())
+        users.update(self.get_users(new_users))
+        if new_users:
+            # bulk_create sends no signals - do what the User receiver would
+            Poll.objects.filter(is_open=True, segment=SEGMENT_ALL).refresh_eligible_counts()
+        return [users[username] for username in usernames]
+
+    def delete_users(self, usernames):
+        """
+        Delete the users named in usernames along with their voters - the
+        counters of the open polls are recounted once, the ones of the
+        polls they were registered for fixed up. Returns the usernames that
+        existed
+        """
+        deleted = []
+        with transaction.atomic(), batched_recounts():
+            for chunk in self.chunks(usernames):
+                users = User.objects.filter(username__in=chunk)
+                poll_ids = list(Voter.objects.filter(user__in=users)
+                                             .values_list('poll', flat=True).distinct())
+                deleted.extend(users.values_list('username', flat=True))
+                users.delete()
+                Poll.objects.filter(pk__in=poll_ids).reconcile_counters()
+        return deleted
+
+    def create_polls(self, questions, days=0, choices=DEFAULT_CHOICES, votes=None):
+        """
+        Create a poll of all users per question, published days from now,
+        with the given choice texts. votes optionally pre-seeds the votes -
+        a count per choice, cast by the pending voters Poll.take_pending_voters
+        picks. Polls in which everybody voted are closed. Returns the polls
+        in questions order
+        """
+        pub_date = timezone.now() + datetime.timedelta(days=days)
+        n_users = User.objects.count()
+        Poll.objects.bulk_create([Poll(question=question, pub_date=pub_date,
+                                       n_eligible_voters=n_users)
+                                  for question in questions])
+        by_question = {}
+        for chunk in self.chunks(questions):
+            by_question.update((poll.question, poll)
+                               for poll in Poll.objects.filter(question__in=chunk))
+        polls = [by_question[question] for question in questions]
+
+        Choice.objects.bulk_create([Choice(poll=poll, choice_text=name)
+                                    for poll in polls for name in choices])
+        if votes:
+            for poll in polls:
+                self.seed_votes(poll, votes)
+        invalidate_app_preview_ctx('polls')
+        return polls
+
+    def add_choices(self, poll, choices):
+        """
+        Add choices - dicts with name and votes - to poll. Returns the new
+        choices
+        """
+        last_pk = poll.choice_set.order_by('-pk').values_list('pk', flat=True).first() or 0
+        Choice.objects.bulk_create([Choice(poll=poll, choice_text=choice['name'],
+                                           votes=choice['votes'])
+                                    for choice in choices])
+        n_votes = sum(choice['votes'] for choice in choices)
+        # bulk_create sends no signals - do what the Choice receivers would
+        Poll.objects.filter(pk=poll.pk).update(**changed(n_votes=F('n_votes') + n_votes))
+        invalidate_app_preview_ctx('polls')
+        poll.n_votes += n_votes
+        return list(poll.choice_set.filter(pk__gt=last_pk).order_by('pk'))
+
+    def seed_votes(self, poll, votes):
+        """
+        Cast votes[i] votes for the i-th choice of poll (in pk order) by
+        the pending voters Poll.take_pending_voters picks
+        """
+        choices = list(poll.choice_set.order_by('pk'))
+        n_votes = sum(votes)
+        if not n_votes:
+            return
+        with transaction.atomic():
+            n_voters = len(poll.take_pending_voters(n_votes))
+            if n_voters < n_votes:
+                # rolls back the voters taken
+                raise ValueError('Poll %s has only %d voters left for %d votes'
+                                 % (poll.pk, n_voters, n_votes))
+            for choice, n_choice_votes in zip(choices, votes):
+                if n_choice_votes:
+                    Choice.objects.filter(pk=choice.pk)\
+                                  .update(votes=F('votes') + n_choice_votes)
+            Poll.objects.filter(pk=poll.pk).update(**changed(n_voted=F('n_voted') + n_votes,
+                                                             n_votes=F('n_votes') + n_votes))
+        poll.refresh_from_db()
+        poll.update_open_status()
+
+    def delete_polls(self, polls):
+        """
+        Delete polls with their choices and voters
+        """
+        poll_ids = [getattr(poll, 'pk', poll) for poll in polls]
+        with transaction.atomic():
+            for chunk in self.chunks(poll_ids):
+                Poll.objects.filter(pk__in=chunk).delete()
+        invalidate_app_preview_ctx('polls')
+
+factory = BulkFactory()
 
 def create_user(username=None, password=None, email=None):
     """
@@ -30,7 +222,8 @@ def create_user(username=None, password=None, email=None):
         password = username 
     if email is None:
         email = 'test@test.com'
-    return User.objects.create_user(username, email, password)
+    return factory.create_users([{'username': username, 'email': email,
+                                  'password': password}])[0]
 
 def create_users(user_info = None, prefix='testuser', count=5):
     """
@@ -42,22 +235,18 @@ def create_users(user_info = None, prefix='testuser', count=5):
     if count > MAX_TESTUSER_COUNT:
         raise ValueError('Cannot create more than %d users' % MAX_TESTUSER_COUNT)
 
+    factory_info = []
     for i in range(1, count + 1):
         # get current user info if provided:
         curr_user = {}
         if user_info:
             curr_user = user_info[i - 1]
+        info = dict(curr_user)
+        info.setdefault('username', prefix + str(i))
+        factory_info.append(info)
 
-        username = curr_user.get('username', prefix + str(i))
-
-        try:
-            user = User.objects.get(username=username)
-        except User.DoesNotExist:
-            email = curr_user.get('email', '%s@%s.com'% (username, username))
-            password = curr_user.get('password', username)
-            user = create_user(username=username, email=email, password=password)
-        finally:
-            yield user
+    for user in factory.create_users(factory_info):
+        yield user
 
 def delete_user(user):
     """
@@ -75,64 +264,133 @@ def delete_users(user_info = None, prefix='testuser', count=5):
     if count > MAX_TESTUSER_COUNT:
         raise ValueError('Cannot delete more than %d users' % MAX_TESTUSER_COUNT)
 
+    usernames = []
     for i in range(1, count + 1):
         # get current user info if provided:
         curr_user = {}
         if user_info:
             curr_user = user_info[i - 1]
+        usernames.append(curr_user.get('username', prefix + str(i)))
 
-        username = curr_user.get('username', prefix + str(i))
-
-        try:
-            user = User.objects.get(username=username)
-        except User.DoesNotExist:
-            pass
-        else:
-            username = user.username
-            delete_user(user)
-            yield username
+    for username in factory.delete_users(usernames):
+        yield username
 
 def create_poll(question, days):
     """
     Create a poll
     """
-    return Poll.objects.create(question=question,  
-                               pub_date = timezone.now() + \
-                               datetime.timedelta(days=days))
+    return factory.create_polls([question], days=days, choices=())[0]
 
 def add_poll_choices(poll, choices):
     """ 
     Add a choices to an existing poll
     """
-    for choice in choices:
-        yield Choice.objects.create(poll_id = poll.id, 
-                                    choice_text = choice['name'], 
-                                    votes = choice['votes'])
+    for choice in factory.add_choices(poll, list(choices)):
+        yield choice
 
 def add_default_choices(poll):
     """
     Add default choices to an existing poll
     """
-    choices = [
-        { 'name': 'choice1', 'votes': 0 },
-        { 'name': 'choice2', 'votes': 0 },
-        { 'name': 'choice3', 'votes': 0 },
-    ]
+    choices = [{ 'name': name, 'votes': 0 } for name in DEFAULT_CHOICES]
     return list(add_poll_choices(poll, choices))
 
 def create_default_poll():
     """
     Create poll with default question and default choices
     """
-    poll = create_poll(question='test question', days=-5)
-    add_default_choices(poll)
-    return poll
+    return factory.create_polls(['test question'], days=-5)[0]
+
 
+class RecordingCursor(object):
+    """
+    Cursor wrapper appending the (sql, params) of its statements to a list
+    """
+    def __init__(self, cursor, statements):
+        self.cursor = cursor
+        self.statements = statements
+
+    def __getattr__(self, attr):
+        return getattr(self.cursor, attr)
+
+    def __iter__(self):
+        return iter(self.cursor)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return self.cursor.__exit__(*exc_info)
+
+    def execute(self, sql, params=None):
+        self.statements.append((sql, params))
+        return self.cursor.execute(sql, params)
+
+    def executemany(self, sql, param_list):
+        return self.cursor.executemany(sql, param_list)
+
+class QueryPlanCapture(object):
+    """
+    Record the statements run on a connection - plans then asks SQLite how
+    it runs the SELECTs among them, with the same parameters
+    """
+    def __init__(self, conn=None):
+        self.connection = conn or connection
+        self.statements = []
+
+    def __enter__(self):
+        self.make_cursor = self.connection.make_cursor
+        self.make_debug_cursor = self.connection.make_debug_cursor
+        self.connection.make_cursor = lambda cursor: RecordingCursor(
+            self.make_cursor(cursor), self.statements)
+        self.connection.make_debug_cursor = lambda cursor: RecordingCursor(
+            self.make_debug_cursor(cursor), self.statements)
+        return self
+
+    def __exit__(self, *exc_info):
+        self.connection.make_cursor = self.make_cursor
+        self.connection.make_debug_cursor = self.make_debug_cursor
+
+    def plans(self):
+        """
+        List of (sql, plan) of the SELECTs recorded - plan is the list of
+        the detail column of EXPLAIN QUERY PLAN
+        """
+        plans = []
+        with self.connection.cursor() as cursor:
+            for sql, params in self.statements:
+                if not sql.lstrip().upper().startswith('SELECT'):
+                    continue
+                cursor.execute('EXPLAIN QUERY PLAN ' + sql, params)
+                plans.append((sql, [row[-1] for row in cursor.fetchall()]))
+        return plans
+
+    def full_scans(self, allowed_tables=()):
+        """
+        List of (table, sql) of the full table scans in the plans, other
+        than those of allowed_tables
+        """
+        scans = []
+        for sql, plan in self.plans():
+            for detail in plan:
+                match = FULL_SCAN_RE.match(detail)
+                if match and match.group(1) not in allowed_tables:
+                    scans.append((match.group(1), sql))
+        return scans
 
 class TestCaseWithUtils(TestCase):
     """
     TestCase wrapper class with helper methods
     """
+    # number of test users (testuser1, testuser2, ...) created once for the
+    # whole class as cls.users - each test's changes are rolled back
+    n_test_users = 0
+
+    @classmethod
+    def setUpTestData(cls):
+        super(TestCaseWithUtils, cls).setUpTestData()
+        cls.users = list(create_users(count=cls.n_test_users))
+
     @staticmethod
     def create_test_user(username=None):
         if username is None:
@@ -152,17 +410,33 @@ class TestCaseWithUtils(TestCase):
     def logout(self):
         self.client.logout()
 
-class LoginMixin():
+    @contextlib.contextmanager
+    def assertNoFullScans(self, allowed_tables=()):
+        """
+        Fail if SQLite plans a full table scan for a SELECT run in the
+        block, of a table other than allowed_tables
+        """
+        with QueryPlanCapture() as capture:
+            yield capture
+        scans = capture.full_scans(allowed_tables)
+        self.assertFalse(scans, 'Full table scans:\n' +
+                         '\n'.join('%s: %s' % scan for scan in scans))
+
+class LoginMixin(object):
     """
-    Mixin to add login/logout functionality to tests
+    Mixin to add login/logout functionality to tests - the user is created
+    once for the whole class
     """
+    @classmethod
+    def setUpTestData(cls):
+        super(LoginMixin, cls).setUpTestData()
+        cls.user = create_user()
+
     def setUp(self):
-        self.user = create_user()
-        self.client.login(username=self.user.username, password=self.user.username)
+        self.client.force_login(self.user)
 
     def tearDown(self):
         self.client.logout()
-        delete_user(self.user)
 
 def is_user_logged_in(client, user=None):
     """
@@ -178,32 +452,92 @@ def is_user_logged_in(client, user=None):
 
 def get_app_preview_ctx(app_name):
     """
-    Return preview context for specific app
+    Return preview context for specific app - built on first use and cached
+    until invalidate_app_preview_ctx is called
+    """
+    if app_name not in _preview_ctx_cache:
+        try:
+            app_view = importlib.import_module('%s.views' % app_name)
+        except ImportError:    
+            _preview_ctx_cache[app_name] = {}
+        else:
+            _preview_ctx_cache[app_name] = app_view.get_preview_context()
+    return _preview_ctx_cache[app_name]
+
+def invalidate_app_preview_ctx(app_name=None):
     """
-    try:
-        app_view = importlib.import_module('%s.views' % app_name)
-    except ImportError:    
-        return {}
-    return app_view.get_preview_context()
+    Drop cached preview context of app_name (all apps if not given)
+    """
+    if app_name is None:
+        _preview_ctx_cache.clear()
+    else:
+        _preview_ctx_cache.pop(app_name, None)
+
+class LazyPreviewContext(collections.Mapping):
+    """
+    Preview context of an app - only built when a template looks into it
+    """
+    def __init__(self, app_name):
+        self.app_name = app_name
+
+    def __getitem__(self, key):
+        return get_app_preview_ctx(self.app_name)[key]
+
+    def __iter__(self):
+        return iter(get_app_preview_ctx(self.app_name))
+
+    def __len__(self):
+        return len(get_app_preview_ctx(self.app_name))
 
 def get_target_apps():
     """
-    Return list of target apps
-    """
-    return [ 
-        {
-            'name': 'polls',
-            'url': 'polls:index',
-            'caption': 'Polls',
-            'preview_ctx': get_app_preview_ctx('polls')
-        },
-        {
-            'name': 'blogs',
-            'url': 'blogs:index',
-            'caption': 'Blogs',
-            'preview_ctx': get_app_preview_ctx('polls')
-        }
-    ]
+    Return list of target apps - built once per process
+    """
+    global _target_apps
+    if _target_apps is None:
+        _target_apps = [
+            {
+                'name': name,
+                'url': url,
+                'caption': caption,
+                'preview_ctx': LazyPreviewContext(name)
+            } for name, url, caption in TARGET_APPS
+        ]
+    return _target_apps
+
+def get_poll_and_voter(request, poll_id, register=False):
+    """
+    Return (poll, voter) of the current user for a published poll - fetched
+    with one joined query and cached on the request so that stacked
+    decorators and the view share it. With register, an eligible user
+    opening an open poll for the first time is registered. voter is None
+    if the user is not registered
+    """
+    if poll_id is None:
+        raise Http404('No poll given')
+    cache = request.__dict__.setdefault('_poll_voter_cache', {})
+    poll_id = int(poll_id)
+    if poll_id not in cache:
+        now = timezone.now()
+        try:
+            voter = Voter.objects.select_related('poll').get(
+                poll_id=poll_id, user_id=request.user.pk, poll__pub_date__lte=now)
+        except Voter.DoesNotExist:
+            queryset = Poll.objects.filter(pub_date__lte=now)
+            cache[poll_id] = (get_object_or_404(queryset, pk=poll_id), None)
+        else:
+            vote_buffer = get_vote_buffer()
+            if vote_buffer is not None and vote_buffer.is_pending(poll_id, voter.user_id):
+                # vote acknowledged but not flushed yet
+                voter.has_voted = True
+            cache[poll_id] = (voter.poll, voter)
+    poll, voter = cache[poll_id]
+    if voter is None and register and poll.is_open and request.user.is_authenticated():
+        # registered meanwhile if register_voter finds a voter already
+        voter = (poll.register_voter(request.user) or
+                 poll.voter_set.filter(user=request.user).first())
+        cache[poll_id] = (poll, voter)
+    return poll, voter
 
 def required_voting_status(req_status = True):
     """
@@ -213,10 +547,14 @@ def required_voting_status(req_status = True):
         @wraps(view_func)
         def view_wrapper(request, *args, **kwargs):
             #print "------- voting status check --------"
-            queryset = Poll.objects.filter(pub_date__lte=timezone.now())
-            poll_id = kwargs['poll_id']
-            poll = get_object_or_404(queryset, pk=poll_id)
-            voter = poll.voter_set.get(user=request.user)
+            # the pages of users who have not voted register them - the
+            # others only need the voter row they voted with
+            poll, voter = get_poll_and_voter(request, kwargs.get('poll_id'),
+                                             register=not req_status)
+
+            if voter is None:
+                # user not registered for this poll - can neither vote nor see results
+                return HttpResponseRedirect(reverse('polls:index'))
 
             if req_status is True:
                 #print "----------- voter should have voted ------------"
@@ -244,11 +582,7 @@ def required_poll_status(req_status = True):
         @wraps(view_func)
         def view_wrapper(request, *args, **kwargs):
             #print "------- poll status check --------"
-            queryset = Poll.objects.filter(pub_date__lte=timezone.now())
-            poll_id = None
-            if 'poll_id' in kwargs:
-                poll_id = kwargs['poll_id']
-            poll = get_object_or_404(queryset, pk=poll_id)
+            poll, _ = get_poll_and_voter(request, kwargs.get('poll_id'))
 
             if req_status is True:
                 #print "-------- poll should be open ----------"
@@ -267,6 +601,42 @@ def required_poll_status(req_status = True):
         return view_wrapper
     return decorator
             
+def poll_etag(request, poll_id, **kwargs):
+    """
+    ETag of the pages of a poll - changes with Poll.version and with the
+    user's own voter row
+    """
+    poll, voter = get_poll_and_voter(request, poll_id)
+    voter_state = 'none' if voter is None else int(voter.has_voted)
+    return '%d-%d-%s-%s' % (poll.pk, poll.version, request.user.pk, voter_state)
+
+def poll_last_modified(request, poll_id, **kwargs):
+    poll, _ = get_poll_and_voter(request, poll_id)
+    return poll.modified
+
+def conditional_page(etag_func, last_modified_func=None):
+    """
+    Decorator - answer conditional GETs with 304 while etag_func (and
+    last_modified_func if given) report no change, without calling the
+    view. Goes below the access decorators. Browsers revalidate every time
+    """
+    def decorator(view_func):
+        conditional_view = condition(etag_func=etag_func,
+                                     last_modified_func=last_modified_func)(view_func)
+        @wraps(view_func)
+        def view_wrapper(request, *args, **kwargs):
+            response = conditional_view(request, *args, **kwargs)
+            patch_cache_control(response, private=True, no_cache=True)
+            return response
+        return view_wrapper
+    return decorator
+
+def conditional_poll_page(view_func):
+    """
+    Decorator - conditional GETs of a page of a single poll, see poll_etag
+    """
+    return conditional_page(poll_etag, poll_last_modified)(view_func)
+
 def anonymous_required(view_func):
     """
     Decorator to ensure that user is not logged in
@@ -282,6 +652,39 @@ def anonymous_required(view_func):
     return view_wrapper
 
 
+def cache_get_or_compute(key, compute, timeout=None,
+                          lock_timeout=SINGLE_FLIGHT_LOCK_TIMEOUT):
+    """
+    Return the cached value of key. On a miss only one caller computes it -
+    threads of this process queue on a lock, other processes wait on a lock
+    key added to the cache - and everyone else gets the stored result
+    """
+    value = cache.get(key, _cache_miss)
+    if value is not _cache_miss:
+        return value
+
+    with _single_flight_locks[hash(key) % len(_single_flight_locks)]:
+        value = cache.get(key, _cache_miss)
+        if value is not _cache_miss:
+            return value
+
+        lock_key = '%s:lock' % key
+        deadline = time.time() + lock_timeout
+        while not cache.add(lock_key, 1, lock_timeout):
+            time.sleep(SINGLE_FLIGHT_POLL_INTERVAL)
+            value = cache.get(key, _cache_miss)
+            if value is not _cache_miss:
+                return value
+            if time.time() > deadline:
+                # lock holder died - compute it ourselves
+                break
+        try:
+            value = compute()
+            cache.set(key, value, timeout)
+        finally:
+            cache.delete(lock_key)
+    return value
+
 def render_template(request, template, context=None):
     """
     Shortcut to include RequestContext
@@ -1,14 +1,16 @@
 from django.shortcuts import render_to_response
-from django.http import HttpResponse, HttpResponseRedirect
+from django.http import HttpResponse, HttpResponseRedirect, JsonResponse
 from django.contrib import auth
 from django.core.urlresolvers import reverse
 from django.core.context_processors import csrf
 from django.contrib.auth.decorators import login_required
+from django.contrib.admin.views.decorators import staff_member_required
 from django.core.urlresolvers import reverse, NoReverseMatch
 
 import test_apps.settings as settings
 from test_apps.utils import anonymous_required
 from test_apps.utils import render_template
+from test_apps.timing import request_timings
 
 
 @anonymous_required
@@ -90,3 +92,10 @@ def logout_view(request):
         context['logged_out'] = True
     context.update(csrf(request))
     return render_template(request,'test_apps/login.html', context)
+
+@staff_member_required
+def timing_view(request):
+    """
+    Rolling request timing summary per URL name - see test_apps/timing.py
+    """
+    return JsonResponse(request_timings.summary())